@@ -0,0 +1,105 @@
+"""
+Time every startup file of the profile: wall time, time spent importing
+and time spent waiting for PVs to connect.
+
+This file sorts first, so it wraps IPython's safe_execfile (which runs the
+startup files), the import statement and the ophyd connection waits, and
+999-startup-report.py prints the report and restores them at the end.
+See startup_report() there.
+"""
+import builtins
+import os
+import sys
+import time
+
+
+class StartupTimer:
+    "Per-file wall, import and PV connection times of the startup files."
+    def __init__(self):
+        self.t0 = time.perf_counter()
+        self.files = []  # dicts, in execution order
+        self._current = None
+        self._import_depth = 0
+        self._pv_depth = 0
+        self._shell = None
+        self._safe_execfile = None
+        self._import = None
+        self._patched_waits = []
+
+    def install(self, shell):
+        self._shell = shell
+        self._safe_execfile = shell.safe_execfile
+        self._import = builtins.__import__
+        shell.safe_execfile = self._timed_execfile
+        builtins.__import__ = self._timed_import
+
+    def uninstall(self):
+        if self._shell is not None:
+            self._shell.safe_execfile = self._safe_execfile
+            self._shell = None
+        if self._import is not None:
+            builtins.__import__ = self._import
+            self._import = None
+        for cls, original in self._patched_waits:
+            cls.wait_for_connection = original
+        self._patched_waits = []
+
+    def _timed_execfile(self, fname, *args, **kwargs):
+        record = {'file': os.path.basename(fname), 'wall': 0.,
+                  'import': 0., 'pv': 0.}
+        previous, self._current = self._current, record
+        t0 = time.perf_counter()
+        try:
+            return self._safe_execfile(fname, *args, **kwargs)
+        finally:
+            record['wall'] = time.perf_counter() - t0
+            self._current = previous
+            self.files.append(record)
+            self._patch_ophyd()
+
+    def _timed_import(self, *args, **kwargs):
+        if self._import_depth or self._current is None:
+            return self._import(*args, **kwargs)
+        self._import_depth += 1
+        t0 = time.perf_counter()
+        try:
+            return self._import(*args, **kwargs)
+        finally:
+            self._import_depth -= 1
+            self._current['import'] += time.perf_counter() - t0
+
+    def pv_wait(self, seconds):
+        "Charge seconds of PV connection waiting to the current file."
+        if self._current is not None:
+            self._current['pv'] += seconds
+
+    def _patch_ophyd(self):
+        # ophyd gets imported by the first startup files; wrap its
+        # connection waits as soon as it is there
+        if self._patched_waits or 'ophyd' not in sys.modules:
+            return
+        from ophyd import Device
+        from ophyd.signal import EpicsSignalBase
+        for cls in (Device, EpicsSignalBase):
+            original = cls.wait_for_connection
+            cls.wait_for_connection = self._timed_wait(original)
+            self._patched_waits.append((cls, original))
+
+    def _timed_wait(self, wait_for_connection):
+        timer = self
+
+        def timed_wait_for_connection(self, *args, **kwargs):
+            if timer._pv_depth:
+                return wait_for_connection(self, *args, **kwargs)
+            timer._pv_depth += 1
+            t0 = time.perf_counter()
+            try:
+                return wait_for_connection(self, *args, **kwargs)
+            finally:
+                timer._pv_depth -= 1
+                timer.pv_wait(time.perf_counter() - t0)
+        return timed_wait_for_connection
+
+
+startup_timer = StartupTimer()
+startup_timer.install(get_ipython())
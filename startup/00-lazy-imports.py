@@ -0,0 +1,113 @@
+"""
+Deferred imports for the startup files.
+
+Heavy packages that most sessions never touch (olog, spec output, chxtools,
+fitting ...) are bound to stand-ins that import them on first use:
+
+    xf = lazy_import('chxtools.xfuncs')          # import chxtools.xfuncs as xf
+    leastsq = lazy_from('scipy.optimize', 'leastsq')
+    olog_client = lazy_object(SimpleOlogClient)   # created on first use
+
+lazy_imports() lists what has been resolved so far.
+"""
+import importlib
+import sys
+import types
+
+_lazy_resolved = {}
+
+
+def _lazy_resolve_module(name):
+    module = sys.modules.get(name)
+    if module is None:
+        module = importlib.import_module(name)
+        _lazy_resolved[name] = module
+    return module
+
+
+class LazyModule(types.ModuleType):
+    "Module that is imported on first attribute access."
+    def __init__(self, name):
+        super().__init__(name)
+        self.__dict__['_lazy_module'] = None
+
+    def _lazy_load(self):
+        module = self.__dict__['_lazy_module']
+        if module is None:
+            module = _lazy_resolve_module(self.__name__)
+            self.__dict__['_lazy_module'] = module
+        return module
+
+    def __getattr__(self, attr):
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        return getattr(self._lazy_load(), attr)
+
+    def __dir__(self):
+        return dir(self._lazy_load())
+
+    def __repr__(self):
+        if self.__dict__['_lazy_module'] is not None:
+            return repr(self.__dict__['_lazy_module'])
+        return "<lazy module '{}' not imported yet>".format(self.__name__)
+
+
+class LazyObject:
+    """
+    Stand-in for factory(): created on first attribute access or call, then
+    forwarded to. Dunder attributes are not forwarded, so that inspecting
+    the stand-in (e.g. when subscribing it to the RunEngine) does not
+    create the object.
+    """
+    def __init__(self, factory, description):
+        object.__setattr__(self, '_lazy_factory', factory)
+        object.__setattr__(self, '_lazy_description', description)
+        object.__setattr__(self, '_lazy_target', None)
+
+    def _lazy_load(self):
+        target = self._lazy_target
+        if target is None:
+            target = self._lazy_factory()
+            object.__setattr__(self, '_lazy_target', target)
+        return target
+
+    def __getattr__(self, attr):
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        return getattr(self._lazy_load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._lazy_load(), attr, value)
+
+    def __call__(self, *args, **kwargs):
+        return self._lazy_load()(*args, **kwargs)
+
+    def __repr__(self):
+        if self._lazy_target is not None:
+            return repr(self._lazy_target)
+        return '<lazy {} not loaded yet>'.format(self._lazy_description)
+
+
+def lazy_import(name):
+    "import name, deferred until the module is used (already imported: as is)"
+    return sys.modules.get(name) or LazyModule(name)
+
+
+def lazy_from(module, name):
+    "from module import name, deferred until name is used (called ...)"
+    if module in sys.modules:
+        return getattr(sys.modules[module], name)
+    return LazyObject(lambda: getattr(_lazy_resolve_module(module), name),
+                      '{}.{}'.format(module, name))
+
+
+def lazy_object(factory, *args, **kwargs):
+    "factory(*args, **kwargs), deferred until the result is used"
+    name = (getattr(factory, '_lazy_description', None) or
+            getattr(factory, '__name__', None) or repr(factory))
+    return LazyObject(lambda: factory(*args, **kwargs), name + '()')
+
+
+def lazy_imports():
+    "Names of the deferred modules that got imported so far."
+    return sorted(_lazy_resolved)
@@ -14,10 +14,11 @@ def print_scan_ids(name, start_doc):
 RE.subscribe(print_scan_ids, 'start')
 
 
-from chxtools import attfuncs as att
-from chxtools import attfuncs2 as att2
-from chxtools import xfuncs as xf
-from chxtools.bpm_stability import bpm_read
-from chxtools import transfuncs as trans  
-from chxtools import bpm_stability as bpmst
+# chxtools is imported on first use (00-lazy-imports.py)
+att = lazy_import('chxtools.attfuncs')
+att2 = lazy_import('chxtools.attfuncs2')
+xf = lazy_import('chxtools.xfuncs')
+bpm_read = lazy_from('chxtools.bpm_stability', 'bpm_read')
+trans = lazy_import('chxtools.transfuncs')
+bpmst = lazy_import('chxtools.bpm_stability')
 
@@ -0,0 +1,154 @@
+"""
+Device creation and PV connection at profile startup.
+
+Devices made with make_device() are registered here so that their PVs can
+be waited on together, with one global timeout, by connect_devices(),
+which lists whatever did not connect instead of stalling on each device.
+
+Starting the profile with CHX_LAZY_DEVICES=1 in the environment makes
+make_device() return LazyDevice proxies instead: nothing is created or
+connected until the device is first used.
+"""
+import os
+import time
+
+LAZY_DEVICES = os.environ.get('CHX_LAZY_DEVICES', '0').lower() not in (
+    '', '0', 'no', 'false')
+# seconds connect_devices() waits, in total, for all the PVs
+STARTUP_CONNECT_TIMEOUT = float(os.environ.get('CHX_CONNECT_TIMEOUT', 5))
+
+_startup_devices = []
+
+
+class LazyDevice:
+    """
+    Stand-in for a device that is only created on first use.
+
+    Any attribute access (or isinstance check) creates the device with
+    cls(*args, **kwargs), runs setup(device) if given and forwards to it.
+    """
+    def __init__(self, cls, args, kwargs, setup=None):
+        object.__setattr__(self, '_lazy_spec', (cls, args, kwargs, setup))
+        object.__setattr__(self, '_lazy_device', None)
+
+    def _lazy_instance(self):
+        device = self._lazy_device
+        if device is None:
+            cls, args, kwargs, setup = self._lazy_spec
+            device = cls(*args, **kwargs)
+            if setup is not None:
+                setup(device)
+            object.__setattr__(self, '_lazy_device', device)
+        return device
+
+    @property
+    def instantiated(self):
+        return self._lazy_device is not None
+
+    @property
+    def __class__(self):
+        return type(self._lazy_instance())
+
+    def __getattr__(self, attr):
+        return getattr(self._lazy_instance(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._lazy_instance(), attr, value)
+
+    def __dir__(self):
+        return dir(self._lazy_instance())
+
+    def __eq__(self, other):
+        if isinstance(other, LazyDevice):
+            other = other._lazy_instance()
+        return self._lazy_instance() == other
+
+    def __hash__(self):
+        return hash(self._lazy_instance())
+
+    def __repr__(self):
+        if self._lazy_device is not None:
+            return repr(self._lazy_device)
+        cls, args, kwargs, setup = self._lazy_spec
+        return '<lazy {}({}) not created yet>'.format(
+            cls.__name__, ', '.join([repr(a) for a in args] +
+                                    ['{}={!r}'.format(k, v)
+                                     for k, v in kwargs.items()]))
+
+
+def make_device(cls, *args, setup=None, lazy=None, **kwargs):
+    """
+    Create cls(*args, **kwargs), register it for connect_devices() and run
+    setup(device) on it (read_attrs, stage_sigs, names ...).
+
+    In lazy mode (lazy=True, or LAZY_DEVICES by default) a LazyDevice is
+    returned instead, and creation and setup happen on first use.
+    """
+    if lazy is None:
+        lazy = LAZY_DEVICES
+    if lazy:
+        device = LazyDevice(cls, args, kwargs, setup)
+    else:
+        device = cls(*args, **kwargs)
+        if setup is not None:
+            setup(device)
+    _startup_devices.append(device)
+    return device
+
+
+def _device_signals(device):
+    # only the signals the device built: lazy components (the area detector
+    # plugins ...) are connected when they are first used
+    if hasattr(device, 'walk_signals'):
+        return [walk.item for walk in device.walk_signals(include_lazy=False)]
+    return [device]
+
+
+def _pv_names(signal):
+    names = [getattr(signal, 'pvname', None),
+             getattr(signal, 'setpoint_pvname', None)]
+    return sorted({name for name in names if name})
+
+
+def connect_devices(devices=None, timeout=None, verbose=True):
+    """
+    Wait, at most timeout seconds in total, for the PVs of devices (default:
+    all the devices made with make_device) to connect.
+
+    Every device is created first so that all the channel searches run at
+    the same time; unconnected devices do not hold up the others.
+    returns {device name: [PVs that did not connect]}
+    """
+    if devices is None:
+        devices = _startup_devices
+    if timeout is None:
+        timeout = STARTUP_CONNECT_TIMEOUT
+    t0 = time.monotonic()
+    pending = []
+    for device in devices:
+        if isinstance(device, LazyDevice):
+            device = device._lazy_instance()
+        pending.extend((device, signal) for signal in _device_signals(device))
+    # the channel searches all run in the background since the devices were
+    # created: wait on each signal with what is left of the global timeout
+    # (the startup timer, 0-startup-timing.py, charges these waits itself)
+    deadline = t0 + timeout
+    for device, signal in pending:
+        remaining = deadline - time.monotonic()
+        if remaining > 0 and not getattr(signal, 'connected', True):
+            try:
+                signal.wait_for_connection(timeout=remaining)
+            except Exception:   # TimeoutError, reported below
+                pass
+    pending = [(device, signal) for device, signal in pending
+               if not getattr(signal, 'connected', True)]
+
+    unconnected = {}
+    for device, signal in pending:
+        unconnected.setdefault(device.name, []).extend(_pv_names(signal))
+    if verbose:
+        print('Connected {} devices in {:.1f} s'.format(
+            len(devices) - len(unconnected), time.monotonic() - t0))
+        for name, pvs in sorted(unconnected.items()):
+            print('  {} did not connect: {}'.format(name, ', '.join(pvs)))
+    return unconnected
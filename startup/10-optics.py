@@ -68,6 +68,16 @@ class VirtualMotorSlits(Blades, VirtualMotorCenterAndGap):
     pass
 
 
+def _name_readbacks(slits):
+    """
+    Name the readbacks of virtual slits after their axes (e.g. gsl_xc), to
+    solve the "KeyError Problem" when doing dscan and trying to save to a
+    spec file, Y.G., 20170110
+    """
+    for axis in ['xc', 'yc', 'xg', 'yg']:
+        getattr(slits, axis).readback.name = '{}_{}'.format(slits.name, axis)
+
+
 class XYMotor(Device):
     x = Cpt(EpicsMotor, '-Ax:X}Mtr')
     y = Cpt(EpicsMotor, '-Ax:Y}Mtr')
@@ -222,23 +232,23 @@ class XBPM( Device):
    vt = Cpt( EpicsSignal, 'CtrlDAC:BLevel-SP' )
 xBPM =XBPM( 'XF:11IDB-BI{XBPM:02}', name = 'xBPM' )
 
-diff = Diffractometer('XF:11IDB-ES{Dif', name='diff')
+diff = make_device(Diffractometer, 'XF:11IDB-ES{Dif', name='diff')
 
 # sample beamstop
 #sambst = XYMotor('XF:11IDB-OP{BS:Samp', name='sambst')
 
-s1 = MotorCenterAndGap('XF:11IDB-OP{Slt:1', name='s1')
-k1 = Kinoform('XF:11IDB-OP{Lens:1', name='k1')  # upstream
-k2 = Kinoform('XF:11IDB-OP{Lens:2', name='k2')  # downstream
-gi = XYThetaMotor('XF:11IDB-OP{Mir:GI', name='gi')  # GI-mirror
-s2 = MotorCenterAndGap('XF:11IDB-OP{Slt:2', name='s2') #Beam-defining (large JJ) slits
-pbs = MotorSlits('XF:11IDA-OP{Slt:PB', name='pbs')  # pink beam slits
+s1 = make_device(MotorCenterAndGap, 'XF:11IDB-OP{Slt:1', name='s1')
+k1 = make_device(Kinoform, 'XF:11IDB-OP{Lens:1', name='k1')  # upstream
+k2 = make_device(Kinoform, 'XF:11IDB-OP{Lens:2', name='k2')  # downstream
+gi = make_device(XYThetaMotor, 'XF:11IDB-OP{Mir:GI', name='gi')  # GI-mirror
+s2 = make_device(MotorCenterAndGap, 'XF:11IDB-OP{Slt:2', name='s2') #Beam-defining (large JJ) slits
+pbs = make_device(MotorSlits, 'XF:11IDA-OP{Slt:PB', name='pbs')  # pink beam slits
 flt_y = EpicsMotor('XF:11IDA-OP{Flt:1-Ax:Y}Mtr', name='flt_y')  # filters
-dcm = DCM('XF:11IDA-OP{Mono:DCM', name='dcm') #, check position, e.g., by dcm.b.user_readback.value
-dmm = DMM('XF:11IDA-OP{Mono:DMM', name='dmm')
-mbs = VirtualMotorSlits('XF:11IDA-OP{Slt:MB', name='mbs')  # Mono-beam Slits, check position, e.g., by mbs.xc.readback.value
-tran= Transfocator('XF:11IDA-OP{Lens:', name='tran')    # Transfocator
-s4 = MotorCenterAndGap('XF:11IDB-ES{Slt:4', name='s4')  # temp guard slits
+dcm = make_device(DCM, 'XF:11IDA-OP{Mono:DCM', name='dcm') #, check position, e.g., by dcm.b.user_readback.value
+dmm = make_device(DMM, 'XF:11IDA-OP{Mono:DMM', name='dmm')
+mbs = make_device(VirtualMotorSlits, 'XF:11IDA-OP{Slt:MB', name='mbs', setup=_name_readbacks)  # Mono-beam Slits, check position, e.g., by mbs.xc.readback.value
+tran = make_device(Transfocator, 'XF:11IDA-OP{Lens:', name='tran')    # Transfocator
+s4 = make_device(MotorCenterAndGap, 'XF:11IDB-ES{Slt:4', name='s4')  # temp guard slits
 fsh_x=EpicsMotor('XF:11IDB-OP{FS:1-Ax:X}Mtr', name='fsh_x')  # fast shutter positioner: X
 fsh_y=EpicsMotor('XF:11IDB-OP{FS:1-Ax:Y}Mtr', name='fsh_y')  # fast shutter positioner: Y
 #smp =SmarPod('XF:11IDB-ES{SPod:1-',name='smp')    # SmarPod
@@ -267,38 +277,17 @@ SAXS_x2 = EpicsMotor('XF:11IDB-ES{Tbl:SAXS-Ax:X2}Mtr',name='SAXS_x2')
 
 
 # Note inconsistency in capitalization of Bpm/BPM below.
-bpm1 = XYMotor('XF:11IDA-BI{Bpm:1', name='bpm1')
-bpm2 = XYMotor('XF:11IDB-BI{BPM:2', name='bpm2')
+bpm1 = make_device(XYMotor, 'XF:11IDA-BI{Bpm:1', name='bpm1')
+bpm2 = make_device(XYMotor, 'XF:11IDB-BI{BPM:2', name='bpm2')
 
-w1 = XYMotor('XF:11IDB-OP{Win:1', name='w1')  # window positioners
-hdm = HorizontalDiffractionMirror('XF:11IDA-OP{Mir:HDM', name='hdm')
-gsl = VirtualMotorCenterAndGap('XF:11IDB-OP{Slt:Guard', name='gsl')  #Guard rSlits (SmarAct)
+w1 = make_device(XYMotor, 'XF:11IDB-OP{Win:1', name='w1')  # window positioners
+hdm = make_device(HorizontalDiffractionMirror, 'XF:11IDA-OP{Mir:HDM', name='hdm')
+gsl = make_device(VirtualMotorCenterAndGap, 'XF:11IDB-OP{Slt:Guard', name='gsl', setup=_name_readbacks)  #Guard rSlits (SmarAct)
 #gsl = VirtualMotorSlits('XF:11IDB-OP{Slt:Guard', name='gsl')  #Guard rSlits (SmarAct)
 
 
 
 #SAXS beam stop
-saxs_bst = SAXSBeamStop( 'XF:11IDB-ES{BS:SAXS', name = 'saxs_bst' )
+saxs_bst = make_device(SAXSBeamStop, 'XF:11IDB-ES{BS:SAXS', name='saxs_bst')
  
-#To solve the "KeyError Problem" when doing dscan and trying to save to a spec file, Y.G., 20170110
-gsl.xc.readback.name = 'gsl_xc'
-gsl.yc.readback.name = 'gsl_yc'
-gsl.xg.readback.name = 'gsl_xg'
-gsl.yg.readback.name = 'gsl_yg'
-
-mbs.xc.readback.name = 'mbs_xc'
-mbs.yc.readback.name = 'mbs_yc'
-mbs.xg.readback.name = 'mbs_xg'
-mbs.yg.readback.name = 'mbs_yg'
-
-fe = VirtualMotorCenterAndGap('FE:C11A-OP{Slt:12', name='fe') # Front End Slits (Primary Slits)
-
-fe.xc.readback.name = 'fe_xc'
-fe.yc.readback.name = 'fe_yc'
-fe.xg.readback.name = 'fe_xg'
-fe.yg.readback.name = 'fe_yg'
-
-
-
-
-
+fe = make_device(VirtualMotorCenterAndGap, 'FE:C11A-OP{Slt:12', name='fe', setup=_name_readbacks) # Front End Slits (Primary Slits)
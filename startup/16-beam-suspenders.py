@@ -0,0 +1,241 @@
+"""
+Beam availability: storage ring mode, ID beam enable, ring current and
+cryo-cooler refill.
+
+install_beam_suspenders(), called with the default BEAM_THRESHOLDS at
+the end of this file (remove_beam_suspenders() to opt out), adds
+RunEngine suspenders on these monitored PVs: a plan pauses on the monitor update that reports a beam loss (or a
+refill) and resumes, after a settle time, as soon as the conditions hold
+again. beam_availability keeps the time of the last loss and recovery;
+it is added to the baseline, so every run records them, and every
+transition is kept in beam_availability.history.
+
+check_ring / wait_for_ring / check_cryo (30-user.py) use the same
+monitored signals and thresholds.
+"""
+import threading
+import time
+
+from ophyd import Device, EpicsSignalRO, Signal
+from ophyd import Component as Cpt
+from bluesky.suspenders import (SuspenderBase, SuspendBoolLow, SuspendCeil,
+                                SuspendFloor)
+
+BEAM_THRESHOLDS = {
+    'ring_mode': 'Operations',   # SR mode required
+    'ring_current': 180.,        # [mA] suspend below
+    'ring_current_resume': 180.,  # [mA] resume above
+    'ring_settle': 60.,          # [s] wait after the beam is back
+    'cryo_refill_valve': 10.,    # [%] refill valve open: refill in progress
+    'cryo_settle': 60.,          # [s] wait after the refill
+}
+
+ring_mode = make_device(EpicsSignalRO, 'SR-OPS{}Mode-Sts', string=True,
+                        auto_monitor=True, name='ring_mode')
+id_beam_enabled = make_device(EpicsSignalRO,
+                              'SR:C11-EPS{PLC:1}Sts:ID_BE_Enbl-Sts',
+                              auto_monitor=True, name='id_beam_enabled')
+ring_current = make_device(EpicsSignalRO, 'SR:C03-BI{DCCT:1}I:Real-I',
+                           auto_monitor=True, name='ring_current')
+cryo_level = make_device(EpicsSignalRO, 'XF:11IDA-UT{Cryo:1}L:19-I',
+                         auto_monitor=True, name='cryo_level')
+cryo_refill_valve = make_device(EpicsSignalRO,
+                                'XF:11IDA-UT{Cryo:1-IV:19}Pos-I',
+                                auto_monitor=True, name='cryo_refill_valve')
+
+
+class SuspendUnlessEqual(SuspenderBase):
+    "Suspend while the signal is not equal to expected (e.g. the SR mode)."
+    def __init__(self, signal, expected, **kwargs):
+        self._expected = expected
+        super().__init__(signal, **kwargs)
+
+    def _should_suspend(self, value):
+        return value != self._expected
+
+    def _should_resume(self, value):
+        return value == self._expected
+
+    def _get_justification(self):
+        if not self.tripped:
+            return ''
+        return 'Signal {} = {!r}, waiting for {!r}'.format(
+            self._sig.name, self._sig.get(), self._expected)
+
+
+def beam_conditions(cryo=True, ring=True):
+    """
+    {condition: ok} from the monitored values and BEAM_THRESHOLDS
+    (ring: SR mode, ID and current, cryo: the cryo-cooler refill)
+    """
+    conditions = {}
+    if ring:
+        conditions.update(
+            ring_mode=ring_mode.get() == BEAM_THRESHOLDS['ring_mode'],
+            id_beam_enabled=id_beam_enabled.get() == 1,
+            ring_current=ring_current.get() > BEAM_THRESHOLDS['ring_current'])
+    if cryo:
+        conditions['cryo_refill'] = (cryo_refill_valve.get() <
+                                     BEAM_THRESHOLDS['cryo_refill_valve'])
+    return conditions
+
+
+class BeamAvailability(Device):
+    """
+    Times (epoch seconds) of the last beam loss and recovery, for the
+    baseline of the runs; history lists every (lost, back, reason).
+    """
+    losses = Cpt(Signal, value=0)
+    last_lost = Cpt(Signal, value=0.)
+    last_back = Cpt(Signal, value=0.)
+    last_reason = Cpt(Signal, value='')
+    lost_seconds = Cpt(Signal, value=0.)   # total since the recording started
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.history = []
+        self.cryo = True
+        self._subscriptions = []
+
+    @property
+    def available(self):
+        return not self.history or self.history[-1][1] is not None
+
+    def start_recording(self, cryo=True):
+        self.cryo = cryo
+        if self._subscriptions:
+            return
+        for signal in (ring_mode, id_beam_enabled, ring_current,
+                       cryo_refill_valve):
+            self._subscriptions.append(
+                (signal, signal.subscribe(self._update, run=False)))
+
+    def stop_recording(self):
+        for signal, cid in self._subscriptions:
+            signal.unsubscribe(cid)
+        self._subscriptions = []
+
+    def _update(self, timestamp=None, **kwargs):
+        try:
+            failed = [name for name, ok in beam_conditions(self.cryo).items()
+                      if not ok]
+        except Exception:   # not connected (yet)
+            return
+        now = timestamp or time.time()
+        if failed and self.available:
+            self.history.append([now, None, ', '.join(failed)])
+            self.losses.put(self.losses.get() + 1)
+            self.last_lost.put(now)
+            self.last_reason.put(', '.join(failed))
+            print('{}  beam not available: {}'.format(time.ctime(now),
+                                                      ', '.join(failed)))
+        elif not failed and not self.available:
+            self.history[-1][1] = now
+            self.last_back.put(now)
+            self.lost_seconds.put(self.lost_seconds.get() +
+                                  now - self.history[-1][0])
+            print('{}  beam back'.format(time.ctime(now)))
+
+
+beam_availability = BeamAvailability(name='beam_availability')
+_beam_suspenders = []
+
+
+def install_beam_suspenders(cryo=True, **thresholds):
+    """
+    Pause the RunEngine while the beam is not available (see
+    BEAM_THRESHOLDS, which keyword arguments update, e.g.
+    install_beam_suspenders(ring_current=100, ring_settle=120)) and record
+    the losses in the baseline (beam_availability).
+    cryo: also pause during cryo-cooler refills
+    """
+    unknown = set(thresholds) - set(BEAM_THRESHOLDS)
+    if unknown:
+        raise ValueError('unknown thresholds: ' + ', '.join(sorted(unknown)))
+    remove_beam_suspenders()
+    BEAM_THRESHOLDS.update(thresholds)
+    settle = BEAM_THRESHOLDS['ring_settle']
+    message = 'no beam in the SR ring / ID'
+    _beam_suspenders.extend([
+        SuspendUnlessEqual(ring_mode, BEAM_THRESHOLDS['ring_mode'],
+                           sleep=settle, tripped_message=message),
+        SuspendBoolLow(id_beam_enabled, sleep=settle,
+                       tripped_message=message),
+        SuspendFloor(ring_current, BEAM_THRESHOLDS['ring_current'],
+                     resume_thresh=BEAM_THRESHOLDS['ring_current_resume'],
+                     sleep=settle, tripped_message=message)])
+    if cryo:
+        _beam_suspenders.append(
+            SuspendCeil(cryo_refill_valve,
+                        BEAM_THRESHOLDS['cryo_refill_valve'],
+                        sleep=BEAM_THRESHOLDS['cryo_settle'],
+                        tripped_message='cryo-cooler refill in progress'))
+    for suspender in _beam_suspenders:
+        RE.install_suspender(suspender)
+    beam_availability.start_recording(cryo)
+    if beam_availability not in sd.baseline:
+        sd.baseline.append(beam_availability)
+
+
+def remove_beam_suspenders():
+    "Undo install_beam_suspenders."
+    for suspender in _beam_suspenders:
+        RE.remove_suspender(suspender)
+    del _beam_suspenders[:]
+    beam_availability.stop_recording()
+    if beam_availability in sd.baseline:
+        sd.baseline.remove(beam_availability)
+
+
+def wait_for_signal(signal, condition, timeout=None):
+    """
+    Block until condition(value) holds for the monitored signal, re-checked
+    on every monitor update. returns True, or False on timeout
+    """
+    update = threading.Event()
+    cid = signal.subscribe(lambda **kwargs: update.set(), run=False)
+    deadline = None if timeout is None else time.monotonic() + timeout
+    try:
+        while not condition(signal.get()):
+            now = time.monotonic()
+            if deadline is not None and now > deadline:
+                return False
+            update.clear()
+            update.wait(1. if deadline is None else min(1., deadline - now))
+        return True
+    finally:
+        signal.unsubscribe(cid)
+
+
+def wait_for_beam(cryo=False, ring=True, timeout=None, poll=60.,
+                  message=None):
+    """
+    Block until beam_conditions(cryo, ring) are all ok, re-checked on every
+    monitor update of the PVs; message(conditions) is called every poll
+    seconds meanwhile. returns True, or False on timeout
+    """
+    update = threading.Event()
+    signals = [ring_mode, id_beam_enabled, ring_current, cryo_refill_valve]
+    cids = [signal.subscribe(lambda **kwargs: update.set(), run=False)
+            for signal in signals]
+    deadline = None if timeout is None else time.monotonic() + timeout
+    last_message = time.monotonic()
+    try:
+        while True:
+            conditions = beam_conditions(cryo, ring)
+            if all(conditions.values()):
+                return True
+            now = time.monotonic()
+            if deadline is not None and now > deadline:
+                return False
+            if message is not None and now - last_message >= poll:
+                message(conditions)
+                last_message = now
+            update.clear()
+            update.wait(min(1., poll))
+    finally:
+        for signal, cid in zip(signals, cids):
+            signal.unsubscribe(cid)
+
+
+install_beam_suspenders()
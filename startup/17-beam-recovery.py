@@ -0,0 +1,149 @@
+"""
+Small event-driven state machine for the beamline checks and the beam
+recovery (check_bl / check_recover in 30-user.py).
+
+Each RecoveryStep does its action, then waits for its condition, which
+is re-evaluated on every monitor update of the step's signals, for at
+most its timeout, and moves on to its `success` or `failure` step. Steps
+without a next step end the sequence. Every transition is printed with
+its timing and kept: last_recovery() returns the last sequence and
+recovery_report() prints it.
+"""
+import threading
+import time
+from datetime import datetime
+
+RECOVERY_HISTORY_LENGTH = 20
+
+_recovery_history = []
+
+
+class RecoveryStep:
+    """
+    name: state name
+    action: callable run when entering the state
+    condition: callable -> True when the state succeeded (None: succeeds
+        right after the action)
+    signals: signals whose monitor updates re-evaluate condition (create
+        them with auto_monitor=True, otherwise condition is only
+        re-checked every second)
+    timeout: [s] max. time to wait for condition (None: no limit, 0:
+        checked once)
+    hold: [s] condition has to stay true for hold seconds
+    success, failure: name of the next state (None: end)
+    """
+    def __init__(self, name, action=None, condition=None, signals=(),
+                 timeout=10., hold=0., success=None, failure=None):
+        self.name = name
+        self.action = action
+        self.condition = condition
+        self.signals = list(signals)
+        self.timeout = timeout
+        self.hold = hold
+        self.success = success
+        self.failure = failure
+
+    def wait(self):
+        "Wait for the condition; returns True if it was met in time."
+        if self.condition is None:
+            return True
+        update = threading.Event()
+        subscriptions = [(signal, signal.subscribe(
+            lambda **kwargs: update.set(), run=False))
+            for signal in self.signals]
+        start = time.monotonic()
+        true_since = None
+        try:
+            while True:
+                now = time.monotonic()
+                if self.condition():
+                    true_since = now if true_since is None else true_since
+                    if now - true_since >= self.hold:
+                        return True
+                else:
+                    true_since = None
+                if self.timeout is not None and now - start >= self.timeout:
+                    return False
+                wait = 0.2 if true_since is not None else 1.
+                if self.timeout is not None:
+                    wait = min(wait, start + self.timeout - now)
+                update.clear()
+                update.wait(wait)
+        finally:
+            for signal, cid in subscriptions:
+                signal.unsubscribe(cid)
+
+
+class RecoveryLog:
+    "Transitions of one run of a state machine."
+    def __init__(self, name):
+        self.name = name
+        self.started = datetime.now().isoformat(timespec='seconds')
+        self.t0 = time.monotonic()
+        self.transitions = []   # [state, start, duration, outcome]
+        self.final = None
+        self.total = None
+
+    def enter(self, state):
+        self.transitions.append([state, time.monotonic() - self.t0, None,
+                                 None])
+
+    def leave(self, outcome, following=None):
+        transition = self.transitions[-1]
+        transition[2] = time.monotonic() - self.t0 - transition[1]
+        transition[3] = outcome
+        print('{}  {}: {} {} after {:.1f} s{}'.format(
+            time.strftime('%H:%M:%S'), self.name, transition[0], outcome,
+            transition[2], '' if following is None else ' -> ' + following))
+
+    def end(self, state):
+        self.final = state
+        self.total = time.monotonic() - self.t0
+        _recovery_history.append(self)
+        del _recovery_history[:-RECOVERY_HISTORY_LENGTH]
+
+    def report(self):
+        print('{} started {}, ended in {!r} after {:.1f} s'.format(
+            self.name, self.started, self.final, self.total or 0.))
+        for state, start, duration, outcome in self.transitions:
+            print('  {:>8.1f} s  {:>8.1f} s  {:<28} {}'.format(
+                start, duration or 0., state, outcome or ''))
+
+
+def run_recovery(steps, start, name='recovery'):
+    """
+    Run the state machine made of steps (list of RecoveryStep) from the
+    step named start. returns the RecoveryLog; its `final` attribute is
+    the name of the last step
+    """
+    steps = {step.name: step for step in steps}
+    log = RecoveryLog(name)
+    state = start
+    while True:
+        step = steps[state]
+        log.enter(state)
+        try:
+            if step.action is not None:
+                step.action()
+            ok = step.wait()
+        except BaseException:
+            log.leave('error')
+            log.end(state)
+            raise
+        following = step.success if ok else step.failure
+        log.leave('ok' if ok else 'timed out', following)
+        if following is None:
+            log.end(state)
+            return log
+        state = following
+
+
+def last_recovery():
+    "RecoveryLog of the last check / recovery sequence."
+    return _recovery_history[-1] if _recovery_history else None
+
+
+def recovery_report(last=1):
+    "Print the transitions and timings of the last `last` sequences."
+    for log in _recovery_history[-last:]:
+        log.report()
@@ -191,28 +191,7 @@ class EigerFastTrigger(EigerBase):
 # test_trig4M = FastShutterTrigger('XF:11IDB-ES{Trigger:Eig4M}', name='test_trig4M')
 
 
-## This renaming should be reversed: no correspondance between CSS screens, PV names and ophyd....
-xray_eye1 = StandardProsilica('XF:11IDA-BI{Bpm:1-Cam:1}', name='xray_eye1')
-xray_eye2 = StandardProsilica('XF:11IDB-BI{Mon:1-Cam:1}', name='xray_eye2')
-xray_eye3 = StandardProsilica('XF:11IDB-BI{Cam:08}', name='xray_eye3')
-xray_eye4 = StandardProsilica('XF:11IDB-BI{Cam:09}', name='xray_eye4')
-xray_eye1_writing = StandardProsilicaWithTIFF('XF:11IDA-BI{Bpm:1-Cam:1}', name='xray_eye1')
-xray_eye2_writing = StandardProsilicaWithTIFF('XF:11IDB-BI{Mon:1-Cam:1}', name='xray_eye2')
-xray_eye3_writing = StandardProsilicaWithTIFF('XF:11IDB-BI{Cam:08}', name='xray_eye3')
-xray_eye4_writing = StandardProsilicaWithTIFF('XF:11IDB-BI{Cam:09}', name='xray_eye4')
-fs1 = StandardProsilica('XF:11IDA-BI{FS:1-Cam:1}', name='fs1')
-fs2 = StandardProsilica('XF:11IDA-BI{FS:2-Cam:1}', name='fs2')
-fs_wbs = StandardProsilica('XF:11IDA-BI{BS:WB-Cam:1}', name='fs_wbs')
-# dcm_cam = StandardProsilica('XF:11IDA-BI{Mono:DCM-Cam:1}', name='dcm_cam')
-fs_pbs = StandardProsilica('XF:11IDA-BI{BS:PB-Cam:1}', name='fs_pbs')
-# elm = Elm('XF:11IDA-BI{AH401B}AH401B:',)
-
-all_standard_pros = [xray_eye1, xray_eye2, xray_eye3, xray_eye4,
-                     xray_eye1_writing, xray_eye2_writing,
-                     xray_eye3_writing, xray_eye4_writing, fs1, fs2,
-                     fs_wbs, fs_pbs]
-#                     xray_eye3_writing, fs1, fs2, dcm_cam, fs_wbs, fs_pbs]
-for camera in all_standard_pros:
+def set_prosilica_defaults(camera):
     camera.read_attrs = ['stats1', 'stats2', 'stats3', 'stats4', 'stats5']
     # camera.tiff.read_attrs = []  # leaving just the 'image'
     for stats_name in ['stats1', 'stats2', 'stats3', 'stats4', 'stats5']:
@@ -224,12 +203,38 @@ for camera in all_standard_pros:
     camera.stage_sigs[camera.trans1.blocking_callbacks] = 1
     camera.stage_sigs[camera.cam.trigger_mode] = 'Fixed Rate'
 
-for camera in [xray_eye1_writing, xray_eye2_writing,
-               xray_eye3_writing, xray_eye4_writing]:
+
+def set_prosilica_tiff_defaults(camera):
+    set_prosilica_defaults(camera)
     camera.read_attrs.append('tiff')
     camera.tiff.read_attrs = []
 
 
+# Devices are made with make_device (05-device-startup.py): created now, or
+# on first use when the profile is started with CHX_LAZY_DEVICES=1.
+## This renaming should be reversed: no correspondance between CSS screens, PV names and ophyd....
+xray_eye1 = make_device(StandardProsilica, 'XF:11IDA-BI{Bpm:1-Cam:1}', name='xray_eye1', setup=set_prosilica_defaults)
+xray_eye2 = make_device(StandardProsilica, 'XF:11IDB-BI{Mon:1-Cam:1}', name='xray_eye2', setup=set_prosilica_defaults)
+xray_eye3 = make_device(StandardProsilica, 'XF:11IDB-BI{Cam:08}', name='xray_eye3', setup=set_prosilica_defaults)
+xray_eye4 = make_device(StandardProsilica, 'XF:11IDB-BI{Cam:09}', name='xray_eye4', setup=set_prosilica_defaults)
+xray_eye1_writing = make_device(StandardProsilicaWithTIFF, 'XF:11IDA-BI{Bpm:1-Cam:1}', name='xray_eye1', setup=set_prosilica_tiff_defaults)
+xray_eye2_writing = make_device(StandardProsilicaWithTIFF, 'XF:11IDB-BI{Mon:1-Cam:1}', name='xray_eye2', setup=set_prosilica_tiff_defaults)
+xray_eye3_writing = make_device(StandardProsilicaWithTIFF, 'XF:11IDB-BI{Cam:08}', name='xray_eye3', setup=set_prosilica_tiff_defaults)
+xray_eye4_writing = make_device(StandardProsilicaWithTIFF, 'XF:11IDB-BI{Cam:09}', name='xray_eye4', setup=set_prosilica_tiff_defaults)
+fs1 = make_device(StandardProsilica, 'XF:11IDA-BI{FS:1-Cam:1}', name='fs1', setup=set_prosilica_defaults)
+fs2 = make_device(StandardProsilica, 'XF:11IDA-BI{FS:2-Cam:1}', name='fs2', setup=set_prosilica_defaults)
+fs_wbs = make_device(StandardProsilica, 'XF:11IDA-BI{BS:WB-Cam:1}', name='fs_wbs', setup=set_prosilica_defaults)
+# dcm_cam = StandardProsilica('XF:11IDA-BI{Mono:DCM-Cam:1}', name='dcm_cam')
+fs_pbs = make_device(StandardProsilica, 'XF:11IDA-BI{BS:PB-Cam:1}', name='fs_pbs', setup=set_prosilica_defaults)
+# elm = Elm('XF:11IDA-BI{AH401B}AH401B:',)
+
+all_standard_pros = [xray_eye1, xray_eye2, xray_eye3, xray_eye4,
+                     xray_eye1_writing, xray_eye2_writing,
+                     xray_eye3_writing, xray_eye4_writing, fs1, fs2,
+                     fs_wbs, fs_pbs]
+#                     xray_eye3_writing, fs1, fs2, dcm_cam, fs_wbs, fs_pbs]
+
+
 def set_eiger_defaults(eiger):
     """Choose which attributes to read per-step (read_attrs) or
     per-run (configuration attrs)."""
@@ -253,22 +258,22 @@ def set_eiger_defaults(eiger):
 # set_eiger_defaults(eiger500K_single)
 
 # Eiger 1M using internal trigger
-eiger1m_single = EigerSingleTrigger('XF:11IDB-ES{Det:Eig1M}',
-                                    name='eiger1m_single')
-set_eiger_defaults(eiger1m_single)
+eiger1m_single = make_device(EigerSingleTrigger, 'XF:11IDB-ES{Det:Eig1M}',
+                             name='eiger1m_single',
+                             setup=set_eiger_defaults)
 
 # Eiger 4M using internal trigger
-eiger4m_single = EigerSingleTrigger('XF:11IDB-ES{Det:Eig4M}',
-                                    name='eiger4m_single')
-set_eiger_defaults(eiger4m_single)
+eiger4m_single = make_device(EigerSingleTrigger, 'XF:11IDB-ES{Det:Eig4M}',
+                             name='eiger4m_single',
+                             setup=set_eiger_defaults)
 
 # Eiger 1M using fast trigger assembly
-eiger1m = EigerFastTrigger('XF:11IDB-ES{Det:Eig1M}', name='eiger1m')
-set_eiger_defaults(eiger1m)
+eiger1m = make_device(EigerFastTrigger, 'XF:11IDB-ES{Det:Eig1M}', name='eiger1m',
+                      setup=set_eiger_defaults)
 
 # Eiger 4M using fast trigger assembly
-eiger4m = EigerFastTrigger('XF:11IDB-ES{Det:Eig4M}', name='eiger4m')
-set_eiger_defaults(eiger4m)
+eiger4m = make_device(EigerFastTrigger, 'XF:11IDB-ES{Det:Eig4M}', name='eiger4m',
+                      setup=set_eiger_defaults)
 
 
 def manual_count(det=eiger4m_single):
@@ -285,6 +290,13 @@ def manual_count(det=eiger4m_single):
             yield from unstage(det)
 
 
+# Wait for the PVs of all the devices so far together, with one global
+# timeout, and list those that did not connect. Lazy devices connect on
+# first use instead.
+if not LAZY_DEVICES:
+    connect_devices()
+
+
 # Comment this out to suppress deluge of logging messages.
 # import logging
 # logging.basicConfig(level=logging.DEBUG)
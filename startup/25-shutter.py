@@ -22,9 +22,9 @@ class FourPVShutter(Device):
 
 class FourPVShutter(Device):
     open_command = Cpt(EpicsSignal, 'Cmd:Opn-Cmd')
-    open_status = Cpt(EpicsSignal, 'Cmd:Opn-Sts')
+    open_status = Cpt(EpicsSignal, 'Cmd:Opn-Sts', auto_monitor=True)
     close_command = Cpt(EpicsSignal, 'Cmd:Cls-Cmd')
-    close_status = Cpt(EpicsSignal, 'Cmd:Cls-Sts')
+    close_status = Cpt(EpicsSignal, 'Cmd:Cls-Sts', auto_monitor=True)
 
     def open(self):
         self.open_command.put(1)
@@ -54,6 +54,6 @@ class TwoPVShutter(EpicsSignal):
 
 fast_sh = TwoPVShutter('XF:11IDB-ES{Zebra}:OUT1_TTL:STA',
                        write_pv='XF:11IDB-ES{Zebra}:SOFT_IN:B0',
-                       name='fast_sh')
+                       auto_monitor=True, name='fast_sh')
 
 
@@ -0,0 +1,417 @@
+"""
+Monitored Lakeshore temperatures for wait_temperature & co (30-user.py).
+
+temperature_monitor subscribes to the channel A-D temperatures and to the
+setpoint, control channel and ramp of both outputs, and keeps the recent
+temperatures of each channel in a fixed-size ring buffer. The rolling
+mean, the gradient and the time spent inside a deadband around the
+setpoint are updated with every monitor update, so waiting for a stable
+temperature ends on the update that meets the criterion instead of at
+the next polling period. The monitors are started on first use.
+
+temperature_monitor.predict() (or temperature_eta()) fits the recent
+trajectory with a ramp plus an exponential approach and forecasts when
+the temperature reaches, and is stable within, the deadband, e.g. to
+schedule the next series.
+"""
+import functools
+import threading
+import time
+
+import numpy as np
+from epics import PV
+
+TEMPERATURE_CHANNEL_PVS = {ch: 'XF:11IDB-ES{Env:01-Chan:' + ch + '}T:C-I'
+                           for ch in 'ABCD'}
+TEMPERATURE_OUTPUT_PVS = {
+    output: {'setpoint': 'XF:11IDB-ES{Env:01-Out:%d}T-SP' % output,    # K
+             'control': 'XF:11IDB-ES{Env:01-Out:%d}Out-Sel' % output,  # 1-4: A-D
+             'ramp': 'XF:11IDB-ES{Env:01-Out:%d}Val:Ramp-RB' % output,  # deg.C/min
+             'ramp_on': 'XF:11IDB-ES{Env:01-Out:%d}Enbl:Ramp-Sel' % output}
+    for output in (1, 2)}
+# samples kept per channel (the Lakeshore updates about once per second)
+TEMPERATURE_HISTORY_SIZE = 1200
+
+
+class TemperatureHistory:
+    """
+    Ring buffer of (time, temperature) with running sums, for the mean
+    and the least-squares gradient of the buffered samples.
+    """
+    def __init__(self, size=TEMPERATURE_HISTORY_SIZE):
+        self.t = np.zeros(size)
+        self.v = np.zeros(size)
+        self.n = 0
+        self.i = 0
+        self.t0 = None
+        self._sums = np.zeros(5)   # t, v, t*t, t*v, count
+
+    def append(self, t, v):
+        if self.t0 is None:
+            self.t0 = t
+        t = t - self.t0
+        if self.n == len(self.t):
+            old_t, old_v = self.t[self.i], self.v[self.i]
+            self._sums -= (old_t, old_v, old_t*old_t, old_t*old_v, 1)
+        else:
+            self.n += 1
+        self.t[self.i], self.v[self.i] = t, v
+        self._sums += (t, v, t*t, t*v, 1)
+        self.i = (self.i + 1) % len(self.t)
+        if self.i == 0:   # keep the rounding errors from adding up
+            t, v = self.t[:self.n], self.v[:self.n]
+            self._sums = np.array([t.sum(), v.sum(), (t*t).sum(),
+                                   (t*v).sum(), self.n])
+
+    def __len__(self):
+        return self.n
+
+    def last(self):
+        "(time, temperature) of the latest sample, or None"
+        if not self.n:
+            return None
+        j = (self.i - 1) % len(self.t)
+        return self.t[j] + self.t0, self.v[j]
+
+    def span(self):
+        "seconds covered by the buffer"
+        if self.n < 2:
+            return 0.
+        first = self.i % self.n if self.n == len(self.t) else 0
+        return self.last()[0] - self.t0 - self.t[first]
+
+    def mean(self):
+        return self._sums[1] / self.n if self.n else np.nan
+
+    def gradient(self):
+        "least-squares slope of the buffered samples, in deg.C/min"
+        st, sv, stt, stv, n = self._sums
+        denom = n * stt - st * st
+        if n < 2 or denom <= 0:
+            return np.nan
+        return 60. * (n * stv - st * sv) / denom
+
+    def values(self):
+        "(times, temperatures) in time order"
+        order = np.roll(np.arange(self.n), -self.i) if self.n == len(
+            self.t) else np.arange(self.n)
+        return self.t[order] + self.t0, self.v[order]
+
+
+# time constants tried by fit_temperature_trajectory [s]
+TEMPERATURE_TAU_GRID = np.geomspace(5., 7200., 60)
+# seconds of history fitted by TemperatureMonitor.predict
+TEMPERATURE_FIT_WINDOW = 900.
+
+
+def fit_temperature_trajectory(t, T, ramp=True, taus=TEMPERATURE_TAU_GRID):
+    """
+    Least-squares fit of T = a + r*(t-t[-1]) + b*exp(-(t-t[-1])/tau),
+    i.e. an exponential approach to a (or to a ramp of rate r). The model
+    is linear in a, r, b for a given tau, so tau is scanned over taus.
+    ramp=False fixes r=0.
+    returns dict with asymptote (a), rate (r, deg.C/s), amplitude (b: the
+    distance to the asymptote at t[-1]), tau and rms, or None if there
+    are too few samples
+    """
+    t = np.asarray(t, dtype=float)
+    T = np.asarray(T, dtype=float)
+    if len(t) < 8 or t[-1] - t[0] < 10.:
+        return None
+    t = t - t[-1]
+    best = None
+    for tau in taus:
+        columns = [np.ones_like(t), np.exp(-t / tau)]
+        if ramp:
+            columns.append(t)
+        A = np.column_stack(columns)
+        coef = np.linalg.lstsq(A, T, rcond=None)[0]
+        rms = np.sqrt(np.mean((A.dot(coef) - T) ** 2))
+        if best is None or rms < best['rms']:
+            best = {'asymptote': float(coef[0]), 'amplitude': float(coef[1]),
+                    'rate': float(coef[2]) if ramp else 0.,
+                    'tau': float(tau), 'rms': float(rms)}
+    return best
+
+
+class TemperatureMonitor:
+    """
+    Monitors of the Lakeshore temperatures and outputs.
+
+    status(output, dead_band) summarises the control channel of an output;
+    wait_stable() blocks until its temperature has been within dead_band of
+    the setpoint for a given time.
+    """
+    def __init__(self, channels=TEMPERATURE_CHANNEL_PVS,
+                 outputs=TEMPERATURE_OUTPUT_PVS,
+                 size=TEMPERATURE_HISTORY_SIZE):
+        self.channel_pvs = dict(channels)
+        self.output_pvs = {output: dict(pvs) for output, pvs in outputs.items()}
+        self.history = {ch: TemperatureHistory(size) for ch in channels}
+        self.outputs = {output: {} for output in outputs}
+        self._bands = {}     # (output, dead_band): time entered the band
+        self._changed = {}   # output: time of the last setpoint change
+        self._pvs = []
+        self._update = threading.Condition()
+
+    @property
+    def running(self):
+        return bool(self._pvs)
+
+    def start(self, timeout=5.):
+        "Subscribe to the PVs and wait (at most timeout) for their values."
+        if self.running:
+            return
+        for ch, pvname in self.channel_pvs.items():
+            self._pvs.append(PV(pvname, auto_monitor=True, callback=(
+                functools.partial(self._on_temperature, ch))))
+        for output, pvs in self.output_pvs.items():
+            for key, pvname in pvs.items():
+                self._pvs.append(PV(pvname, auto_monitor=True, callback=(
+                    functools.partial(self._on_output, output, key))))
+        deadline = time.monotonic() + timeout
+        for pv in self._pvs:
+            pv.wait_for_connection(max(deadline - time.monotonic(), .01))
+        with self._update:
+            self._update.wait_for(self._complete,
+                                  max(deadline - time.monotonic(), 0))
+
+    def stop(self):
+        for pv in self._pvs:
+            pv.clear_callbacks()
+            pv.disconnect()
+        self._pvs = []
+
+    def _complete(self):
+        return (all(len(h) for h in self.history.values()) and
+                all(len(o) == len(self.output_pvs[n])
+                    for n, o in self.outputs.items()))
+
+    # Samples are stamped with their local arrival time, not the IOC
+    # timestamp: in_band_for and predict compare them with time.time(), and
+    # the clocks of the IOC and of this machine need not agree.
+    def _on_temperature(self, ch, value=None, **kwargs):
+        t = time.time()
+        with self._update:
+            self.history[ch].append(t, value)
+            for output, band in list(self._bands):
+                if self._known(output) and self.control(output) == ch:
+                    self._update_band(output, band, t, value)
+            self._update.notify_all()
+
+    def _on_output(self, output, key, value=None, **kwargs):
+        with self._update:
+            previous = self.outputs[output].get(key)
+            self.outputs[output][key] = value
+            if key in ('setpoint', 'control') and previous != value:
+                self._changed[output] = time.time()
+                for band_output, band in self._bands:
+                    if band_output == output:
+                        self._bands[output, band] = None
+            self._update.notify_all()
+
+    def _known(self, output):
+        return all(key in self.outputs[output] for key in ('setpoint',
+                                                           'control'))
+
+    def _check_output(self, output):
+        if output not in self.output_pvs:
+            raise ValueError('unknown output {!r}'.format(output))
+        missing = set(self.output_pvs[output]) - set(self.outputs[output])
+        if missing:
+            raise RuntimeError('no value yet from output {} PVs: {} (not '
+                               'connected?)'.format(output, ', '.join(
+                                   self.output_pvs[output][key]
+                                   for key in sorted(missing))))
+
+    def _update_band(self, output, band, t, value):
+        if abs(value - self.setpoint(output)) > band:
+            self._bands[output, band] = None
+        elif self._bands[output, band] is None:
+            self._bands[output, band] = t
+
+    def control(self, output=1):
+        "control channel ('A'-'D') of output"
+        self._check_output(output)
+        return 'ABCD'[int(self.outputs[output]['control']) - 1]
+
+    def setpoint(self, output=1):
+        "setpoint of output [deg.C]"
+        self._check_output(output)
+        return self.outputs[output]['setpoint'] - 273.15
+
+    def temperature(self, channel='C'):
+        last = self.history[channel].last()
+        return np.nan if last is None else last[1]
+
+    def in_band_for(self, output=1, dead_band=1.):
+        """
+        seconds the control channel of output has been within dead_band of
+        the setpoint (0 if outside)
+        """
+        key = output, dead_band
+        with self._update:
+            if key not in self._bands:
+                # start from the buffered samples since the last change
+                self._bands[key] = None
+                t, v = self.history[self.control(output)].values()
+                since = self._changed.get(output, -np.inf)
+                out = np.nonzero((abs(v - self.setpoint(output)) > dead_band)
+                                 | (t < since))[0]
+                start = out[-1] + 1 if len(out) else 0
+                if start < len(t):
+                    self._bands[key] = t[start]
+            since = self._bands[key]
+        if since is None:
+            return 0.
+        # still in band now, not only at the last sample: the controller
+        # PVs only post on change
+        return max(time.time() - since, 0.)
+
+    def settle_estimate(self, output=1, dead_band=1., wait_time=0.):
+        """
+        seconds until the control channel of output has been within
+        dead_band for wait_time (see predict), None if not predictable
+        """
+        return self.predict(output, dead_band, wait_time)['stable']
+
+    def predict(self, output=1, dead_band=1., wait_time=0.,
+                window=TEMPERATURE_FIT_WINDOW):
+        """
+        Forecast of the control channel of output, from a fit of the last
+        window seconds (fit_temperature_trajectory):
+        - ramping (ramp on, far from the setpoint): the temperature follows
+          the Lakeshore ramp with a lag of ramp*tau, then relaxes with tau
+          once the ramp reaches the setpoint
+        - otherwise: exponential approach to the fitted asymptote; it never
+          reaches the deadband if the asymptote is outside
+        Falls back to the gradient when the fit is not possible.
+        returns dict with reach (s until within dead_band), stable (s until
+        within dead_band for wait_time), stable_at (time.time() then), and
+        the fit (asymptote, rate [deg.C/min], tau, rms); None if unknown
+        """
+        self.start()
+        self._check_output(output)
+        ch = self.control(output)
+        T_set = self.setpoint(output)
+        T_now = self.temperature(ch)
+        residency = self.in_band_for(output, dead_band)
+        ramp = self.outputs[output]['ramp'] / 60.   # deg.C/s
+        ramping = (self.outputs[output]['ramp_on'] == 1 and ramp > 0 and
+                   abs(T_set - T_now) > 2 * dead_band)
+        t, T = self.history[ch].values()
+        recent = t >= t[-1] - window if len(t) else slice(None)
+        fit = fit_temperature_trajectory(t[recent], T[recent], ramp=ramping)
+
+        if residency > 0:
+            reach = 0.
+        elif fit is None:
+            gradient = self.history[ch].gradient() / 60.
+            distance = T_set - T_now
+            reach = None
+            if gradient and not np.isnan(gradient) and distance * gradient > 0:
+                reach = (abs(distance) - dead_band) / abs(gradient)
+        elif ramping:
+            lag = ramp * fit['tau']
+            reach = max(abs(T_set - T_now) - lag, 0.) / ramp
+            if lag > dead_band:
+                reach += fit['tau'] * np.log(lag / dead_band)
+        else:
+            offset = abs(fit['asymptote'] - T_set)
+            amplitude = abs(fit['amplitude'])
+            if offset >= dead_band:
+                reach = None
+            elif amplitude + offset <= dead_band:
+                reach = 0.
+            else:
+                reach = fit['tau'] * np.log(amplitude / (dead_band - offset))
+
+        if residency > 0:
+            stable = max(wait_time - residency, 0.)
+        else:
+            stable = None if reach is None else reach + wait_time
+        prediction = {'channel': ch, 'temperature': T_now, 'setpoint': T_set,
+                      'ramping': ramping,
+                      'reach': None if reach is None else float(reach),
+                      'stable': None if stable is None else float(stable),
+                      'stable_at': (None if stable is None else
+                                    time.time() + stable),
+                      'asymptote': None, 'rate': None, 'tau': None,
+                      'rms': None}
+        if fit is not None:
+            prediction.update(asymptote=fit['asymptote'],
+                              rate=60. * fit['rate'], tau=fit['tau'],
+                              rms=fit['rms'])
+        return prediction
+
+    def status(self, output=1, dead_band=1., wait_time=0.):
+        "dict with the state of the control channel of output"
+        self.start()
+        self._check_output(output)
+        ch = self.control(output)
+        history = self.history[ch]
+        return {'channel': ch, 'temperature': self.temperature(ch),
+                'setpoint': self.setpoint(output),
+                'mean': history.mean(), 'gradient': history.gradient(),
+                'span': history.span(),
+                'ramp': self.outputs[output]['ramp'],
+                'ramp_on': self.outputs[output]['ramp_on'] == 1,
+                'in_band_for': self.in_band_for(output, dead_band),
+                'settle_estimate': self.settle_estimate(output, dead_band,
+                                                        wait_time)}
+
+    def wait_for(self, condition, timeout=None, poll=1.):
+        """
+        Block until condition() is true, checked on every monitor update
+        (and at least every poll seconds). returns condition(), i.e. False
+        on timeout
+        """
+        self.start()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._update:
+            while True:
+                result = condition()
+                if result:
+                    return result
+                remaining = poll if deadline is None else min(
+                    poll, deadline - time.monotonic())
+                if remaining <= 0:
+                    return result
+                self._update.wait(remaining)
+
+    def wait_stable(self, output=1, dead_band=1., wait_time=60.,
+                    timeout=None):
+        """
+        Wait until the control channel of output has been within dead_band
+        of the setpoint for wait_time seconds, at most timeout seconds.
+        returns True if it is stable
+        """
+        return self.wait_for(
+            lambda: self.in_band_for(output, dead_band) >= wait_time,
+            timeout)
+
+
+temperature_monitor = TemperatureMonitor()
+
+
+def temperature_eta(output=1, dead_band=1., wait_time=0.):
+    """
+    Print and return temperature_monitor.predict(): when the control
+    channel of Lakeshore output 1/2 will be within dead_band of the
+    setpoint, and stable there for wait_time seconds.
+    """
+    prediction = temperature_monitor.predict(output, dead_band, wait_time)
+    print('channel {channel}: {temperature:.2f}C, setpoint {setpoint:.2f}C'
+          .format(**prediction))
+    for key, text in (('reach', 'within +/- {}C'.format(dead_band)),
+                      ('stable', 'stable for {}s'.format(wait_time))):
+        if prediction[key] is None:
+            print('  {}: not predictable'.format(text))
+        else:
+            print('  {}: in {:.1f} min ({})'.format(
+                text, prediction[key] / 60., time.ctime(
+                    time.time() + prediction[key])))
+    if prediction['asymptote'] is not None:
+        print('  fit: asymptote {asymptote:.2f}C, rate {rate:.3f}C/min, '
+              'tau {tau:.0f}s, rms {rms:.3f}C'.format(**prediction))
+    return prediction
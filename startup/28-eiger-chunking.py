@@ -0,0 +1,104 @@
+"""
+Choice of the Eiger FWNImagesPerFile (frames per data file) for a series.
+
+Too few frames per file gives thousands of tiny files, slow to download
+from the detector and to open in EigerImages2; too many gives huge files
+that are only readable once the series (nearly) ends. tune_images_per_file
+picks a value from the frame size, the expected compression, the frame
+rate and the targets below, and predicts the resulting throughput.
+
+The costs are rough figures, to be refined with benchmark_eiger_handlers
+(924-eiger-benchmark.py) on the beamline disks.
+"""
+import numpy as np
+
+EIGER_FRAME_SHAPES = {'eiger1m': (1065, 1030), 'eiger4m': (2167, 2070),
+                      'eiger500K': (514, 1030)}
+EIGER_BYTES_PER_PIXEL = 4
+# typical bslz4 compression of XPCS frames (a few photons per pixel or less)
+EIGER_COMPRESSION_RATIO = 10.
+
+# detector side: writing out data, plus creating / closing each data file
+EIGER_WRITE_BYTES_PER_SECOND = 400e6
+EIGER_FILE_WRITE_SECONDS = 0.02
+# reading side: opening a data file (link resolution, HDF5 metadata) and
+# decoding frames
+FILE_OPEN_SECONDS = 0.005
+DECODE_BYTES_PER_SECOND = 500e6
+
+IMAGES_PER_FILE_CHOICES = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000,
+                           5000, 10000)
+
+
+def predicted_throughput(images_per_file, frame_bytes, compression_ratio,
+                         frame_rate=None):
+    """
+    Predicted write (compressed MB/s out of the detector) and read
+    (decoded MB/s in EigerImages2) throughput for images_per_file.
+    """
+    stored = images_per_file * frame_bytes / compression_ratio
+    write = stored / (stored / EIGER_WRITE_BYTES_PER_SECOND +
+                      EIGER_FILE_WRITE_SECONDS)
+    if frame_rate:
+        write = min(write, frame_rate * frame_bytes / compression_ratio)
+    decoded = images_per_file * frame_bytes
+    read = decoded / (FILE_OPEN_SECONDS + decoded / DECODE_BYTES_PER_SECOND)
+    return write / 1e6, read / 1e6
+
+
+def tune_images_per_file(det='eiger4m', imnum=1000, acqp=None,
+                         compression_ratio=EIGER_COMPRESSION_RATIO,
+                         min_file_bytes=20e6, max_file_bytes=1e9,
+                         max_file_seconds=10., read_block=None):
+    """
+    Choose FWNImagesPerFile for a series of imnum frames of det.
+
+    acqp: acquire period [s]; files are kept to max_file_seconds of
+          acquisition so that they become readable while the series runs
+    min_file_bytes, max_file_bytes: target range of the (compressed) size
+          of a data file
+    read_block: frames the analysis reads at a time (e.g. get_frames
+          blocks); the choice is then a divisor or a multiple of it
+    returns a dict with images_per_file, the number of files, the file
+    size and the predicted write/read throughput (MB/s)
+    """
+    if imnum < 1:
+        raise ValueError('imnum must be at least 1, got {!r}'.format(imnum))
+    frame_bytes = (np.prod(EIGER_FRAME_SHAPES[det]) *
+                   EIGER_BYTES_PER_PIXEL)
+    file_bytes = frame_bytes / compression_ratio
+    frame_rate = 1. / acqp if acqp else None
+
+    choices = set(IMAGES_PER_FILE_CHOICES)
+    if read_block:
+        choices.update(read_block << k for k in range(8))
+        choices.update(read_block >> k for k in range(1, 8)
+                       if read_block % (1 << k) == 0)
+    candidates = sorted(n for n in choices if n < imnum) + [imnum]
+    allowed = [n for n in candidates
+               if n * file_bytes <= max_file_bytes and
+               (frame_rate is None or n / frame_rate <= max_file_seconds)]
+    allowed = allowed or candidates[:1]
+    # the smallest files above min_file_bytes, or else the largest allowed,
+    # aligned with read_block when possible
+    if read_block:
+        aligned = [n for n in allowed if n == imnum or
+                   n % read_block == 0 or read_block % n == 0]
+        allowed = aligned or allowed
+    big_enough = [n for n in allowed if n * file_bytes >= min_file_bytes]
+    images_per_file = big_enough[0] if big_enough else allowed[-1]
+
+    write, read = predicted_throughput(images_per_file, frame_bytes,
+                                       compression_ratio, frame_rate)
+    return {'images_per_file': int(images_per_file),
+            'files': int(-(-imnum // images_per_file)),
+            'file_MB': float(images_per_file * file_bytes / 1e6),
+            'predicted_write_MBps': float(write),
+            'predicted_read_MBps': float(read)}
+
+
+def images_per_file_md(choice):
+    "Run metadata recording a tune_images_per_file choice."
+    return {'images per file': choice['images_per_file'],
+            'predicted write MB/s': round(choice['predicted_write_MBps'], 1),
+            'predicted read MB/s': round(choice['predicted_read_MBps'], 1)}
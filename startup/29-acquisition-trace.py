@@ -0,0 +1,145 @@
+"""
+Phase timelines of the acquisition macros (series, eiger4m_series, snap,
+Sample.measure* ...), to see where the dead time between runs goes.
+
+A macro decorated with @traced gets an AcquisitionTrace. The macro marks
+its own phases with trace_phase('...'), and the RunEngine messages
+(stage, trigger, wait, read, unstage = file close ...) are marked from a
+RE.msg_hook. When the macro returns, the timeline is written as a
+side-car JSON file next to each run it took,
+ACQUISITION_TRACE_DIR/<start uid>.json, and kept in last_trace().
+"""
+import functools
+import json
+import os
+import time
+from datetime import datetime
+
+ACQUISITION_TRACE_DIR = os.environ.get(
+    'CHX_TRACE_DIR', os.path.expanduser('~/.cache/chx_acquisition_traces'))
+# print the timeline of every traced macro when it returns
+ACQUISITION_TRACE_PRINT = False
+
+_active_traces = []
+_last_trace = None
+
+
+class AcquisitionTrace:
+    "Monotonic timeline of the phases of one acquisition macro."
+    def __init__(self, name):
+        self.name = name
+        self.started = datetime.now().isoformat()
+        self.t0 = time.monotonic()
+        self.phases = []   # [phase, start, duration], start relative to t0
+        self.runs = []     # start uids of the runs taken
+        self.total = None
+
+    def phase(self, name):
+        "End the current phase and start `name` (repeats are merged)."
+        if self.phases and self.phases[-1][0] == name:
+            return
+        self.end()
+        self.phases.append([name, time.monotonic() - self.t0, None])
+
+    def end(self):
+        now = time.monotonic() - self.t0
+        if self.phases and self.phases[-1][2] is None:
+            self.phases[-1][2] = now - self.phases[-1][1]
+        self.total = now
+
+    def summary(self):
+        "Phases, total time per phase and runs, as a JSON-able dict."
+        per_phase = {}
+        for name, start, duration in self.phases:
+            per_phase[name] = per_phase.get(name, 0.) + (duration or 0.)
+        return {'macro': self.name, 'started': self.started,
+                'total': self.total, 'runs': self.runs,
+                'per_phase': per_phase,
+                'phases': [{'phase': name, 'start': start,
+                            'duration': duration}
+                           for name, start, duration in self.phases]}
+
+    def report(self):
+        print('{} ({:.3f} s)'.format(self.name, self.total or 0.))
+        for name, start, duration in self.phases:
+            print('  {:>9.3f} s  {:>9.3f} s  {}'.format(
+                start, duration or 0., name))
+
+    def save(self, directory=ACQUISITION_TRACE_DIR):
+        "Write the summary as <run start uid>.json (or <macro>_<time>.json)."
+        names = self.runs or ['{}_{}'.format(
+            self.name, self.started.replace(':', '-'))]
+        try:
+            os.makedirs(directory, exist_ok=True)
+            for name in names:
+                with open(os.path.join(directory, name + '.json'), 'w') as f:
+                    json.dump(self.summary(), f, indent=1)
+        except OSError as e:
+            print('Could not save the acquisition trace: {}'.format(e))
+
+
+def trace_phase(name):
+    "Mark the start of phase `name` of the macro being traced (if any)."
+    if _active_traces:
+        _active_traces[-1].phase(name)
+
+
+def last_trace():
+    "AcquisitionTrace of the last traced macro."
+    return _last_trace
+
+
+def traced(func=None, *, name=None):
+    """
+    Decorator tracing the phases of an acquisition macro. Nested traced
+    calls (measureSpots -> measure -> snap) belong to the outer trace.
+    """
+    if func is None:
+        return functools.partial(traced, name=name)
+    trace_name = name or func.__qualname__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        global _last_trace
+        if _active_traces:
+            trace_phase(trace_name)
+            return func(*args, **kwargs)
+        trace = AcquisitionTrace(trace_name)
+        trace.phase('setup')
+        _active_traces.append(trace)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _active_traces.pop()
+            trace.end()
+            _last_trace = trace
+            trace.save()
+            if ACQUISITION_TRACE_PRINT:
+                trace.report()
+    return wrapper
+
+
+# RunEngine messages -> phases
+_MSG_PHASES = {'open_run': 'open run', 'stage': 'stage',
+               'trigger': 'trigger', 'wait': 'wait (acquisition)',
+               'create': 'read', 'read': 'read', 'save': 'read',
+               'unstage': 'unstage (file close)', 'close_run': 'close run',
+               'sleep': 'sleep', 'pause': 'pause', 'set': 'set'}
+
+
+def _trace_msg_hook(msg, _chained=RE.msg_hook):
+    if _active_traces:
+        phase = _MSG_PHASES.get(msg.command)
+        if phase is not None:
+            _active_traces[-1].phase(phase)
+    if _chained is not None:
+        _chained(msg)
+
+
+def _trace_runs(name, doc):
+    if _active_traces:
+        _active_traces[-1].runs.append(doc['uid'])
+
+
+RE.msg_hook = _trace_msg_hook
+RE.subscribe(_trace_runs, 'start')
@@ -1,6 +1,8 @@
 import asyncio
+import threading
 import time
 from ophyd import EpicsMotor
+from ophyd.status import wait as status_wait
 from epics import caput
 from epics import caget
 from databroker.assets.path_only_handlers import RawHandler
@@ -179,14 +181,14 @@ def ct_500k(expt=.0001,frame_rate=9000,imnum=1,comment='eiger500K image'):
     #a=RE.md.pop('T_yoke')
 
 hdm_feedback_selector = EpicsSignal('XF:11IDA-OP{Mir:HDM-Ax:P}Sts:FB-Sel',
-                                    name='hdm_feedback_selector')
-bpm2_feedback_selector_b = EpicsSignal('XF:11IDB-BI{XBPM:02}Fdbk:BEn-SP', name='bpm2_feeedback_selector_b')
-bpm2_feedback_selector_a = EpicsSignal('XF:11IDB-BI{XBPM:02}Fdbk:AEn-SP', name='bpm2_feeedback_selector_a')
+                                    auto_monitor=True, name='hdm_feedback_selector')
+bpm2_feedback_selector_b = EpicsSignal('XF:11IDB-BI{XBPM:02}Fdbk:BEn-SP', auto_monitor=True, name='bpm2_feeedback_selector_b')
+bpm2_feedback_selector_a = EpicsSignal('XF:11IDB-BI{XBPM:02}Fdbk:AEn-SP', auto_monitor=True, name='bpm2_feeedback_selector_a')
 
 
 class BPMReadings(Device):
-    x = Cpt(EpicsSignal, 'XF:11IDB-BI{XBPM:02}Pos:X-I')
-    y = Cpt(EpicsSignal, 'XF:11IDB-BI{XBPM:02}Pos:Y-I')
+    x = Cpt(EpicsSignal, 'XF:11IDB-BI{XBPM:02}Pos:X-I', auto_monitor=True)
+    y = Cpt(EpicsSignal, 'XF:11IDB-BI{XBPM:02}Pos:Y-I', auto_monitor=True)
 
 bpm_readings = BPMReadings('', name='bpm_readings')
 
@@ -225,8 +227,8 @@ def feedback_ON():
         yield from bps.sleep(1)
         yield from mv(bpm2_feedback_selector_a, 1)
 
-hdm_pitch = EpicsSignal('XF:11IDA-OP{Mir:HDM-Ax:P}Pos-I', name='hdm_pitch')
-hdm_pid_setpoint = EpicsSignal('XF:11IDA-OP{Mir:HDM-Ax:P}PID-SP', name='hdm_pid_setpoint')
+hdm_pitch = EpicsSignal('XF:11IDA-OP{Mir:HDM-Ax:P}Pos-I', auto_monitor=True, name='hdm_pitch')
+hdm_pid_setpoint = EpicsSignal('XF:11IDA-OP{Mir:HDM-Ax:P}PID-SP', auto_monitor=True, name='hdm_pid_setpoint')
 
 def feedback_OFF(epics_feedback_on=True): 
     """
@@ -298,12 +300,14 @@ def diode_IN():
 
 
 
+@traced
 def snap(det='eiger4m',expt=0.1,comment='Single image'):
     """
     sets exp time (and period) to expt (default 0.1s)
     sets #images and #triggers both to 1
     takes an Eiger image
     """
+    trace_phase('parameter setup')
     if det == 'eiger4m':
         dets=[eiger4m_single]
         caput('XF:11IDB-ES{Det:Eig4M}cam1:NumImages',1)
@@ -386,6 +390,7 @@ class param_Exception(Exception):
 ########## END sample-detector distance macros for SAXS ####################
 
 # temporary fix for not having the fast shutter
+@traced
 def eiger4m_series(expt=.1,acqp='auto',imnum=5,comment=''):
     """
     July 2017: fast shutter broken, use edge of empty slot in monitor chamber
@@ -399,9 +404,12 @@ def eiger4m_series(expt=.1,acqp='auto',imnum=5,comment=''):
             expt=.00134
     else:
             pass
+    trace_phase('metadata collection')
     seqid=caget('XF:11IDB-ES{Det:Eig4M}cam1:SequenceId')+1
     idpath=caget('XF:11IDB-ES{Det:Eig4M}cam1:FilePath',' {"longString":true}')
+    trace_phase('detector file clear')
     caput('XF:11IDB-ES{Det:Eig4M}cam1:FWClear',1)    #remove files from the detector DISABLE FOR MANUAL DOWNLOAD!!!
+    trace_phase('parameter setup')
     caput('XF:11IDB-ES{Det:Eig4M}cam1:ArrayCounter',0) # set image counter to '0'
     if imnum < 500:                                                            # set chunk size
             caput('XF:11IDB-ES{Det:Eig4M}cam1:FWNImagesPerFile',10)
@@ -414,6 +422,7 @@ def eiger4m_series(expt=.1,acqp='auto',imnum=5,comment=''):
     detector.num_triggers.put(1)
     #print('adding metadata: '+time.ctime())
     RE(sleep(2)) # needed to ensure values are updated in EPICS prior to reading them back...
+    trace_phase('metadata collection')
     RE.md['exposure time']=str(expt)        # add metadata information about this run
     #print('adding metadata acquire period: '+str(detector.cam.acquire_period.value))
     RE.md['acquire period']=str(acqp)
@@ -444,6 +453,7 @@ def eiger4m_series(expt=.1,acqp='auto',imnum=5,comment=''):
     RE.resume()
     beam_off()
     ### end data acquisition
+    trace_phase('metadata cleanup')
     a=RE.md.pop('exposure time')        # remove eiger series specific meta data (need better way to remove keys 'silently'....)
     a=RE.md.pop('acquire period')
     #a=RE.md.pop('shutter mode')
@@ -457,6 +467,7 @@ def eiger4m_series(expt=.1,acqp='auto',imnum=5,comment=''):
     a=RE.md.pop('feedback_x')
     a=RE.md.pop('feedback_y')
     a=RE.md.pop('transmission')
+    trace_phase('olog')
     log_manual_count()
 
 # temporary fix for not having the fast shutter
@@ -542,6 +553,7 @@ def prep_series_feedback():
     #RE(mv(bpm2_feedback_selector_a, 1))
     
 # Lutz's test Nov 08 start
+@traced
 def series(det='eiger4m',shutter_mode='single',expt=.1,acqp='auto',imnum=5,comment='', feedback_on=False, use_xbpm=False,OAV_mode='none'):
     """
     det='eiger1m' / 'eiger4m'
@@ -560,29 +572,29 @@ def series(det='eiger4m',shutter_mode='single',expt=.1,acqp='auto',imnum=5,comme
     if acqp=='auto':
         acqp=expt
     if det == 'eiger1m':    #get Dectris sequence ID
+        trace_phase('metadata collection')
         seqid=caget('XF:11IDB-ES{Det:Eig1M}cam1:SequenceId')+1
         idpath=caget('XF:11IDB-ES{Det:Eig1M}cam1:FilePath',' {"longString":true}')
+        trace_phase('detector file clear')
         caput('XF:11IDB-ES{Det:Eig1M}cam1:FWClear',1)    #remove files from the detector
+        trace_phase('parameter setup')
         caput('XF:11IDB-ES{Det:Eig1M}cam1:ArrayCounter',0) # set image counter to '0'
-        if imnum < 10:
-            caput('XF:11IDB-ES{Det:Eig1M}cam1:FWNImagesPerFile',1)
-        elif imnum < 500:                                                            # set chunk size
-            caput('XF:11IDB-ES{Det:Eig1M}cam1:FWNImagesPerFile',10)
-        else: 
-            caput('XF:11IDB-ES{Det:Eig1M}cam1:FWNImagesPerFile',100)
+        chunking=tune_images_per_file(det,imnum,acqp)   # set chunk size (28-eiger-chunking.py)
+        caput('XF:11IDB-ES{Det:Eig1M}cam1:FWNImagesPerFile',chunking['images_per_file'])
     elif det == 'eiger4m':
         if expt <.00134:
             expt=.00134
         else:
             pass
+        trace_phase('metadata collection')
         seqid=caget('XF:11IDB-ES{Det:Eig4M}cam1:SequenceId')+1
         idpath=caget('XF:11IDB-ES{Det:Eig4M}cam1:FilePath',' {"longString":true}')
+        trace_phase('detector file clear')
         caput('XF:11IDB-ES{Det:Eig4M}cam1:FWClear',1)    #remove files from the detector DISABLED FOR MANUAL DOWNLOAD!!!
+        trace_phase('parameter setup')
         caput('XF:11IDB-ES{Det:Eig4M}cam1:ArrayCounter',0) # set image counter to '0'
-        if imnum < 500:                                                            # set chunk size
-            caput('XF:11IDB-ES{Det:Eig4M}cam1:FWNImagesPerFile',10)
-        else: 
-            caput('XF:11IDB-ES{Det:Eig4M}cam1:FWNImagesPerFile',100)
+        chunking=tune_images_per_file(det,imnum,acqp)   # set chunk size (28-eiger-chunking.py)
+        caput('XF:11IDB-ES{Det:Eig4M}cam1:FWNImagesPerFile',chunking['images_per_file'])
     #print('setting detector paramters: '+time.ctime())
     if shutter_mode=='single':
         if det == 'eiger1m':
@@ -644,6 +656,7 @@ def series(det='eiger4m',shutter_mode='single',expt=.1,acqp='auto',imnum=5,comme
         RE.md['transmission']=att.get_T()*att2.get_T()
         RE.md['OAV_mode']=OAV_mode
     #print('adding experiment specific metadata: '+time.ctime())
+    trace_phase('metadata collection')
     ## add experiment specific metadata:
     RE.md['T_yoke']=str(caget('XF:11IDB-ES{Env:01-Chan:C}T:C-I'))
     RE.md['T_sample']=str(caget('XF:11IDB-ES{Env:01-Chan:D}T:C-I'))
@@ -656,10 +669,12 @@ def series(det='eiger4m',shutter_mode='single',expt=.1,acqp='auto',imnum=5,comme
     elif caget('XF:11IDB-BI{XBPM:02}Fdbk:BEn-SP') == 0: 
         RE.md['feedback_y']='off'
     ## end experiment specific metadata
+    RE.md.update(images_per_file_md(chunking))
     print('taking data series: exposure time: '+str(expt)+'s,  period: '+str(acqp)+'s '+str(imnum)+'frames  shutter mode: '+shutter_mode)
     print('Dectris sequence id: '+str(int(seqid)))
     #print('executing count: '+time.ctime())
     print('OAV_mode: '+OAV_mode)    ### ADDED OAV_mode HERE!
+    trace_phase('OAV setup')
     if OAV_mode == 'none':
         detlist=[detector]
     elif OAV_mode == 'single':
@@ -690,10 +705,12 @@ def series(det='eiger4m',shutter_mode='single',expt=.1,acqp='auto',imnum=5,comme
     RE(count(detlist),Measurement=comment)  ### testing camera images taken simultaneously
     # setting image number and period back for OAV camera:
     if OAV_mode != 'none':      ####!!! NEED TO CHANGE TO OAV PVs
+        trace_phase('OAV restore')
         caput('XF:11IDB-BI{Cam:08}cam1:NumImages',org_ni)
         caput('XF:11IDB-BI{Cam:08}cam1:AcquirePeriod',org_pt)
 
     #print('remove metadata: '+time.ctime())    
+    trace_phase('metadata cleanup')
     a=RE.md.pop('exposure time')        # remove eiger series specific meta data (need better way to remove keys 'silently'....)
     a=RE.md.pop('acquire period')
     a=RE.md.pop('shutter mode')
@@ -707,9 +724,320 @@ def series(det='eiger4m',shutter_mode='single',expt=.1,acqp='auto',imnum=5,comme
     a=RE.md.pop('feedback_y')
     a=RE.md.pop('transmission')
     a=RE.md.pop('OAV_mode')
+    for key in images_per_file_md(chunking):
+        a=RE.md.pop(key)
 
 class series_Exception(Exception):
     pass
+
+
+from epics import caget_many
+from bluesky.preprocessors import finalize_wrapper
+
+
+class EigerSeriesSetup(Device):
+    """
+    Eiger and fast shutter setpoints written by series_plan. Sets complete
+    on the EPICS put callback, so a group of them is waited on once.
+    pending_files: files still to be downloaded from the detector
+    """
+    pending_files = Cpt(EpicsSignalRO, 'cam1:PendingFiles_RBV')
+    fw_clear = Cpt(EpicsSignal, 'cam1:FWClear', put_complete=True)
+    array_counter = Cpt(EpicsSignal, 'cam1:ArrayCounter', put_complete=True)
+    images_per_file = Cpt(EpicsSignal, 'cam1:FWNImagesPerFile',
+                          put_complete=True)
+    acquire_time = Cpt(EpicsSignal, 'cam1:AcquireTime', put_complete=True)
+    acquire_period = Cpt(EpicsSignal, 'cam1:AcquirePeriod', put_complete=True)
+    num_images = Cpt(EpicsSignal, 'cam1:NumImages', put_complete=True)
+    shutter_mode = Cpt(EpicsSignal, 'Mode-Cmd', put_complete=True)
+    shutter_num_images = Cpt(EpicsSignal, 'NumImages-SP', put_complete=True)
+    shutter_exposure_time = Cpt(EpicsSignal, 'ExposureTime-SP',
+                                put_complete=True)
+    shutter_acquire_period = Cpt(EpicsSignal, 'AcquirePeriod-SP',
+                                 put_complete=True)
+
+
+class CameraSeriesSetup(Device):
+    "OAV camera setpoints written by series_plan."
+    num_images = Cpt(EpicsSignal, 'cam1:NumImages', put_complete=True)
+    acquire_period = Cpt(EpicsSignal, 'cam1:AcquirePeriod', put_complete=True)
+
+
+series_setup = {
+    'eiger1m': make_device(EigerSeriesSetup, 'XF:11IDB-ES{Det:Eig1M}',
+                           name='eiger1m_series_setup'),
+    'eiger4m': make_device(EigerSeriesSetup, 'XF:11IDB-ES{Det:Eig4M}',
+                           name='eiger4m_series_setup'),
+    'OAV': make_device(CameraSeriesSetup, 'XF:11IDB-BI{Cam:08}',
+                       name='OAV_series_setup'),  ##!!! need to change to OAV
+}
+
+
+def _caget_all(pvs):
+    """
+    Read {key: PV name} in one batched channel access request; char
+    waveforms (long strings) come back as str.
+    """
+    values = caget_many(list(pvs.values()))
+    result = {}
+    for key, value in zip(pvs, values):
+        if value is None:
+            raise series_Exception('error: could not read ' + pvs[key])
+        if isinstance(value, np.ndarray) and value.dtype in (np.uint8, np.int8):
+            value = value.astype(np.uint8).tobytes().split(b'\0')[0].decode()
+        result[key] = value
+    return result
+
+
+def _series_prepare(det='eiger4m', shutter_mode='single', expt=.1,
+                    acqp='auto', imnum=5, comment='', feedback_on=False,
+                    OAV_mode='none'):
+    """
+    Checks and batched PV reads of series_plan, without writing anything.
+
+    returns a dict with the detectors to count ('detlist'), the run
+    metadata ('md'), the setpoints split in 'params' (exposure, shutter,
+    OAV: can be written while the previous files are still downloading)
+    and 'clear' (file writer reset: only once they are downloaded), the
+    OAV values to restore afterwards ('restore') and the 'setup' device
+    """
+    if acqp == 'auto':
+        acqp = expt
+    if det not in ('eiger1m', 'eiger4m'):
+        raise series_Exception('error: det needs to be eiger1m|eiger4m')
+    if shutter_mode not in ('single', 'multi'):
+        raise series_Exception('error: shutter_mode needs to be single|multi')
+    if OAV_mode not in ('none', 'single', 'start_end', 'movie'):
+        raise series_Exception('error: OAV_mode needs to be none|single|start_end|movie...')
+    if det == 'eiger4m' and expt < .00134:
+        expt = .00134
+    if shutter_mode == 'multi':
+        if acqp < .1 and imnum > 5000:
+            print('warning: max number frames with shutter >10Hz is 5000....re-setting "imnum" to 5000.')
+            imnum = 5000
+        if expt*acqp < 5.99E-5:
+            raise series_Exception('error: shutter duty cycle is too high...make sure expt x acqp <6E-5.')
+
+    prefix = {'eiger1m': 'XF:11IDB-ES{Det:Eig1M}',
+              'eiger4m': 'XF:11IDB-ES{Det:Eig4M}'}[det]
+    pvs = {'seqid': prefix + 'cam1:SequenceId',
+           'idpath': prefix + 'cam1:FilePath',
+           'exposure_delay': prefix + 'ExposureDelay-SP',
+           'T_yoke': 'XF:11IDB-ES{Env:01-Chan:C}T:C-I',
+           'T_sample': 'XF:11IDB-ES{Env:01-Chan:D}T:C-I',
+           'feedback_x': 'XF:11IDB-BI{XBPM:02}Fdbk:AEn-SP',
+           'feedback_y': 'XF:11IDB-BI{XBPM:02}Fdbk:BEn-SP'}
+    if OAV_mode != 'none':      ####!!! NEED TO CHANGE TO OAV PVs
+        pvs.update(org_pt='XF:11IDB-BI{Cam:08}cam1:AcquirePeriod_RBV',
+                   org_ni='XF:11IDB-BI{Cam:08}cam1:NumImages_RBV',
+                   oav_expt='XF:11IDB-BI{Cam:08}cam1:AcquireTime',
+                   oav_acqp='XF:11IDB-BI{Cam:08}cam1:AcquirePeriod')
+    values = _caget_all(pvs)
+    seqid = values['seqid'] + 1
+    if shutter_mode == 'multi' and (
+            expt + values['exposure_delay'] >= acqp or acqp < .019):
+        raise series_Exception('error: exposure time +shutter time > acquire period or shutter requested to go >50Hz')
+
+    setup = series_setup[det]
+    chunking = tune_images_per_file(det, imnum, acqp)   # set chunk size
+    clear = [(setup.fw_clear, 1),     # remove files from the detector
+             (setup.array_counter, 0),    # set image counter to '0'
+             (setup.images_per_file, chunking['images_per_file'])]
+    if shutter_mode == 'single':
+        detector = {'eiger1m': eiger1m_single, 'eiger4m': eiger4m_single}[det]
+        params = [(setup.acquire_time, expt),
+                  (setup.acquire_period, acqp),
+                  (setup.num_images, imnum)]
+    else:
+        detector = {'eiger1m': eiger1m, 'eiger4m': eiger4m}[det]
+        params = [(setup.shutter_mode, 1),    # enable auto-shutter-mode
+                  (setup.shutter_num_images, imnum),
+                  (setup.shutter_exposure_time, expt),
+                  (setup.shutter_acquire_period, acqp),
+                  # ignored in data acquisition, but gets correct metadata in HDF5 file
+                  (setup.acquire_period, acqp)]
+
+    detlist = [detector]
+    oav = series_setup['OAV']
+    restore = []
+    if OAV_mode != 'none':
+        detlist.append(xray_eye3_writing)   ##!!! need to change to OAV
+        # setting image number and period back for OAV camera
+        restore = [(oav.num_images, values['org_ni']),
+                   (oav.acquire_period, values['org_pt'])]
+    if OAV_mode == 'single':
+        params.append((oav.num_images, 1))
+    elif OAV_mode == 'start_end':
+        pt = (expt+acqp)*imnum  # period between two images to span Eiger series (exposure time for OAV image neglected)
+        params += [(oav.num_images, 2), (oav.acquire_period, pt)]
+    elif OAV_mode == 'movie':
+        ni = (expt+acqp)*imnum/(values['oav_expt']+values['oav_acqp'])
+        params.append((oav.num_images, np.ceil(ni)))
+
+    md = {'Measurement': comment,
+          'exposure time': expt, 'acquire period': acqp,
+          'shutter mode': shutter_mode, 'number of images': imnum,
+          'data path': values['idpath'], 'sequence id': str(seqid),
+          'transmission': att.get_T()*att2.get_T(), 'OAV_mode': OAV_mode,
+          'T_yoke': str(values['T_yoke']),
+          'T_sample': str(values['T_sample']),
+          'feedback_x': 'on' if feedback_on or values['feedback_x'] == 1 else 'off',
+          'feedback_y': 'on' if feedback_on or values['feedback_y'] == 1 else 'off'}
+    md.update(images_per_file_md(chunking))
+    if shutter_mode == 'single':   # as series() does
+        for key in ('exposure time', 'acquire period', 'number of images'):
+            md[key] = str(md[key])
+
+    return {'detlist': detlist, 'md': md, 'params': params, 'clear': clear,
+            'restore': restore, 'setup': setup, 'seqid': seqid}
+
+
+def _series_setpoints(setpoints, group):
+    for signal, value in setpoints:
+        yield from bps.abs_set(signal, value, group=group)
+
+
+def _series_start(prepared, feedback_on=False, use_xbpm=False):
+    md = prepared['md']
+    print('taking data series: exposure time: '+str(md['exposure time'])+'s,  period: '+str(md['acquire period'])+'s '+str(md['number of images'])+'frames  shutter mode: '+md['shutter mode'])
+    print('Dectris sequence id: '+str(int(prepared['seqid'])))
+    print('OAV_mode: '+md['OAV_mode'])
+    if use_xbpm:
+        caput('XF:11IDB-BI{XBPM:02}FaSoftTrig-SP', 1, wait=True)
+        print('User XBPM to monitor beam intensity.')
+    if feedback_on:
+        yield from prep_series_feedback()
+
+
+def series_plan(det='eiger4m', shutter_mode='single', expt=.1, acqp='auto',
+                imnum=5, comment='', feedback_on=False, use_xbpm=False,
+                OAV_mode='none'):
+    """
+    Plan version of series(), same arguments: RE(series_plan(...))
+
+    All the PVs needed for the checks and the metadata are read in one
+    batched request, and the independent setpoints are written together
+    (set_group) and waited on once, so the setup takes about as long as
+    the slowest PV instead of the sum of all of them. The metadata go to
+    the run start document only: RE.md is left alone.
+    """
+    print('start of series: '+time.ctime())
+    prepared = _series_prepare(det, shutter_mode, expt, acqp, imnum,
+                               comment, feedback_on, OAV_mode)
+    yield from _series_setpoints(prepared['clear'] + prepared['params'],
+                                 'series_setup')
+    yield from bps.wait('series_setup')
+    yield from _series_start(prepared, feedback_on, use_xbpm)
+
+    def restore_oav():
+        if prepared['restore']:
+            yield from _series_setpoints(prepared['restore'], 'series_restore')
+            yield from bps.wait('series_restore')
+
+    return (yield from finalize_wrapper(
+        count(prepared['detlist'], md=prepared['md']), restore_oav()))
+
+
+# seconds series_queue_plan waits for the files of a series to be downloaded
+# from the detector before clearing them for the next one
+SERIES_QUEUE_DOWNLOAD_TIMEOUT = 600.
+
+
+def _wait_files_downloaded(setup, timeout=SERIES_QUEUE_DOWNLOAD_TIMEOUT):
+    # read through the RunEngine (bps.rd), so that the plan can be simulated
+    t0 = time.monotonic()
+    while (yield from bps.rd(setup.pending_files)):
+        if time.monotonic() - t0 > timeout:
+            raise series_Exception('error: files of the previous series still not downloaded after {:.0f}s'.format(timeout))
+        yield from bps.sleep(.2)
+
+
+def series_queue_plan(items, feedback_on=False, use_xbpm=False,
+                      download_timeout=SERIES_QUEUE_DOWNLOAD_TIMEOUT):
+    """
+    Take a list of series back to back: RE(series_queue_plan(items))
+
+    items: list of dicts with the series_plan arguments (det, shutter_mode,
+        expt, acqp, imnum, comment, OAV_mode) and optionally
+        'position': {motor: position} to move to before the series,
+        'sample': a Sample (32-CFN-Sample.py) whose get_md() is added to
+                  the metadata, as in Sample.measureXPCS,
+        'md': extra metadata
+    While the files of one series are downloaded from the detector, the
+    next item's motors move, its detector / shutter / OAV parameters are
+    written and its metadata are read. Only the file writer reset waits
+    for the download to finish.
+    Unlike calling series() once per item, the OAV / camera settings are
+    not restored after each series: each item starts from the settings the
+    previous one left, and the settings from before the queue are
+    restored once, at the end (also on error / abort).
+    returns the list of run start uids
+    """
+    keys = ('det', 'shutter_mode', 'expt', 'acqp', 'imnum', 'comment',
+            'OAV_mode')
+    items = [dict(item) for item in items]
+    for n, item in enumerate(items):
+        unknown = set(item) - set(keys) - {'position', 'sample', 'md'}
+        if unknown:
+            raise series_Exception('error: unknown keys in queue item {}: {}'.format(n, ', '.join(sorted(unknown))))
+    uids = []
+    restore = {}
+    previous = None
+
+    def run_queue():
+        nonlocal previous
+        for n, item in enumerate(items):
+            trace_phase('queue item {}: moves and parameters'.format(n))
+            for motor, position in item.get('position', {}).items():
+                yield from bps.abs_set(motor, position, group='series_queue')
+            prepared = _series_prepare(
+                feedback_on=feedback_on,
+                **{key: item[key] for key in keys if key in item})
+            for signal, value in prepared['restore']:
+                restore.setdefault(signal, value)   # values before the queue
+            yield from _series_setpoints(prepared['params'], 'series_queue')
+            if previous is prepared['setup']:
+                trace_phase('queue item {}: waiting for file download'.format(n))
+                yield from _wait_files_downloaded(previous, download_timeout)
+            yield from _series_setpoints(prepared['clear'], 'series_queue')
+            yield from bps.wait('series_queue')
+
+            trace_phase('queue item {}: metadata'.format(n))
+            md = prepared['md']
+            if 'sample' in item:   # positions are read after the moves
+                md = dict(item['sample'].get_md(**md))
+            md.update(item.get('md', {}))
+            md['queue item'] = n
+            print('series queue: item {} of {}, {}'.format(
+                n + 1, len(items), time.ctime()))
+            yield from _series_start(prepared, feedback_on, use_xbpm)
+            uid = yield from count(prepared['detlist'], md=md)
+            uids.append(uid)
+            previous = prepared['setup']
+
+    def restore_oav():
+        if restore:
+            yield from _series_setpoints(restore.items(), 'series_restore')
+            yield from bps.wait('series_restore')
+
+    yield from finalize_wrapper(run_queue(), restore_oav())
+    return uids
+
+
+@traced  # 29-acquisition-trace.py
+def series_queue(items, feedback_on=False, use_xbpm=False):
+    """
+    Take the series in items back to back, overlapping the setup of each
+    series with the download of the previous one; see series_queue_plan.
+    e.g. series_queue([dict(expt=.01, imnum=1000, comment='25C', position={diff.xh: 0.1}),
+                       dict(expt=.01, imnum=1000, comment='25C', position={diff.xh: 0.3})])
+    returns the list of run start uids
+    """
+    print('start of series queue: '+time.ctime())
+    uids = RE(series_queue_plan(items, feedback_on, use_xbpm))
+    print('end of series queue: '+time.ctime())
+    return uids
+
 # heating with sample chamber, using both heaters:
 def set_temperature(Tsetpoint,heat_ramp=3,cool_ramp=0,log_entry='on'):       # MADE MAJOR CHANGES: NEEDS TESTING!!! [01/23/2017 LW]
     """
@@ -787,52 +1115,37 @@ def set_temperature(Tsetpoint,heat_ramp=3,cool_ramp=0,log_entry='on'):       # M
 
 
 # wait for temperature NOT TESTED YET
-def wait_temperature(wait_time=1200,dead_band=1.,channel=1,log_entry='on'):
+def wait_temperature(wait_time=1200,dead_band=1.,channel=1,log_entry='on',update_period=300):
     """
+    wait until the temperature on the control channel of Lakeshore output 'channel' (1 or 2)
+    has been within +/- dead_band of the setpoint for wait_time seconds
+    the temperatures are monitored (27-temperature-monitor.py): returns as soon as the criterion is met,
+    gives up after 2x wait_time once within 2x dead_band
+    update_period: [s] max. period of the updated estimates while approaching the setpoint
+    use temperature_eta() to predict when the temperature will be stable, e.g. to plan the next series
     """
+    if channel not in (1,2):
+        raise check_Exception('error: control channel has to be either "1" or "2"!')
     sleep(5) # make sure previous changes to the Lakehsore settings are updated...
-    ch=['none','XF:11IDB-ES{Env:01-Chan:A}T:C-I','XF:11IDB-ES{Env:01-Chan:B}T:C-I','XF:11IDB-ES{Env:01-Chan:C}T:C-I','XF:11IDB-ES{Env:01-Chan:D}T:C-I']
-    #check on which temperature the selected channel feedbacks:
-    if channel==1:
-        ch_num=caget('XF:11IDB-ES{Env:01-Out:1}Out-Sel')
-        ramp=caget('XF:11IDB-ES{Env:01-Out:1}Val:Ramp-RB')
-        T_set=caget('XF:11IDB-ES{Env:01-Out:1}T-SP') - 273.15
-        ramp_on=caget('XF:11IDB-ES{Env:01-Out:1}Enbl:Ramp-Sel')
-    elif channel==2:
-        ch_num=caget('XF:11IDB-ES{Env:01-Out:2}Out-Sel')
-        ramp=caget('XF:11IDB-ES{Env:01-Out:2}Val:Ramp-RB')
-        T_set=caget('XF:11IDB-ES{Env:01-Out:2}T-SP') - 273.15
-        ramp_on=caget('XF:11IDB-ES{Env:01-Out:2}Enbl:Ramp-Sel')
-    else: raise check_Exception('error: control channel has to be either "1" or "2"!')
-    curr_T=caget(ch[ch_num])
-    # estimate how long it will take to reach the temperature setpoint:
-    if ramp_on==1:
-        dtime=abs(T_set-curr_T)/ramp
-    else:
-        print('temperature ramping is off...checking temperature increase vs. time...this will take several minutes....')
-        sleep(120) # wait 2 minutes (overcome T-inertia)
-        dtime=get_T_gradient(channel)
-    print(time.ctime()+ '   initial estimate to reach T='+str(T_set)[:5]+'C on channel '+caget('XF:11IDB-ES{Env:01-Out:1}Out-Sel','char')+': '+str(dtime)[:5]+' minutes')
-    # initial wait for reaching setpoint temperature
-    dT=T_set-caget(ch[ch_num])
-    while abs(dT)>2*dead_band:
-        RE(sleep(min([abs(dtime)*60,300])))        # get an update after max 5 minutes...
-        dtime=(T_set-caget(ch[ch_num]))/(abs(get_T_gradient(channel))+.1)
-        dT=T_set-caget(ch[ch_num])  #why was this commented??
-        print(time.ctime()+ '       updated estimate to reach T='+str(T_set)[:5]+'C on channel '+caget('XF:11IDB-ES{Env:01-Out:1}Out-Sel','char')+': '+str(dtime)[:5]+' minutes    current temperature: '+str(caget(ch[ch_num]))[:5]+'C')
-    print('hurray! temperature within 2x deadband! Going to check for stability....waiting max 1x wait_time to stabilize + 1x wait_time!')
-    check=0
-    period=0    
-    while check<10 and period<5:
-        if get_T_stability(wait_time,channel, dead_band) ==1:
-            period=period+1
-        elif get_T_stability(wait_time,channel, dead_band) ==0:
-            period=0
-        check=check+1
-    if period == 5:
+    mon=temperature_monitor
+    # predicted times to reach the setpoint, from a fit of the monitored temperatures:
+    prediction=mon.predict(channel,2*dead_band)
+    T_set=prediction['setpoint']
+    def estimate(prediction):
+        if prediction['reach'] is None:
+            return 'unknown (temperature not converging to the setpoint)'
+        return str(prediction['reach']/60.)[:5]+' minutes'
+    print(time.ctime()+ '   initial estimate to reach T='+str(T_set)[:5]+'C on channel '+prediction['channel']+': '+estimate(prediction))
+    # initial wait for reaching setpoint temperature, updated estimate when it should have been reached (or after max update_period)
+    near=lambda: abs(T_set-mon.temperature(mon.control(channel)))<=2*dead_band
+    while not mon.wait_for(near,timeout=min(max(prediction['reach'] or update_period,30),update_period)):
+        prediction=mon.predict(channel,2*dead_band)
+        print(time.ctime()+ '       updated estimate to reach T='+str(T_set)[:5]+'C on channel '+prediction['channel']+': '+estimate(prediction)+'    current temperature: '+str(prediction['temperature'])[:5]+'C')
+    print('hurray! temperature within 2x deadband! Going to check for stability....waiting max 2x wait_time!')
+    if mon.wait_stable(channel,dead_band,wait_time,timeout=2*wait_time):
         message=time.ctime()+'    achieved T='+str(T_set)+' +/- '+str(dead_band)+'C for '+str(wait_time)+'s'
-    elif period<5 and check==10:
-        message=time.ctime()+'    failed to achieve T='+str(T_set)+' +/- '+str(dead_band)+'C for '+str(wait_time)+'s, required stability achieved for ~'+str(period*wait_time/5)+'s only'
+    else:
+        message=time.ctime()+'    failed to achieve T='+str(T_set)+' +/- '+str(dead_band)+'C for '+str(wait_time)+'s, required stability achieved for ~'+str(int(mon.in_band_for(channel,dead_band)))+'s only'
     print(message)
     if log_entry=='on':
         olog_entry(message)
@@ -843,32 +1156,29 @@ def get_T_stability(wait_time,channel,dead_band):
     """
     checks whether the temperatures is within the deadband for 1/5 of the total waiting time
     -> yes: returns 1 | no: returns 0
+    returns as soon as this is known, from the monitored temperatures
     """
-    ch=['none','XF:11IDB-ES{Env:01-Chan:A}T:C-I','XF:11IDB-ES{Env:01-Chan:B}T:C-I','XF:11IDB-ES{Env:01-Chan:C}T:C-I','XF:11IDB-ES{Env:01-Chan:D}T:C-I']
-    ch_num=caget('XF:11IDB-ES{Env:01-Out:'+str(channel)+'}Out-Sel')    
-    temperatures=np.zeros(int(wait_time/5))
-    for i in range(int(wait_time/5)):
-        RE(sleep(1))
-        temperatures[i]=caget(ch[ch_num])-(caget('XF:11IDB-ES{Env:01-Out:'+str(channel)+'}T-SP') - 273.15)
-    if max(abs(temperatures))>dead_band:
-        T_stability_pass=0
-    elif max(abs(temperatures))<=dead_band:
+    mon=temperature_monitor
+    period=wait_time/5.
+    mon.wait_for(lambda: mon.in_band_for(channel,dead_band)==0 or mon.in_band_for(channel,dead_band)>=period,timeout=period)
+    if mon.in_band_for(channel,dead_band)>=period:
         T_stability_pass=1
+    else:
+        T_stability_pass=0
     return T_stability_pass
     
     
-def get_T_gradient(channel):
+def get_T_gradient(channel,min_span=60):
     """
     returns temperature gradient on control channel in deg.C/min
+    least-squares slope of the monitored temperatures (up to 20 min), waits until min_span seconds are recorded
+    (at most 2*min_span seconds, then uses whatever has been recorded: nan with less than 2 samples)
     """
-    ch=['none','XF:11IDB-ES{Env:01-Chan:A}T:C-I','XF:11IDB-ES{Env:01-Chan:B}T:C-I','XF:11IDB-ES{Env:01-Chan:C}T:C-I','XF:11IDB-ES{Env:01-Chan:D}T:C-I']
-    ch_num=caget('XF:11IDB-ES{Env:01-Out:'+str(channel)+'}Out-Sel')    
-    T1=caget(ch[ch_num])
-    t1=time.time()
-    RE(sleep(60))
-    T2=caget(ch[ch_num])
-    t2=time.time()
-    T_gradient=60*abs(T2-T1)/(t2-t1)
+    mon=temperature_monitor
+    mon.start()
+    history=lambda: mon.history[mon.control(channel)]
+    mon.wait_for(lambda: history().span()>=min_span,timeout=2*min_span)
+    T_gradient=abs(history().gradient())
     return T_gradient
 
 def olog_entry(string):
@@ -885,7 +1195,12 @@ def olog_entry(string):
 
 # begin test better function to check if beam is available for experiment + better recovery [Jan 2017]
 def check_ring():
-    if caget('SR-OPS{}Mode-Sts',1) == 'Operations' and caget('SR:C11-EPS{PLC:1}Sts:ID_BE_Enbl-Sts') ==1 and caget('SR:C03-BI{DCCT:1}I:Real-I') >180:
+    """
+    SR ring in operations, ID beam enabled and ring current above threshold?
+    -> 1 / 0, from the monitored signals and BEAM_THRESHOLDS (16-beam-suspenders.py)
+    note: plans pause by themselves on beam loss / cryo refill, through the suspenders installed at startup (install_beam_suspenders)
+    """
+    if all(beam_conditions(cryo=False).values()):
         ring_ok=1
         print('checking for SR ring status...seems ok')
     else:
@@ -894,47 +1209,79 @@ def check_ring():
     return ring_ok
 
 def wait_for_ring(wait_after=0):
+    """
+    wait until there is beam in the SR ring (returns as soon as the monitored conditions hold), then wait_after seconds
+    use install_beam_suspenders() to have the RunEngine pause and resume by itself instead
+    """
     ring_ok=check_ring()
     if ring_ok==0:
-        while ring_ok==0:
-            print('no beam in SR ring...checking again in 5 minutes.')
-            RE(sleep(300))
-            ring_ok=check_ring()
+        def report(conditions):
+            print(time.ctime()+'  no beam in SR ring ('+', '.join(name for name,ok in conditions.items() if not ok)+')...waiting.')
+        report(beam_conditions(cryo=False))
+        wait_for_beam(cryo=False,poll=300,message=report)
+        print(time.ctime()+'  beam is back in the SR ring.')
         RE(sleep(wait_after))
     if ring_ok==1: pass
 
-def check_bl():
+def _dbpm_feedback_ok(tolerance=.5):
+    # DBPM feedback on in X & Y, combined position error below tolerance
+    return (bpm2_feedback_selector_a.get()==1 and bpm2_feedback_selector_b.get()==1 and
+            abs(bpm_readings.x.get())+abs(bpm_readings.y.get())<tolerance)
+
+def check_bl(timeout=10.):
     """
     macro to check whether stable beam can be obtained on the DBPM
     opens all shutters, checks whether beam is blocked by diode
     checks for feedback stays on (-> enough intensity on DBPM)
     checks for feedback running (-> deviation of <.5um combined error in X & Y in slow readout)
+    each step waits (max. timeout s) for the monitored PVs instead of fixed sleeps, see recovery_report()
     """
     print('checking beamline for beam available...')
     #diode_IN() 
-    att2.set_T(0) 
-    fe_sh.open()
-    foe_sh.open()
-    fast_sh.open()
     current_T=att.get_T()
-    att.set_T(1)
-    time.sleep(2)
+    def open_shutters():
+        att2.set_T(0) 
+        fe_sh.open()
+        foe_sh.open()
+        fast_sh.open()
+        att.set_T(1)
+    def dbpm_feedback_on():
+        # as feedback_ON(): HDM epics feedback off, DBPM feedback on: B (Y) first, A (X) 2s later
+        hdm_feedback_selector.put(0)
+        bpm2_feedback_selector_b.put(1)
+        time.sleep(2)
+        bpm2_feedback_selector_a.put(1)
+    def cycle_feedback():
+        # as feedback_ON(): cycle the DBPM feedback if the beam is off center
+        # off (readback 0) for at least 1s, then B (Y) on and A (X) 2s later
+        bpm2_feedback_selector_a.put(0)
+        bpm2_feedback_selector_b.put(0)
+        for selector in [bpm2_feedback_selector_a,bpm2_feedback_selector_b]:
+            wait_for_signal(selector,lambda value: value==0,timeout=timeout)
+        time.sleep(1)
+        bpm2_feedback_selector_b.put(1)
+        time.sleep(2)
+        bpm2_feedback_selector_a.put(1)
 
     #expected_feedback_voltage_A=3.67    # Dont't drive the beamline into the wall!!!
     #expected_feedback_voltage_B=4.91
-
-    #if abs(caget('XF:11IDB-BI{XBPM:02}CtrlDAC:ALevel-I')-expected_feedback_voltage_A)>0.4:
-    #   print('Feedback voltage A seems wrong, setting it to '+str(expected_feedback_voltage_A))
-    #    caput('XF:11IDB-BI{XBPM:02}CtrlDAC:ALevel-SP',expected_feedback_voltage_A)
-    #if abs(caget('XF:11IDB-BI{XBPM:02}CtrlDAC:BLevel-I')-expected_feedback_voltage_B)>0.4:
-    #   print('Feedback voltage B seems wrong, setting it to '+str(expected_feedback_voltage_B))
-    #    caput('XF:11IDB-BI{XBPM:02}CtrlDAC:BLevel-SP',expected_feedback_voltage_B)
-    
-    time.sleep(2) 
-
-    RE(feedback_ON())
-    time.sleep(2)
-    if caget('XF:11IDB-BI{XBPM:02}Fdbk:BEn-SP')==1 and caget('XF:11IDB-BI{XBPM:02}Fdbk:AEn-SP')==1 and abs(caget('XF:11IDB-BI{XBPM:02}Pos:X-I'))+abs(caget('XF:11IDB-BI{XBPM:02}Pos:Y-I'))<.5:
+    feedback_signals=[bpm2_feedback_selector_a,bpm2_feedback_selector_b,bpm_readings.x,bpm_readings.y]
+    steps=[RecoveryStep('open shutters',open_shutters,
+                        lambda: fe_sh.open_status.get()==1 and foe_sh.open_status.get()==1 and fast_sh.get()==1,
+                        [fe_sh.open_status,foe_sh.open_status,fast_sh],timeout=timeout,
+                        success='DBPM feedback',failure='DBPM feedback'),
+           RecoveryStep('DBPM feedback',dbpm_feedback_on,_dbpm_feedback_ok,feedback_signals,
+                        timeout=timeout,hold=1.,success='beam on DBPM',failure='cycle DBPM feedback'),
+           RecoveryStep('cycle DBPM feedback',cycle_feedback,_dbpm_feedback_ok,feedback_signals,
+                        timeout=timeout,hold=1.,success='beam on DBPM',failure='no beam on DBPM'),
+           RecoveryStep('beam on DBPM'),
+           RecoveryStep('no beam on DBPM')]
+    try:
+        log=run_recovery(steps,'open shutters',name='check_bl')
+    finally:
+        att.set_T(current_T)
+        print('Setting back transmission to '+str(current_T))
+    if log.final=='beam on DBPM':
         bl_ok=1
         print('################################\n')
         print('checked beamline: beam on DBPM, all ok!')
@@ -942,65 +1289,75 @@ def check_bl():
         bl_ok=0
         print('################################\n')
         print('checked beamline: NO beam on DBPM, not ready for experiment....')
-    att.set_T(current_T)
-    print('Setting back transmission to '+str(current_T))
     return bl_ok
 
-def check_recover():
+def check_recover(timeout=10.):
+    """
+    check SR ring and beamline for beam available and try to recover if necessary
+    event-driven sequence of steps (17-beam-recovery.py): each step waits (max. timeout s)
+    for the monitored PVs instead of fixed sleeps; recovery_report() shows the timing of each step
+    """
     print('checking SR ring and BL for beam available and try to recover if necessary....')
-    ring_ok=check_ring()
-    if ring_ok==1:
-        pass
-    elif ring_ok==0:
-        print('looks like a beam loss in the SR ring...')
+    result={}
+    def olog(message):
+        print(message)
         try:
-            olog_client.log('looks like a beam loss in the SR ring...trying to recover')
-        except: pass    
-        wait_for_ring()
-    bl_ok=check_bl()
-    #bl_ok=check_bl() # let's check a second time ...?!
-    if bl_ok==1:
-        pass
-    elif bl_ok==0:
-        print('beam in SR, but not at DBPM...trying to recover...')
-        try:
-            olog_client.log('beam in SR, but not at DBPM...trying to recover...')
+            olog_client.log(message)
         except: pass    
+    def check_beamline():
+        result['bl_ok']=check_bl(timeout)
+    def hdm_feedback_on():
+        olog('beam in SR, but not at DBPM...trying to recover...')
         caput('XF:11IDB-BI{XBPM:02}Fdbk:AEn-SP',0)    # DBPM feedback off
         caput('XF:11IDB-BI{XBPM:02}Fdbk:BEn-SP',0)
         caput('XF:11IDA-OP{Mir:HDM-Ax:P}Sts:FB-Sel',1) # Epics feedback on HDM on
-        RE(sleep(8))
-        if abs(caget('XF:11IDA-OP{Mir:HDM-Ax:P}PID-SP')-caget('XF:11IDA-OP{Mir:HDM-Ax:P}Pos-I'))>.5:
-            print('Beam in Storage ring, but cannot recover at BL side...')
-            try:
-                olog_client.log('Beam in Storage ring, but cannot recover at BL side...possible problem wiht PID loop on SIEPA3P')
-            except: pass    
-            raise check_Exception('error: looks like the PID loop on SIEPA3P is NOT running, abort recovery attempt')
-        else: pass
+    def dbpm_feedback_b():
         caput('XF:11IDB-BI{XBPM:02}CtrlDAC:BLevel-SP',caget('XF:11IDB-BI{XBPM:02}CtrlDAC:BLevel-SP')) 
                 # enforce last known (good) DAC outputs
         caput('XF:11IDB-BI{XBPM:02}CtrlDAC:ALevel-SP',caget('XF:11IDB-BI{XBPM:02}CtrlDAC:ALevel-SP'))
         caput('XF:11IDB-BI{XBPM:02}Fdbk:BEn-SP',1)
-        RE(sleep(10))
+    def dbpm_feedback_a():
         caput('XF:11IDA-OP{Mir:HDM-Ax:P}Sts:FB-Sel',0)
         caput('XF:11IDB-BI{XBPM:02}Fdbk:AEn-SP',1)            # back to feedback on DBPM
-        RE(sleep(10))
-        bl_ok=check_bl()
-        if bl_ok==0:
-            feedback_ON()    # one last chance...
-        else: pass
-        bl_ok=check_bl()
-        if bl_ok==1:
-            print('Successfully recovered! Hurray!')
-            try:
-                olog_client.log('Successfully recoverd beam loss. Check data for impact of possible non-ideal alignment.')
-            except: 
-                pass    
-        elif bl_ok==0:
-            try:
-                olog_client.log('Beam in Storage ring, but cannot recover at BL side...abort recovery attempt')
-            except: pass    
-            raise check_Exception('error: could not recover beam on BL side...abort!')
+    def last_chance():
+        RE(feedback_ON())    # one last chance...
+        check_beamline()
+    def recovered():
+        print('Successfully recovered! Hurray!')
+        try:
+            olog_client.log('Successfully recoverd beam loss. Check data for impact of possible non-ideal alignment.')
+        except: 
+            pass    
+    def pid_not_running():
+        olog('Beam in Storage ring, but cannot recover at BL side...possible problem wiht PID loop on SIEPA3P')
+        raise check_Exception('error: looks like the PID loop on SIEPA3P is NOT running, abort recovery attempt')
+    def not_recovered():
+        olog('Beam in Storage ring, but cannot recover at BL side...abort recovery attempt')
+        raise check_Exception('error: could not recover beam on BL side...abort!')
+    ring_signals=[ring_mode,id_beam_enabled,ring_current]
+    ring_ok=lambda: all(beam_conditions(cryo=False).values())
+    bl_ok=lambda: result.get('bl_ok')==1
+    steps=[RecoveryStep('check ring',None,ring_ok,timeout=0,success='check beamline',failure='wait for ring'),
+           RecoveryStep('wait for ring',lambda: olog('looks like a beam loss in the SR ring...trying to recover'),
+                        ring_ok,ring_signals,timeout=None,success='check beamline'),
+           RecoveryStep('check beamline',check_beamline,bl_ok,timeout=0,success='beam ok',failure='HDM feedback'),
+           RecoveryStep('HDM feedback',hdm_feedback_on,
+                        lambda: abs(hdm_pid_setpoint.get()-hdm_pitch.get())<=.5,[hdm_pid_setpoint,hdm_pitch],
+                        timeout=timeout,hold=1.,success='DBPM feedback B',failure='PID loop not running'),
+           RecoveryStep('DBPM feedback B',dbpm_feedback_b,
+                        lambda: bpm2_feedback_selector_b.get()==1 and abs(bpm_readings.y.get())<.5,
+                        [bpm2_feedback_selector_b,bpm_readings.y],timeout=timeout,hold=1.,
+                        success='DBPM feedback A',failure='DBPM feedback A'),
+           RecoveryStep('DBPM feedback A',dbpm_feedback_a,_dbpm_feedback_ok,
+                        [bpm2_feedback_selector_a,bpm2_feedback_selector_b,bpm_readings.x,bpm_readings.y],
+                        timeout=timeout,hold=1.,success='check beamline again',failure='check beamline again'),
+           RecoveryStep('check beamline again',check_beamline,bl_ok,timeout=0,success='recovered',failure='last chance'),
+           RecoveryStep('last chance',last_chance,bl_ok,timeout=0,success='recovered',failure='not recovered'),
+           RecoveryStep('beam ok'),
+           RecoveryStep('recovered',recovered),
+           RecoveryStep('PID loop not running',pid_not_running),
+           RecoveryStep('not recovered',not_recovered)]
+    run_recovery(steps,'check ring',name='check_recover')
 
     
 class check_Exception(Exception):
@@ -1011,11 +1368,12 @@ class check_Exception(Exception):
 
 # end test better function to check if beam is available for experiment + better recovery
 
-def check_cryo(level_threshold=55.):
+def check_cryo(level_threshold=55.,open_timeout=30.):
     """
     checking whether cryo-cooler refill is in progress or initiating refill, if current level is below threshold.
     waits for refill to be completed and reports current filling level
-    calling sequence: check_cryo(level_threshold=55.)
+    open_timeout: [s] max. time for the refill valve to open after the refill has been requested
+    calling sequence: check_cryo(level_threshold=55.,open_timeout=30.)
     """
     if caget('XF:11IDA-UT{Cryo:1}L:19-I')<level_threshold or caget('XF:11IDA-UT{Cryo:1-IV:19}Pos-I') >10.:
         if caget('XF:11IDA-UT{Cryo:1-IV:19}Pos-I') >10.:
@@ -1024,15 +1382,15 @@ def check_cryo(level_threshold=55.):
             print('cryo-cooler level: '+ str(caget('XF:11IDA-UT{Cryo:1}L:19-I'))[:5]+'% -> going to refill cryo_cooler')
         else: pass
         caput('XF:11IDA-UT{Cryo:1-IV:19}Pos-SP',100)
-        refill_on=1
-        #print('cryo-cooler level: '+ str(caget('XF:11IDA-UT{Cryo:1}L:19-I'))+'-> going to refill cryo_cooler')
-        while refill_on==1:
-            RE(sleep(60))
-            if caget('XF:11IDA-UT{Cryo:1-IV:19}Pos-I') >10.:
-                print('cryo-cooler refill in progress, filling level: '+str(caget('XF:11IDA-UT{Cryo:1}L:19-I'))[:5])
-            elif caget('XF:11IDA-UT{Cryo:1-IV:19}Pos-I') <10.:
-                print('cryo-cooler refill complete!')
-                refill_on=0
+        # the valve readback only follows the setpoint after a while: wait for the refill to start first...
+        if not wait_for_signal(cryo_refill_valve,lambda value: value>BEAM_THRESHOLDS['cryo_refill_valve'],timeout=open_timeout):
+            print('cryo-cooler refill valve did not open within '+str(open_timeout)+'s, filling level: '+str(cryo_level.get())[:5]+'%')
+            return
+        # ...then for the refill valve to close (monitored), reporting the filling level every minute
+        def report(conditions):
+            print('cryo-cooler refill in progress, filling level: '+str(cryo_level.get())[:5])
+        wait_for_beam(cryo=True,ring=False,poll=60,message=report)
+        print('cryo-cooler refill complete!')
     else:
         print('cryo-cooler level: '+ str(caget('XF:11IDA-UT{Cryo:1}L:19-I'))[:5]+'-> no refill at this time')
 
@@ -1100,46 +1458,81 @@ def WAXS_rot_setup():
     x2_velocity=np.array([3.669,3.669,3.669,3.67,3.671,3.672,3.672,3.673,3.674,3.674,3.675,3.675,3.675,3.676,3.676,3.676,3.677,3.677,3.677,3.677,3.677,3.677,3.677,3.677,3.677,3.677,3.676,3.676,3.676,3.675,3.675,3.675,3.674,3.674,3.673,3.672,3.672,3.671,3.67,3.669,3.669,3.668,3.667,3.666,3.665,3.664,3.663,3.661,3.66,3.659,3.658,3.656,3.655,3.653,3.652,3.651,3.649,3.647,3.646,3.644,3.642,3.64,3.639,3.637,3.635,3.633,3.631,3.629,3.627,3.625,3.622,3.62,3.618,3.616,3.613,3.611,3.608,3.606,3.603,3.601,3.598,3.595,3.593,3.59,3.587,3.584])
     return [WAXS_angle,x1_pos,x2_pos,x2_velocity]
 
+CubicSpline = lazy_from('scipy.interpolate', 'CubicSpline')
+
+class WAXSTrajectory:
+    '''
+    smooth (cubic spline) X1 and X2 positions vs. WAXS rotation angle, from the WAXS_rot_setup() look-up table
+    built once, see WAXS_trajectory()
+    '''
+    def __init__(self):
+        [WAXS_angle,x1_pos,x2_pos,x2_velocity]=WAXS_rot_setup()
+        self.angles=np.array(WAXS_angle)
+        self.x1=CubicSpline(self.angles,x1_pos)
+        self.x2=CubicSpline(self.angles,x2_pos)
+        self.angle_from_x1=CubicSpline(x1_pos,self.angles)
+        self.angle_from_x2=CubicSpline(x2_pos,self.angles)
+
+    def profile(self,angle_from,angle_to,x1_velocity,step=.5):
+        '''
+        time-parameterised move from angle_from to angle_to with X1 at x1_velocity [mm/s]
+        returns breakpoint angles, times [s], X1 and X2 positions and the X2 velocity of each segment (len-1)
+        '''
+        n=max(int(np.ceil(abs(angle_to-angle_from)/step)),1)
+        angles=np.linspace(angle_from,angle_to,n+1)
+        x1=self.x1(angles)
+        x2=self.x2(angles)
+        times=np.concatenate([[0],np.cumsum(abs(np.diff(x1)))/x1_velocity])
+        x2_velocity=abs(np.diff(x2))/np.diff(times)
+        return angles,times,x1,x2,x2_velocity
+
+_WAXS_trajectory=None
+
+def WAXS_trajectory():
+    '''
+    WAXSTrajectory for the current look-up table (computed on first use)
+    '''
+    global _WAXS_trajectory
+    if _WAXS_trajectory is None:
+        _WAXS_trajectory=WAXSTrajectory()
+    return _WAXS_trajectory
+
 def WAXS_rot_pos():
     '''
     calculates current rotation angle for SAXS table's WAXS section from X1 and X2 positions via a look-up table
     '''
-    [WAXS_angle,x1_pos,x2_pos,x2_velocity]=WAXS_rot_setup()
-    WAXS_angle=np.array(WAXS_angle)
-    x1_pos=np.array(x1_pos)
-    x2_pos=np.array(x2_pos)
-    x2_velocity=np.array(x2_velocity)
+    trajectory=WAXS_trajectory()
     ### WAXS angle according to X1:    
     if SAXS_x1.position >415.09 or SAXS_x1.position <=-.2:
         raise rotation_exception('error: position of X1 is out of range')    
     elif SAXS_x1.position <0:
         WAXS_angle_x1=0
     elif SAXS_x1.position <415.09 and SAXS_x1.position >=0:
-        WAXS_angle_x1 = np.interp(SAXS_x1.position,x1_pos,WAXS_angle)
+        WAXS_angle_x1 = float(trajectory.angle_from_x1(SAXS_x1.position))
     ### WAXS angle according to X2:    
     if SAXS_x2.position >1516.06 or SAXS_x1.position <=-.2:
         raise rotation_exception('error: position of X2 is out of range')    
     elif SAXS_x2.position <0:
         WAXS_angle_x2=0
     elif SAXS_x2.position <1516.06 and SAXS_x2.position >=0:
-        WAXS_angle_x2 = np.interp(SAXS_x2.position,x2_pos,WAXS_angle)
+        WAXS_angle_x2 = float(trajectory.angle_from_x2(SAXS_x2.position))
     curr_WAXS_angle=0.5*(WAXS_angle_x1+WAXS_angle_x2)
     print('WAXS rotation according to X1: '+str(WAXS_angle_x1)+'  WAXS rotation according to X2: '+str(WAXS_angle_x2)+'  -> WAXS rotation: ~'+str(curr_WAXS_angle))
     return curr_WAXS_angle
 
-def WAXS_rotation(angle):
+def WAXS_rotation(angle,continuous=True,step=.5,max_error=1.):
     '''
-    moves SAXS table's WAXS section to desired rotation angle in 2 deg steps, using lookup table for positions and X2 velocity
+    moves SAXS table's WAXS section to desired rotation angle, using a spline of the lookup table for positions and X2 velocity
     WAXS_rotation(angle) -> angle [deg.]
+    continuous=True: one continuous move of X1 (at its current velocity); the X2 velocity follows the planned profile
+                     (segments of step [deg.]), switched from the monitored X1 position
+                     both axes are stopped if X2 is off the trajectory by more than max_error [mm]
+    continuous=False: previous behavior, moving in 1 deg steps
     '''
     max_angle=14.1 #hard coded limit for current setup    
-    [WAXS_angle,x1_pos,x2_pos,x2_velocity]=WAXS_rot_setup()
-    WAXS_angle=np.array(WAXS_angle)
-    x1_pos=np.array(x1_pos)
-    x2_pos=np.array(x2_pos)
-    x2_velocity=np.array(x2_velocity)
     if angle <0 or angle>max_angle:
         raise rotation_exception('error: requested rotation angle out of range')
+    trajectory=WAXS_trajectory()
     curr_WAXS_angle=WAXS_rot_pos()
     #curr_WAXS_angle=7.9 ### fake for test
     if angle >= curr_WAXS_angle:
@@ -1147,24 +1540,67 @@ def WAXS_rotation(angle):
     elif angle < curr_WAXS_angle:
         direction=-1
     print('going to move WAXS section from '+str(curr_WAXS_angle)+' to: '+str(angle))
-    while abs(angle - curr_WAXS_angle) > 1:        # moving in 1 deg steps
-        curr_velocity= np.interp((curr_WAXS_angle+direction*.5),WAXS_angle,x2_velocity)
-        curr_X1=np.interp((curr_WAXS_angle+direction*1),WAXS_angle,x1_pos)
-        curr_X2=np.interp((curr_WAXS_angle+direction*1),WAXS_angle,x2_pos)
-        print('moving to: '+str(curr_WAXS_angle+direction*1)+' setting X2 velocity to '+str(curr_velocity)+'  X1 -> '+str(curr_X1)+'  X2 -> '+str(curr_X2))
-        # need to do the actual moves here:
-        SAXS_x2.velocity.value=curr_velocity
-        mov([SAXS_x1,SAXS_x2],[curr_X1,curr_X2])
-        curr_WAXS_angle=WAXS_rot_pos()        # the real thing...
-        #curr_WAXS_angle=curr_WAXS_angle+direction*1 #faking move for testing
-    # moving the balance:
-    if abs(angle - curr_WAXS_angle) <1.2:
-        curr_X1=np.interp(angle,WAXS_angle,x1_pos)
-        curr_X2=np.interp(angle,WAXS_angle,x2_pos)
-        print('moving to: '+str(angle)+'  X1 -> '+str(curr_X1)+'  X2 -> '+str(curr_X2))    
-        # need to do the actual move here:
-        mov([SAXS_x1,SAXS_x2],[curr_X1,curr_X2])
-    else: raise rotation_exception('error: discrepancy from where the rotation is expected to be....')
+    if abs(angle - curr_WAXS_angle) < .001:
+        return
+    if not continuous:
+        while abs(angle - curr_WAXS_angle) > 1:        # moving in 1 deg steps
+            angles,times,x1,x2,x2_velocity=trajectory.profile(curr_WAXS_angle,curr_WAXS_angle+direction*1,1.,step=1)
+            print('moving to: '+str(angles[-1])+' setting X2 velocity to '+str(x2_velocity[0])+'  X1 -> '+str(x1[-1])+'  X2 -> '+str(x2[-1]))
+            SAXS_x2.velocity.value=x2_velocity[0]
+            mov([SAXS_x1,SAXS_x2],[x1[-1],x2[-1]])
+            curr_WAXS_angle=WAXS_rot_pos()        # the real thing...
+        # moving the balance:
+        if abs(angle - curr_WAXS_angle) <1.2:
+            curr_X1=float(trajectory.x1(angle))
+            curr_X2=float(trajectory.x2(angle))
+            print('moving to: '+str(angle)+'  X1 -> '+str(curr_X1)+'  X2 -> '+str(curr_X2))    
+            mov([SAXS_x1,SAXS_x2],[curr_X1,curr_X2])
+        else: raise rotation_exception('error: discrepancy from where the rotation is expected to be....')
+        return
+
+    x1_velocity=SAXS_x1.velocity.get()
+    x2_velocity_before=SAXS_x2.velocity.get()
+    angles,times,x1,x2,x2_velocity=trajectory.profile(curr_WAXS_angle,angle,x1_velocity,step=step)
+    print('continuous move: '+str(len(x2_velocity))+' segments, X1 -> '+str(x1[-1])+' @ '+str(x1_velocity)+'mm/s  X2 -> '+str(x2[-1])+' @ '+str(x2_velocity.min())[:5]+'-'+str(x2_velocity.max())[:5]+'mm/s, expected duration: '+str(times[-1])[:6]+'s')
+    update=threading.Event()
+    cid=SAXS_x1.user_readback.subscribe(lambda **kwargs: update.set(),run=False)
+    segment=0
+    error=0.
+    t0=time.time()
+    status=[]
+    try:
+        SAXS_x2.velocity.put(x2_velocity[0],wait=True)
+        status=[SAXS_x1.set(x1[-1]),SAXS_x2.set(x2[-1])]
+        while not all(st.done for st in status):
+            update.wait(.5)
+            update.clear()
+            # segment and expected X2 position from the monitored X1 position
+            curr_angle=float(trajectory.angle_from_x1(SAXS_x1.user_readback.get()))
+            progress=(curr_angle-angles[0])*direction
+            new_segment=min(int(np.searchsorted((angles-angles[0])*direction,progress,side='right'))-1,len(x2_velocity)-1)
+            if new_segment>segment:
+                segment=new_segment
+                SAXS_x2.velocity.put(x2_velocity[segment])
+                SAXS_x2.user_setpoint.put(x2[-1])     # re-issue the target, so the new velocity applies
+            error=max(error,abs(SAXS_x2.user_readback.get()-float(trajectory.x2(curr_angle))))
+            if error>max_error:
+                raise rotation_exception('error: X2 off the trajectory by '+str(error)[:5]+'mm, stopped X1 and X2 at WAXS rotation ~'+str(curr_angle)[:6])
+    except BaseException:   # also on Ctrl-C: never leave one axis running
+        SAXS_x1.stop()
+        SAXS_x2.stop()
+        raise
+    finally:
+        SAXS_x1.user_readback.unsubscribe(cid)
+        # restore the X2 velocity only once both axes have stopped, it would apply to the running move otherwise
+        for st in status:
+            try:
+                status_wait(st,timeout=30)
+            except Exception:   # stopped / failed move: done anyway
+                pass
+        SAXS_x2.velocity.put(x2_velocity_before)
+    print('WAXS rotation done in '+str(time.time()-t0)[:6]+'s, max. deviation of X2 from the trajectory: '+str(error)[:5]+'mm')
+    if abs(WAXS_rot_pos()-angle)>.2:
+        raise rotation_exception('error: discrepancy from where the rotation is expected to be....')
 
 
 class rotation_exception(Exception):
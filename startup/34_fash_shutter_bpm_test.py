@@ -36,7 +36,7 @@ plot_data_with_linfit( t,y )
 
     
 """
-from scipy.optimize import leastsq
+leastsq = lazy_from('scipy.optimize', 'leastsq')
 
 #plot_dict(d, xlim=None, ylim=[-9, 1], keys=['9.0_ms','10.0_ms','20.0_ms','30.0_ms','40.0_ms', '50.0_ms','60.0_ms','70.0_ms','80.0_ms','90.0_ms'],xlabel='data points', ylabel='intensity', title='XBPM Read ~Fast Shutter Test')
  
@@ -3,9 +3,11 @@ import readline
 from collections import defaultdict
 import queue
 import threading
-from pyOlog import SimpleOlogClient
 
-olog_client = SimpleOlogClient()
+# pyOlog, jinja2 and the olog clients are only loaded when something gets
+# logged (00-lazy-imports.py)
+SimpleOlogClient = lazy_from('pyOlog', 'SimpleOlogClient')
+olog_client = lazy_object(SimpleOlogClient)
 
 
 
@@ -84,20 +86,24 @@ TEMPLATES['dscan'] = single_motor_template
 TEMPLATES['ascan'] = single_motor_template
 TEMPLATES['ID_calibration'] = single_motor_template
 
-from jinja2 import Template
+Template = lazy_from('jinja2', 'Template')
 
 
 # connect olog
 from functools import partial
-from pyOlog import SimpleOlogClient
 
 
 # Set up the logbook. This configures bluesky's summaries of
 # data acquisition (scan type, ID, etc.).
 
 LOGBOOKS = ['Data Acquisition']  # list of logbook names to publish to
-simple_olog_client = SimpleOlogClient()
-generic_logbook_func = simple_olog_client.log
+simple_olog_client = lazy_object(SimpleOlogClient)
+
+
+def generic_logbook_func(*args, **kwargs):
+    return simple_olog_client.log(*args, **kwargs)
+
+
 configured_logbook_func = partial(generic_logbook_func, logbooks=LOGBOOKS)
 
 # This is for ophyd.commands.get_logbook, which simply looks for
@@ -105,7 +111,9 @@ configured_logbook_func = partial(generic_logbook_func, logbooks=LOGBOOKS)
 logbook = simple_olog_client
 
 
-logbook_cb = logbook_cb_factory(configured_logbook_func, desc_dispatch=TEMPLATES)
+# built (importing jinja2) by the olog thread, on the first start document
+logbook_cb = lazy_object(logbook_cb_factory, configured_logbook_func,
+                         desc_dispatch=TEMPLATES)
 
 def submit_to_olog(queue, cb):
     while True:
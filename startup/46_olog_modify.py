@@ -1,6 +1,8 @@
-from pyOlog import LogEntry,  Attachment,OlogClient
-from pyOlog import SimpleOlogClient
-from pyOlog.OlogDataTypes import  Logbook
+LogEntry = lazy_from('pyOlog', 'LogEntry')
+Attachment = lazy_from('pyOlog', 'Attachment')
+OlogClient = lazy_from('pyOlog', 'OlogClient')
+SimpleOlogClient = lazy_from('pyOlog', 'SimpleOlogClient')
+Logbook = lazy_from('pyOlog.OlogDataTypes', 'Logbook')
 
 #from epics import caput, caget
 
@@ -29,6 +29,8 @@ RE.md_validator = lambda x: x # the default
 
 temp_C = EpicsSignal('XF:11IDB-ES{Env:01-Chan:C}T:C-I', name='temp_C')
 sd.baseline = [diff, s1, s2, s4, saxs_bst, temp_C]
+if _beam_suspenders:  # keep the beam losses in the baseline, see 16-beam-suspenders.py
+    sd.baseline.append(beam_availability)
 #sd.monitors = []
 
 #bec.disable_baseline()  # Do not show baseline.
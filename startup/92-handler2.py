@@ -1,50 +1,408 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import os
+import time
+import warnings
+import weakref
 import numpy as np
-import h5py
+h5py = lazy_import('h5py')  # see 00-lazy-imports.py
 from pims import FramesSequence, Frame
 
+# Optional codecs for reading raw Eiger chunks without the HDF5 filter
+# pipeline (see EigerImages2.workers). Without them we use the filters.
+try:
+    import bitshuffle
+except ImportError:
+    bitshuffle = None
+try:
+    import lz4.block
+except ImportError:
+    lz4 = None
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+
+def _decode_bslz4(buf, shape, dtype):
+    # bitshuffle filter (32008) chunk: uncompressed size (uint64 BE),
+    # block size in bytes (uint32 BE), then the compressed blocks
+    block_size = int.from_bytes(buf[8:12], 'big') // dtype.itemsize
+    data = np.frombuffer(buf, dtype=np.uint8, offset=12)
+    return bitshuffle.decompress_lz4(data, shape, dtype, block_size)
+
+
+def _decode_lz4(buf, shape, dtype):
+    # LZ4 filter (32004) chunk: uncompressed size (uint64 BE), block size
+    # (uint32 BE), then (compressed size (uint32 BE), block) pairs. Blocks
+    # that did not compress are stored as they are.
+    total = int.from_bytes(buf[:8], 'big')
+    block_size = int.from_bytes(buf[8:12], 'big')
+    out = np.empty(total, dtype=np.uint8)
+    pos, filled = 12, 0
+    while filled < total:
+        nbytes = int.from_bytes(buf[pos:pos + 4], 'big')
+        pos += 4
+        size = min(block_size, total - filled)
+        block = buf[pos:pos + nbytes]
+        if nbytes != size:
+            block = lz4.block.decompress(block, uncompressed_size=size)
+        out[filled:filled + size] = np.frombuffer(block, dtype=np.uint8)
+        pos += nbytes
+        filled += size
+    return out.view(dtype).reshape(shape)
+
+
+def _chunk_codec(dataset):
+    """
+    Return a function decoding one raw chunk of dataset, or None when the
+    chunk layout or compression codec is not one we can handle ourselves.
+    """
+    if dataset.chunks is None or dataset.chunks[1:] != dataset.shape[1:]:
+        return None  # we only handle chunks of whole frames
+    dcpl = dataset.id.get_create_plist()
+    if dcpl.get_nfilters() != 1:
+        return None
+    code, flags, values, name = dcpl.get_filter(0)
+    if code == 32008 and bitshuffle is not None:
+        if len(values) > 4 and values[4] == 2:  # bitshuffle + LZ4
+            return _decode_bslz4
+    elif code == 32004 and lz4 is not None:
+        return _decode_lz4
+    return None
+
+
+class _DataFileWatcher:
+    """
+    Wait for new files in the directory the detector writes to.
+
+    backend='poll' simply sleeps for poll_interval; backend='inotify'
+    wakes up as soon as a file is written or moved into the directory
+    (needs the optional inotify_simple package, else we poll).
+    """
+    def __init__(self, directory, backend='poll', poll_interval=1.):
+        self.poll_interval = poll_interval
+        self._inotify = None
+        if backend == 'inotify':
+            if inotify_simple is None:
+                warnings.warn('inotify_simple is not installed, '
+                              'falling back to polling')
+            else:
+                flags = inotify_simple.flags
+                self._inotify = inotify_simple.INotify()
+                self._inotify.add_watch(
+                    directory,
+                    flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE)
+        elif backend != 'poll':
+            raise ValueError("backend must be 'poll' or 'inotify'")
+
+    def wait(self, timeout):
+        timeout = max(0., min(timeout, self.poll_interval))
+        if self._inotify is None:
+            time.sleep(timeout)
+        else:
+            self._inotify.read(timeout=int(1000 * timeout))
+
+    def close(self):
+        if self._inotify is not None:
+            self._inotify.close()
+
 
 class EigerImages2(FramesSequence):
-    def __init__(self, master_filepath, images_per_file, *, md=None):
+    # Decompressed blocks of frames are kept in an LRU cache, so walking a
+    # series several times (or hopping around inside one data file) does
+    # not decompress the same HDF5 chunks over and over again.
+    cache_bytes = 1024 * 1024**2   # default budget per sequence: 1 GB
+    # With workers > 0, get_frames() fetches the compressed chunks directly
+    # and decompresses them in a pool of that many threads. Data files with
+    # an unknown codec are still read through the HDF5 filter pipeline.
+    workers = 0
+
+    def __init__(self, master_filepath, images_per_file, *, md=None,
+                 cache_bytes=None, workers=None):
         self._md = md
         self.master_filepath = master_filepath
         self.images_per_file = images_per_file
+        if cache_bytes is not None:
+            self.cache_bytes = cache_bytes
+        if workers is not None:
+            self.workers = workers
+        self._codecs = {}  # data key -> chunk decoder (or None)
+        self._block_cache = OrderedDict()  # (data key, block index) -> ndarray
+        self._cached_bytes = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
         self._handle = h5py.File(master_filepath, 'r')
         try:
             self._entry = self._handle['entry']['data']  # Eiger firmware v1.3.0 and onwards
         except KeyError:
             self._entry = self._handle['entry']          # Older firmwares
+        self._num_links = None  # layout (keys, length, shape) is read lazily
 
     @property
     def md(self):
         return self._md
 
-    @property
-    def valid_keys(self):
+    def refresh(self):
+        """
+        Re-read the layout of the series from the master file.
+
+        Dereferencing every external link is expensive (one open per data
+        file, painful over NFS), so the valid keys, frame count, frame shape
+        and dtype are computed once and only re-read when the number of
+        links in the master file changes, when a link that led nowhere
+        (data file not written yet) resolves, or when refresh() is called.
+        """
         valid_keys = []
+        unresolved = []
+        frame_counts = []
+        frame_shape, pixel_type = None, None
         for key in sorted(self._entry.keys()):
             try:
-                self._entry[key]
+                dataset = self._entry[key]
             except KeyError:
-                pass  # This is a link that leads nowhere.
-            else:
-                valid_keys.append(key)
-        return valid_keys
+                unresolved.append(key)
+                continue  # This is a link that leads nowhere.
+            valid_keys.append(key)
+            if isinstance(dataset, h5py.Dataset):
+                frame_counts.append(dataset.shape[0])
+                if frame_shape is None:
+                    frame_shape, pixel_type = dataset.shape[1:], dataset.dtype
+        self._valid_keys = tuple(valid_keys)
+        self._frame_counts = np.array(frame_counts, dtype=np.int64)
+        self._len = int(self._frame_counts.sum())
+        self._frame_shape = frame_shape
+        self._pixel_type = pixel_type
+        self._num_links = len(self._entry)
+        self._unresolved = tuple(unresolved)
+
+    def _check_layout(self):
+        # len(group) is a single H5Gget_info call: it does not follow links.
+        if self._num_links != len(self._entry):
+            self.refresh()
+            return
+        # The master file links all the data files as soon as it is
+        # written, before they exist: only retry the links that led nowhere.
+        for key in self._unresolved:
+            try:
+                self._entry[key]
+            except (KeyError, OSError):
+                continue
+            self.refresh()
+            return
+
+    @property
+    def valid_keys(self):
+        self._check_layout()
+        return list(self._valid_keys)
 
     def get_frame(self, i):
-        dataset = self._entry['data_{:06d}'.format(1 + (i // self.images_per_file))]
-        img = dataset[i % self.images_per_file]
+        key = 'data_{:06d}'.format(1 + (i // self.images_per_file))
+        j = i % self.images_per_file
+        dataset = self._entry[key]
+        frames_per_block = self._frames_per_block(dataset)
+        block = self._get_block(key, dataset, j // frames_per_block,
+                                frames_per_block)
+        img = block[j % frames_per_block].copy()
         return Frame(img, frame_no=i)
 
+    @staticmethod
+    def _frames_per_block(dataset):
+        # One block is one HDF5 chunk along the frame axis: this is the
+        # smallest unit the filter pipeline can decompress anyway.
+        if dataset.chunks is None:
+            return 1
+        return dataset.chunks[0]
+
+    def _get_block(self, key, dataset, block_index, frames_per_block):
+        cache_key = (key, block_index)
+        try:
+            block = self._block_cache[cache_key]
+        except KeyError:
+            pass
+        else:
+            self._block_cache.move_to_end(cache_key)
+            self.cache_hits += 1
+            return block
+        self.cache_misses += 1
+        start = block_index * frames_per_block
+        block = dataset[start:start + frames_per_block]
+        block.flags.writeable = False
+        if block.nbytes <= self.cache_bytes:
+            self._block_cache[cache_key] = block
+            self._cached_bytes += block.nbytes
+            while self._cached_bytes > self.cache_bytes:
+                _, old = self._block_cache.popitem(last=False)
+                self._cached_bytes -= old.nbytes
+        return block
+
+    def get_frames(self, start=0, stop=None, step=1):
+        """
+        Read a range of frames into one contiguous (N, y, x) array.
+
+        Every data_NNNNNN file spanned by the range is read with a single
+        hyperslab selection straight into the preallocated output, instead
+        of one selection (and one Frame) per image.
+        start can also be a slice: seq.get_frames(slice(0, 1000, 2))
+        """
+        return self._read_frames(start, stop, step)
+
+    def _read_frames(self, start, stop, step, region=(slice(None),) * 2):
+        "get_frames(), restricted to a (rows, columns) region of the frames"
+        if isinstance(start, slice):
+            start, stop, step = start.start, start.stop, start.step
+        start, stop, step = slice(start, stop, step).indices(len(self))
+        if step < 1:
+            raise ValueError('get_frames only supports positive steps')
+        indices = range(start, stop, step)
+        region_shape = tuple(len(range(*r.indices(size)))
+                             for r, size in zip(region, self.frame_shape))
+        out = np.empty((len(indices),) + region_shape, dtype=self.pixel_type)
+        chunk_reads = []
+        n = 0
+        while n < len(indices):
+            i = indices[n]
+            file_index = i // self.images_per_file
+            file_stop = (file_index + 1) * self.images_per_file
+            count = len(range(i, min(stop, file_stop), step))
+            key = 'data_{:06d}'.format(1 + file_index)
+            dataset = self._entry[key]
+            j = i - file_index * self.images_per_file
+            codec = self._codec(key, dataset) if self.workers else None
+            if codec is None:
+                dataset.read_direct(
+                    out, (slice(j, j + (count - 1) * step + 1, step),) + region,
+                    np.s_[n:n + count])
+            else:
+                chunk_reads.extend(
+                    self._chunk_reads(dataset, codec, j, count, step, n))
+            n += count
+        if chunk_reads:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                # list() re-raises any exception from the workers
+                list(pool.map(lambda args: self._read_chunk(out, region, *args),
+                              chunk_reads))
+        return out
+
+    def _codec(self, key, dataset):
+        try:
+            return self._codecs[key]
+        except KeyError:
+            codec = self._codecs[key] = _chunk_codec(dataset)
+            return codec
+
+    @staticmethod
+    def _chunk_reads(dataset, codec, j, count, step, n):
+        "Split frames j, j + step, ... of dataset into one read per chunk."
+        frames_per_chunk = dataset.chunks[0]
+        last = j + (count - 1) * step
+        k = 0
+        while k < count:
+            first = j + k * step
+            chunk_start = first // frames_per_chunk * frames_per_chunk
+            chunk_stop = min(chunk_start + frames_per_chunk, last + 1)
+            in_chunk = len(range(first, chunk_stop, step))
+            src = slice(first - chunk_start, chunk_stop - chunk_start, step)
+            yield (dataset, codec, chunk_start, src,
+                   slice(n + k, n + k + in_chunk))
+            k += in_chunk
+
+    @staticmethod
+    def _read_chunk(out, region, dataset, codec, chunk_start, src, dest):
+        offset = (chunk_start,) + (0,) * (dataset.ndim - 1)
+        filter_mask, buf = dataset.id.read_direct_chunk(offset)
+        if filter_mask:
+            # the filter was skipped when this chunk was written
+            chunk = np.frombuffer(buf, dtype=dataset.dtype)
+            chunk = chunk.reshape(dataset.chunks)
+        else:
+            chunk = codec(buf, dataset.chunks, dataset.dtype)
+        out[dest] = chunk[(src,) + region]
+
+    def expected_length(self):
+        """
+        Number of frames the detector was asked for (nimages x ntrigger),
+        or None if the master file does not say.
+        """
+        try:
+            specific = self._handle['entry/instrument/detector/detectorSpecific']
+            return int(specific['nimages'][()]) * int(specific['ntrigger'][()])
+        except KeyError:
+            return None
+
+    def _frames_written(self, key):
+        try:
+            return self._entry[key].shape[0]
+        except (KeyError, OSError):
+            return 0  # not there yet, or still being written
+
+    def follow(self, start=0, *, timeout=60., poll_interval=1.,
+               backend='poll'):
+        """
+        Yield frames as the data files of the series appear on disk.
+
+        Use this on a series that is still being acquired (e.g. right after
+        the event saved early by xpcs_count): frames are yielded as soon as
+        the data file holding them can be read, until the expected number of
+        frames has been seen. TimeoutError is raised when no new data
+        showed up for `timeout` seconds.
+        backend: 'poll' (check every poll_interval seconds) or 'inotify'
+        """
+        watcher = _DataFileWatcher(
+            os.path.dirname(os.path.abspath(self.master_filepath)),
+            backend, poll_interval)
+        expected = self.expected_length()
+        i = start
+        deadline = time.monotonic() + timeout
+        try:
+            while expected is None or i < expected:
+                file_index = i // self.images_per_file
+                key = 'data_{:06d}'.format(1 + file_index)
+                available = (file_index * self.images_per_file
+                             + self._frames_written(key))
+                if available > i:
+                    self.refresh()
+                    frames = self.get_frames(i, available)
+                    for k, img in enumerate(frames, start=i):
+                        yield Frame(img, frame_no=k)
+                    i = available
+                    deadline = time.monotonic() + timeout
+                    continue
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(
+                        'No new frames for {}s after frame {} of {}'.format(
+                            timeout, i, self.master_filepath))
+                watcher.wait(remaining)
+        finally:
+            watcher.close()
+
+    def cache_info(self):
+        "Return hit/miss counters and memory use of the block cache."
+        return {'hits': self.cache_hits,
+                'misses': self.cache_misses,
+                'blocks': len(self._block_cache),
+                'nbytes': self._cached_bytes,
+                'maxbytes': self.cache_bytes}
+
+    def clear_cache(self):
+        self._block_cache.clear()
+        self._cached_bytes = 0
+
     def __len__(self):
-        return sum(self._entry[k].shape[0] for k in self.valid_keys)
+        self._check_layout()
+        return self._len
 
     @property
     def frame_shape(self):
-        return self[0].shape
+        self._check_layout()
+        return self._frame_shape
 
     @property
     def pixel_type(self):
-        return self[0].dtype
+        self._check_layout()
+        return self._pixel_type
 
     @property
     def dtype(self):
@@ -54,10 +412,113 @@ class EigerImages2(FramesSequence):
     def shape(self):
         return self.frame_shape
 
+    def view(self, roi=None, binning=1):
+        """
+        Return a view on this series restricted to a rectangular roi
+        (row_start, row_stop, col_start, col_stop) and/or binned by an
+        integer factor. See EigerImagesView.
+        """
+        return EigerImagesView(self, roi=roi, binning=binning)
+
     def close(self):
+        self.clear_cache()
         self._handle.close()
 
 
+def _binned_dtype(dtype):
+    # integer sums are accumulated in 64 bit so that they cannot overflow
+    dtype = np.dtype(dtype)
+    return np.dtype({'u': np.uint64, 'i': np.int64}.get(dtype.kind, dtype))
+
+
+def bin_frames(frames, binning):
+    """
+    Sum binning x binning blocks of pixels of a frame or a stack of frames.
+    Rows and columns that do not fill a whole block are dropped. Integer
+    data are summed in 64 bit.
+    """
+    if binning == 1:
+        return frames
+    *lead, ny, nx = frames.shape
+    ny, nx = ny // binning, nx // binning
+    frames = frames[..., :ny * binning, :nx * binning]
+    blocks = frames.reshape(tuple(lead) + (ny, binning, nx, binning))
+    return blocks.sum(axis=(-3, -1), dtype=_binned_dtype(frames.dtype))
+
+
+class EigerImagesView(FramesSequence):
+    """
+    ROI and/or binned view on an EigerImages2 series.
+
+    The crop is pushed down into the HDF5 selection, so only the requested
+    rows and columns are read (and, where the chunk layout allows it,
+    decompressed) and held in memory. Binning sums binning x binning blocks
+    of pixels (see bin_frames). md carries the matching binary_mask.
+    """
+    def __init__(self, images, roi=None, binning=1):
+        self.images = images
+        ny, nx = images.frame_shape
+        if roi is None:
+            roi = (0, ny, 0, nx)
+        row_start, row_stop, col_start, col_stop = roi
+        self.roi = roi
+        self.binning = int(binning)
+        if self.binning < 1:
+            raise ValueError('binning must be a positive integer')
+        self._region = (slice(row_start, row_stop), slice(col_start, col_stop))
+        self._md = None
+
+    @property
+    def md(self):
+        if self._md is None and self.images.md is not None:
+            md = dict(self.images.md)
+            if 'binary_mask' in md:
+                mask = md['binary_mask'][self._region]
+                if self.binning > 1:
+                    # a binned pixel is good only if all its pixels are
+                    mask = bin_frames(mask.astype(np.uint8), self.binning)
+                    mask = mask == self.binning**2
+                md['binary_mask'] = mask
+            md.pop('pixel_mask', None)  # bit flags do not crop/bin sensibly
+            self._md = md
+        return self._md
+
+    def get_frame(self, i):
+        img = self._read(i, i + 1, 1)[0]
+        return Frame(img, frame_no=i)
+
+    def get_frames(self, start=0, stop=None, step=1):
+        "Like EigerImages2.get_frames, for the roi and binning of this view."
+        return self._read(start, stop, step)
+
+    def _read(self, start, stop, step):
+        frames = self.images._read_frames(start, stop, step, self._region)
+        return bin_frames(frames, self.binning)
+
+    def __len__(self):
+        return len(self.images)
+
+    @property
+    def frame_shape(self):
+        ny, nx = (len(range(*r.indices(size))) for r, size in
+                  zip(self._region, self.images.frame_shape))
+        return (ny // self.binning, nx // self.binning)
+
+    @property
+    def pixel_type(self):
+        if self.binning == 1:
+            return self.images.pixel_type
+        return _binned_dtype(self.images.pixel_type)
+
+    @property
+    def dtype(self):
+        return self.pixel_type
+
+    @property
+    def shape(self):
+        return self.frame_shape
+
+
 class EigerHandler2:
     EIGER_MD_LAYOUT = {
         'y_pixel_size': 'entry/instrument/detector/y_pixel_size',
@@ -71,6 +532,20 @@ class EigerHandler2:
         'pixel_mask': 'entry/instrument/detector/detectorSpecific/pixel_mask',
     }
     specs = {'AD_EIGER2'}
+    # thread count for parallel chunk decompression in the returned
+    # sequences, e.g. EigerHandler2.workers = 32 (0: HDF5 filter path only)
+    workers = 0
+
+    # Process-wide cache of the metadata read from master files, keyed by
+    # (master path, mtime, size), shared by every handler instance.
+    # Pixel masks are shared read-only arrays, de-duplicated by content:
+    # every sequence taken with the same detector configuration points at
+    # the same pixel_mask / binary_mask pair.
+    md_cache_size = 256
+    _md_cache = OrderedDict()
+    _pixel_masks = weakref.WeakValueDictionary()
+    _binary_masks = weakref.WeakValueDictionary()
+
     def __init__(self, fpath, images_per_file):
         # create pims handler
         self._base_path = fpath
@@ -78,25 +553,55 @@ class EigerHandler2:
 
     def __call__(self, seq_id):
         master_path = '{}_{}_master.h5'.format(self._base_path, seq_id)
+        md = dict(self._read_md(master_path))
+        # TODO Return a multi-dimensional PIMS seq.
+        return EigerImages2(master_path, self._images_per_file, md=md,
+                            workers=self.workers)
+
+    @classmethod
+    def _read_md(cls, master_path):
+        stat = os.stat(master_path)
+        key = (master_path, stat.st_mtime_ns, stat.st_size)
+        try:
+            md = cls._md_cache[key]
+        except KeyError:
+            pass
+        else:
+            cls._md_cache.move_to_end(key)
+            return md
         with h5py.File(master_path, 'r') as f:
-            md = {k: f[v].value for k, v in self.EIGER_MD_LAYOUT.items()}
+            md = {k: f[v][()] for k, v in cls.EIGER_MD_LAYOUT.items()}
         # the pixel mask from the eiger contains:
         # 1  -- gap
         # 2  -- dead
         # 4  -- under-responsive
         # 8  -- over-responsive
         # 16 -- noisy
-        pixel_mask = md['pixel_mask']
-        #pixel_mask[pixel_mask>0] = 1
-        #pixel_mask[pixel_mask==0] = 2
-        #pixel_mask[pixel_mask==1] = 0
-        #pixel_mask[pixel_mask==2] = 1
-        md['binary_mask'] = (md['pixel_mask'] == 0)
+        md['pixel_mask'], md['binary_mask'] = cls._shared_masks(
+            md['pixel_mask'])
         md['framerate'] = 1./md['frame_time']
-        # TODO Return a multi-dimensional PIMS seq.
-        return EigerImages2(master_path, self._images_per_file, md=md)
+        cls._md_cache[key] = md
+        while len(cls._md_cache) > cls.md_cache_size:
+            cls._md_cache.popitem(last=False)
+        return md
+
+    @classmethod
+    def _shared_masks(cls, pixel_mask):
+        "Return the shared (pixel_mask, binary_mask) equal to pixel_mask."
+        digest = (hashlib.sha1(pixel_mask.tobytes()).hexdigest(),
+                  pixel_mask.shape, pixel_mask.dtype.str)
+        shared = cls._pixel_masks.get(digest)
+        binary_mask = cls._binary_masks.get(digest)
+        if shared is None or binary_mask is None:
+            shared = pixel_mask
+            shared.flags.writeable = False
+            binary_mask = (pixel_mask == 0)
+            binary_mask.flags.writeable = False
+            cls._pixel_masks[digest] = shared
+            cls._binary_masks[digest] = binary_mask
+        return shared, binary_mask
 
 # Make reference to the db instance defined in 00-startup.py.
-from eiger_io.fs_handler_dask import EigerHandlerDask
+EigerHandlerDask = lazy_from('eiger_io.fs_handler_dask', 'EigerHandlerDask')
 db.reg.register_handler('AD_EIGER2', EigerHandlerDask, overwrite=True)
 db.reg.register_handler('AD_EIGER', EigerHandlerDask, overwrite=True)
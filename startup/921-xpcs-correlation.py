@@ -0,0 +1,318 @@
+"""
+XPCS correlation functions that run on Eiger series (EigerImages2, see
+92-handler2.py) or on any iterable of frames, at the beamline.
+"""
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import multiprocessing
+import numpy as np
+sparse = lazy_import('scipy.sparse')
+
+
+def _roi_pixels(labels):
+    """
+    Flat indices of the pixels inside the ROIs of labels, sorted by ROI,
+    with the ROI labels and the start and number of pixels of each ROI in
+    that order, so that ROI averages are a single np.add.reduceat.
+    """
+    labels = np.asarray(labels).ravel()
+    pixels = np.flatnonzero(labels)
+    pixels = pixels[np.argsort(labels[pixels], kind='stable')]
+    roi_labels, starts, npix = np.unique(
+        labels[pixels], return_index=True, return_counts=True)
+    return pixels, roi_labels, starts, npix
+
+
+def _roi_box(labels):
+    "(row_start, row_stop, col_start, col_stop) of the ROIs in labels."
+    rows, cols = np.nonzero(labels)
+    if not len(rows):
+        raise ValueError('labels has no ROI pixels')
+    return rows.min(), rows.max() + 1, cols.min(), cols.max() + 1
+
+
+class MultiTauCorrelator:
+    """
+    Streaming multi-tau one-time correlation g2(tau) for ROIs of a detector.
+
+    Frames are fed one at a time (process) or as stacks (process_frames),
+    in a single pass: memory is bounded by num_levels x num_bufs x the
+    number of pixels inside the ROIs, whatever the length of the series.
+
+    labels: integer array of the frame shape, 0 outside of the ROIs and
+            n for the pixels of ROI n
+    num_bufs: (even) number of frames buffered per level. The lags are
+            0 ... num_bufs-1 frames at level 0, then num_bufs/2 ...
+            num_bufs-1 times 2**level at the following levels.
+
+    results() returns lag_steps (in frames) and g2 (lags x ROIs), with the
+    usual normalization g2 = <I(t) I(t+tau)> / (<I(t)> <I(t+tau)>), each
+    average taken over the pixels of the ROI and over time.
+    """
+    def __init__(self, labels, num_levels=7, num_bufs=8):
+        if num_bufs % 2:
+            raise ValueError('num_bufs must be even')
+        (self._pixels, self.roi_labels,
+         self._roi_starts, self._roi_npix) = _roi_pixels(labels)
+        self.num_levels = num_levels
+        self.num_bufs = num_bufs
+
+        self._level_lags = [np.arange(num_bufs)]
+        self._level_lags += [np.arange(num_bufs // 2, num_bufs)] * (num_levels - 1)
+        self._level_offset = np.cumsum([0] + [len(l) for l in self._level_lags])
+        self.lag_steps = np.concatenate(
+            [lags * 2**level for level, lags in enumerate(self._level_lags)])
+
+        num_lags, num_rois = len(self.lag_steps), len(self.roi_labels)
+        self._buf = np.zeros((num_levels, num_bufs, len(self._pixels)))
+        self._pos = np.full(num_levels, -1)
+        self._count = np.zeros(num_levels, dtype=int)
+        self._pending = [None] * num_levels
+        self._G = np.zeros((num_lags, num_rois))
+        self._past = np.zeros((num_lags, num_rois))
+        self._future = np.zeros((num_lags, num_rois))
+        self._norm = np.zeros(num_lags, dtype=int)
+        self.num_frames = 0
+
+    def _roi_mean(self, values):
+        return np.add.reduceat(values, self._roi_starts, axis=-1) / self._roi_npix
+
+    def process(self, frame):
+        "Add one frame to the correlation."
+        values = np.asarray(frame).ravel()[self._pixels].astype(float)
+        self.num_frames += 1
+        self._insert(0, values)
+
+    def process_frames(self, frames):
+        "Add a stack of frames (N, y, x) to the correlation."
+        frames = np.asarray(frames)
+        stack = frames.reshape(len(frames), -1)[:, self._pixels]
+        for values in stack.astype(float):
+            self.num_frames += 1
+            self._insert(0, values)
+
+    def _insert(self, level, values):
+        while True:
+            pos = self._pos[level] = (self._pos[level] + 1) % self.num_bufs
+            self._buf[level, pos] = values
+            self._count[level] += 1
+            lags = self._level_lags[level]
+            lags = lags[lags < self._count[level]]
+            if len(lags):
+                past = self._buf[level, (pos - lags) % self.num_bufs]
+                k = slice(self._level_offset[level],
+                          self._level_offset[level] + len(lags))
+                self._G[k] += self._roi_mean(past * values)
+                self._past[k] += self._roi_mean(past)
+                self._future[k] += self._roi_mean(values)
+                self._norm[k] += 1
+            if level + 1 == self.num_levels:
+                return
+            # every two frames of this level make one frame of the next one
+            if self._pending[level] is None:
+                self._pending[level] = values
+                return
+            values = (self._pending[level] + values) / 2
+            self._pending[level] = None
+            level += 1
+
+    def results(self):
+        "Return lag_steps (frames) and g2 (lags x ROIs) for the lags seen."
+        seen = self._norm > 0
+        norm = self._norm[seen, np.newaxis]
+        G = self._G[seen] / norm
+        past = self._past[seen] / norm
+        future = self._future[seen] / norm
+        with np.errstate(divide='ignore', invalid='ignore'):
+            g2 = G / (past * future)
+        return self.lag_steps[seen], g2
+
+
+def multi_tau_g2(images, labels, num_levels=7, num_bufs=8, block=100):
+    """
+    One-pass multi-tau g2 of a series for the ROIs in labels.
+
+    images: EigerImages2 (or a view/any object with get_frames), read
+            `block` frames at a time, or any iterable of frames, e.g.
+            EigerImages2.follow() to correlate while the series is written
+    returns lag_steps (in frames; multiply by md['frame_time'] for
+    seconds) and g2 with one column per ROI label (see
+    MultiTauCorrelator)
+    An EigerImages2 is read cropped to the bounding box of the ROIs.
+    """
+    labels = np.asarray(labels)
+    box = _roi_box(labels)
+    if isinstance(images, EigerImages2):
+        images = images.view(roi=box)
+        labels = labels[box[0]:box[1], box[2]:box[3]]
+    correlator = MultiTauCorrelator(labels, num_levels, num_bufs)
+    if hasattr(images, 'get_frames'):
+        for start in range(0, len(images), block):
+            correlator.process_frames(images.get_frames(start, start + block))
+    else:
+        for frame in images:
+            correlator.process(frame)
+    return correlator.results()
+
+
+def _images_spec(images):
+    """
+    What a worker process needs to reopen images (an EigerImages2, or a
+    view on one) by itself: HDF5 handles must not cross a fork.
+    """
+    if hasattr(images, 'master_filepath'):
+        return (images.master_filepath, images.images_per_file, None, 1)
+    if hasattr(images, 'images') and hasattr(images.images, 'master_filepath'):
+        parent = images.images
+        return (parent.master_filepath, parent.images_per_file,
+                images.roi, images.binning)
+    raise TypeError('the process pool mode needs an EigerImages2 or a view '
+                    'on one, got {!r}'.format(type(images)))
+
+
+def _open_images(spec):
+    master_filepath, images_per_file, roi, binning = spec
+    images = EigerImages2(master_filepath, images_per_file)
+    if roi is not None or binning != 1:
+        images = images.view(roi=roi, binning=binning)
+    return images
+
+
+class _TwoTimeTiles:
+    """
+    Compute rows of tiles of the two-time correlation of images.
+
+    Only the pixels inside the ROIs are kept: frames are read `read_block`
+    at a time (cropped to the bounding box of the ROIs for EigerImages2)
+    and reduced to an (N, ROI pixels) array right away.
+    """
+    def __init__(self, images, labels, tile, read_block):
+        labels = np.asarray(labels)
+        self.images = images
+        self.tile = tile
+        self.read_block = read_block
+        self.num_frames = len(images)
+        box = _roi_box(labels)
+        if isinstance(images, EigerImages2):
+            self._source = images.view(roi=box)
+            labels = labels[box[0]:box[1], box[2]:box[3]]
+        else:
+            self._source = images
+        (self.pixels, self.roi_labels,
+         self.roi_starts, self.roi_npix) = _roi_pixels(labels)
+        # sparse (pixels x ROIs) matrix averaging the pixels of each ROI
+        roi_index = np.repeat(np.arange(len(self.roi_labels)), self.roi_npix)
+        self._roi_average = sparse.csr_matrix(
+            (1. / self.roi_npix[roi_index],
+             (np.arange(len(self.pixels)), roi_index)),
+            shape=(len(self.pixels), len(self.roi_labels)))
+
+    def _get_frames(self, start, stop):
+        if hasattr(self._source, 'get_frames'):
+            return self._source.get_frames(start, stop)
+        return np.asarray(self._source[start:stop])
+
+    def read(self, start, stop):
+        "ROI pixels of frames start ... stop-1, as a (frames, pixels) array"
+        values = np.empty((stop - start, len(self.pixels)))
+        for i in range(start, stop, self.read_block):
+            frames = self._get_frames(i, min(stop, i + self.read_block))
+            values[i - start:i - start + len(frames)] = \
+                frames.reshape(len(frames), -1)[:, self.pixels]
+        return values
+
+    def row(self, i0):
+        """
+        Tiles (i0, j0) for j0 >= i0, as one (ROIs, tile, N - i0) array
+        holding C[:, t1, t2] for t1 in the tile starting at i0, t2 >= i0.
+        """
+        i1 = min(i0 + self.tile, self.num_frames)
+        A = self.read(i0, i1)
+        mean_A = self._roi_average.T.dot(A.T).T  # (frames, ROIs)
+        C = np.empty((len(self.roi_labels), i1 - i0, self.num_frames - i0))
+        for j0 in range(i0, self.num_frames, self.tile):
+            j1 = min(j0 + self.tile, self.num_frames)
+            B = A if j0 == i0 else self.read(j0, j1)
+            mean_B = mean_A if j0 == i0 else self._roi_average.T.dot(B.T).T
+            for r, (s, n) in enumerate(zip(self.roi_starts, self.roi_npix)):
+                G = A[:, s:s + n].dot(B[:, s:s + n].T) / n
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    C[r, :, j0 - i0:j1 - i0] = G / np.outer(mean_A[:, r],
+                                                            mean_B[:, r])
+        return C
+
+
+def _two_time_row(spec, labels, tile, read_block, i0):
+    # runs in a worker process
+    tiles = _TwoTimeTiles(_open_images(spec), labels, tile, read_block)
+    return i0, tiles.row(i0)
+
+
+def two_time_correlation(images, labels, memory=2 * 1024**3, out=None,
+                         processes=0, read_block=16):
+    """
+    Two-time correlation C(t1, t2) of a series for the ROIs in labels.
+
+    C[r, t1, t2] = <I(t1) I(t2)> / (<I(t1)> <I(t2)>), averaged over the
+    pixels of ROI r (labels: 0 outside of the ROIs, n for ROI n).
+
+    The (t1, t2) plane is computed in square tiles of frames, one row of
+    tiles at a time. The tile size is chosen so that the working set (ROI
+    pixels of two tiles of frames, the results of a row of tiles and the
+    frames being read) stays within `memory` bytes (per process).
+    images: EigerImages2, a view on one, or an (N, y, x) array
+    out: optional (ROIs, N, N) array for the result, e.g. an np.memmap
+         when the result itself does not fit in memory
+    processes: > 0 splits the rows of tiles over that many processes, each
+         reading the frames it needs itself (EigerImages2 or views only)
+    returns roi_labels and C
+    """
+    labels = np.asarray(labels)
+    _roi_box(labels)   # raises if there are no ROI pixels
+    num_frames = len(images)
+    num_pixels = np.count_nonzero(labels)
+    num_rois = len(np.unique(labels[labels > 0]))
+    frame_bytes = labels.size * np.dtype(images.dtype).itemsize
+    # a row of tiles holds the ROI pixels of two tiles of frames and the
+    # (ROIs, tile, N) results, on top of the read_block frames being read
+    budget = memory - read_block * frame_bytes
+    if budget <= 0:
+        raise ValueError('memory budget too small for read_block frames')
+    tile = int(budget // (16. * num_pixels + 8. * num_rois * num_frames))
+    tile = max(1, min(tile, num_frames))
+
+    if out is None:
+        out = np.empty((num_rois, num_frames, num_frames))
+
+    def store(i0, C):
+        i1 = i0 + C.shape[1]
+        out[:, i0:i1, i0:] = C
+        out[:, i0:, i0:i1] = C.transpose(0, 2, 1)
+
+    starts = range(0, num_frames, tile)
+    if processes:
+        spec = _images_spec(images)
+        context = multiprocessing.get_context('fork')
+        with ProcessPoolExecutor(processes, mp_context=context) as pool:
+            # at most `processes` rows in flight: each finished row is
+            # stored into out and dropped before the next one is submitted
+            pending = set()
+            starts = iter(starts)
+            while True:
+                for i0 in starts:
+                    pending.add(pool.submit(_two_time_row, spec, labels,
+                                            tile, read_block, i0))
+                    if len(pending) >= processes:
+                        break
+                if not pending:
+                    break
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    store(*future.result())
+                del done, future
+        roi_labels = np.unique(labels[labels > 0])
+    else:
+        tiles = _TwoTimeTiles(images, labels, tile, read_block)
+        for i0 in starts:
+            store(i0, tiles.row(i0))
+        roi_labels = tiles.roi_labels
+    return roi_labels, out
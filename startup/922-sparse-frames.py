@@ -0,0 +1,186 @@
+"""
+Sparse photon-event storage for low-count Eiger series.
+
+At short exposures most pixels of an XPCS frame are 0: storing, for each
+frame, only the indices and counts of the pixels that saw photons (CSR
+layout) shrinks the data and everything that has to go through it.
+"""
+import json
+import os
+import numpy as np
+from pims import FramesSequence, Frame
+
+
+def _md_to_json(md):
+    "The scalar entries of md, as plain python types."
+    out = {}
+    for k, v in (md or {}).items():
+        if np.ndim(v) == 0 and isinstance(v, (int, float, str, np.generic)):
+            out[k] = v.item() if isinstance(v, np.generic) else v
+    return out
+
+
+def sparsify_frames(images, path, mask=None, count_dtype=np.uint16,
+                    block=32):
+    """
+    Write a series as sparse photon events in directory path.
+
+    images: EigerImages2 (read `block` frames at a time with get_frames)
+            or any sequence of frames
+    mask: boolean array, True for the pixels to keep. Defaults to
+          md['binary_mask'] of images when there is one, which drops the
+          gaps and bad pixels (whose values are not photon counts anyway).
+    count_dtype: dtype of the stored counts. ValueError is raised if a
+          count does not fit.
+
+    Files written: indptr.npy (start of each frame in the event arrays,
+    N + 1 entries), indices.bin (uint32 flat pixel indices), counts.bin
+    (counts), mask.npy and meta.json (frame shape, dtypes, scalar md).
+    Open them with SparseFrames(path).
+    """
+    os.makedirs(path, exist_ok=True)
+    md = getattr(images, 'md', None) or {}
+    if mask is None:
+        mask = md.get('binary_mask')
+    count_dtype = np.dtype(count_dtype)
+    max_count = np.iinfo(count_dtype).max
+    indptr = [0]
+    frame_shape = None
+    keep = None
+    with open(os.path.join(path, 'indices.bin'), 'wb') as indices_file, \
+            open(os.path.join(path, 'counts.bin'), 'wb') as counts_file:
+        if hasattr(images, 'get_frames'):
+            blocks = (images.get_frames(start, start + block)
+                      for start in range(0, len(images), block))
+        else:
+            blocks = ([frame] for frame in images)
+        for frames in blocks:
+            frames = np.asarray(frames)
+            if keep is None:
+                frame_shape = frames.shape[1:]
+                keep = (np.ones(frame_shape, dtype=bool) if mask is None
+                        else np.asarray(mask, dtype=bool))
+            frames = frames.reshape(len(frames), -1) * keep.ravel()
+            rows, indices = np.nonzero(frames)
+            counts = frames[rows, indices]
+            if len(counts) and counts.max() > max_count:
+                raise ValueError('count {} does not fit in {}'.format(
+                    counts.max(), count_dtype))
+            indices.astype(np.uint32).tofile(indices_file)
+            counts.astype(count_dtype).tofile(counts_file)
+            per_frame = np.bincount(rows, minlength=len(frames))
+            indptr.extend((indptr[-1] + np.cumsum(per_frame)).tolist())
+    if keep is None:   # no frames: an empty series of the right shape
+        frame_shape = getattr(images, 'frame_shape', None)
+        if frame_shape is None and mask is not None:
+            frame_shape = np.shape(mask)
+        if frame_shape is None:
+            raise ValueError('images has no frames and no frame_shape')
+        keep = (np.ones(frame_shape, dtype=bool) if mask is None
+                else np.asarray(mask, dtype=bool))
+    np.save(os.path.join(path, 'indptr.npy'), np.array(indptr, dtype=np.int64))
+    np.save(os.path.join(path, 'mask.npy'), keep)
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump({'frame_shape': list(frame_shape),
+                   'pixel_type': np.dtype(images.dtype).str
+                   if hasattr(images, 'dtype') else count_dtype.str,
+                   'count_dtype': count_dtype.str,
+                   'md': _md_to_json(md)}, f)
+    return SparseFrames(path)
+
+
+def _memmap(filename, dtype):
+    if os.path.getsize(filename) == 0:
+        return np.empty(0, dtype=dtype)  # np.memmap refuses empty files
+    return np.memmap(filename, dtype=dtype, mode='r')
+
+
+class SparseFrames(FramesSequence):
+    """
+    Read a series written by sparsify_frames.
+
+    The event arrays are memory-mapped. Frames come back dense, with the
+    same indexing as EigerImages2 (get_frame, get_frames, len, frame_shape),
+    while sum(), mean() and frame_sums() work on the sparse events directly.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        self._frame_shape = tuple(meta['frame_shape'])
+        self._pixel_type = np.dtype(meta['pixel_type'])
+        self.indptr = np.load(os.path.join(path, 'indptr.npy'))
+        self.indices = _memmap(os.path.join(path, 'indices.bin'), np.uint32)
+        self.counts = _memmap(os.path.join(path, 'counts.bin'),
+                              np.dtype(meta['count_dtype']))
+        self._md = meta['md']
+        self._md['binary_mask'] = np.load(os.path.join(path, 'mask.npy'))
+
+    @property
+    def md(self):
+        return self._md
+
+    def events(self, i):
+        "Flat indices and counts of the pixels that saw photons in frame i."
+        s = slice(self.indptr[i], self.indptr[i + 1])
+        return self.indices[s], self.counts[s]
+
+    def get_frame(self, i):
+        img = np.zeros(np.prod(self._frame_shape), dtype=self._pixel_type)
+        indices, counts = self.events(i)
+        img[indices] = counts
+        return Frame(img.reshape(self._frame_shape), frame_no=i)
+
+    def get_frames(self, start=0, stop=None, step=1):
+        "Frames start ... stop-1 (every step-th), as one dense (N, y, x) array."
+        if isinstance(start, slice):
+            start, stop, step = start.start, start.stop, start.step
+        frames = range(*slice(start, stop, step).indices(len(self)))
+        out = np.zeros((len(frames), np.prod(self._frame_shape)),
+                       dtype=self._pixel_type)
+        for n, i in enumerate(frames):
+            indices, counts = self.events(i)
+            out[n, indices] = counts
+        return out.reshape((len(frames),) + self._frame_shape)
+
+    def sum(self, block=10**8):
+        "Per-pixel sum over all frames, reading `block` events at a time."
+        total = np.zeros(np.prod(self._frame_shape), dtype=np.int64)
+        for start in range(0, len(self.indices), block):
+            total += np.bincount(self.indices[start:start + block],
+                                 weights=self.counts[start:start + block],
+                                 minlength=len(total)).astype(np.int64)
+        return total.reshape(self._frame_shape)
+
+    def mean(self):
+        "Per-pixel mean over all frames."
+        return self.sum() / len(self)
+
+    def frame_sums(self):
+        "Total counts of each frame (intensity vs. time)."
+        sums = np.zeros(len(self), dtype=np.int64)
+        # reduceat gives the element itself for empty segments: skip them
+        nonempty = np.diff(self.indptr) > 0
+        if nonempty.any():
+            sums[nonempty] = np.add.reduceat(
+                self.counts, self.indptr[:-1][nonempty], dtype=np.int64)
+        return sums
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    @property
+    def frame_shape(self):
+        return self._frame_shape
+
+    @property
+    def pixel_type(self):
+        return self._pixel_type
+
+    @property
+    def dtype(self):
+        return self.pixel_type
+
+    @property
+    def shape(self):
+        return self.frame_shape
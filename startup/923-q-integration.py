@@ -0,0 +1,201 @@
+"""
+Azimuthal integration of Eiger frames with a precomputed sparse matrix.
+
+The pixel -> (phi, q) bin mapping depends only on the geometry in the
+master file metadata (see EigerHandler2.EIGER_MD_LAYOUT), so it is built
+once per geometry, kept as a sparse (bins x pixels) averaging matrix and
+cached on disk. Reducing a frame is then one sparse mat-vec product, and
+reducing a whole stack one mat-mat product.
+"""
+from collections import OrderedDict
+import hashlib
+import os
+import numpy as np
+sparse = lazy_import('scipy.sparse')
+
+
+QMAP_CACHE_DIR = os.path.expanduser('~/.cache/chx_qmaps')
+
+
+def pixel_q_phi(md, shape=None):
+    """
+    q (1/A) and azimuthal angle phi (degrees, -180 ... 180) of every pixel.
+
+    md: Eiger metadata with beam_center_x/y (pixels), detector_distance and
+        x/y_pixel_size (m) and incident_wavelength (A)
+    shape: frame shape, defaults to the shape of md['pixel_mask']
+    """
+    if shape is None:
+        shape = np.shape(md['pixel_mask'])
+    rows, cols = np.indices(shape, dtype=float)
+    x = (cols - float(md['beam_center_x'])) * float(md['x_pixel_size'])
+    y = (rows - float(md['beam_center_y'])) * float(md['y_pixel_size'])
+    two_theta = np.arctan2(np.hypot(x, y), float(md['detector_distance']))
+    q = 4 * np.pi / float(md['incident_wavelength']) * np.sin(two_theta / 2)
+    phi = np.degrees(np.arctan2(y, x))
+    return q, phi
+
+
+class QIntegrator:
+    """
+    Sparse-matrix azimuthal integrator for one detector geometry.
+
+    md: Eiger metadata, e.g. EigerImages2(...).md
+    num_q, num_phi: number of q bins and of azimuthal sectors (1 gives
+        plain radial profiles)
+    q_range: (q_min, q_max) in 1/A, defaults to the range of the valid pixels
+    mask: boolean array, True for the pixels to use; defaults to
+        md['binary_mask'] (or md['pixel_mask'] == 0)
+    cache_dir: where the matrices are cached, keyed by a hash of the
+        geometry, binning and mask (None: memory only)
+
+    integrate(frame) returns the mean intensity per bin, (num_phi, num_q);
+    integrate_frames(stack) does the same for (N, y, x) stacks in one
+    product. Empty bins come out as nan.
+    """
+    # the last cache_size matrices are kept in memory (LRU), across
+    # instances; the others are reloaded from cache_dir
+    cache_size = 8
+    _cache = OrderedDict()
+
+    def __init__(self, md, num_q=500, num_phi=1, q_range=None, mask=None,
+                 cache_dir=QMAP_CACHE_DIR):
+        if mask is None:
+            mask = md.get('binary_mask')
+            if mask is None:
+                mask = np.asarray(md['pixel_mask']) == 0
+        mask = np.asarray(mask, dtype=bool)
+        self.shape = mask.shape
+        self.num_q = num_q
+        self.num_phi = num_phi
+        self.key = self._geometry_key(md, mask, num_q, num_phi, q_range)
+        tables = self._cache.get(self.key)
+        if tables is None:
+            tables = self._load(cache_dir)
+        if tables is None:
+            tables = self._build(md, mask, q_range)
+            self._save(cache_dir, tables)
+        self._cache[self.key] = tables
+        self._cache.move_to_end(self.key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        self.matrix, self.q_edges, self.phi_edges, self.npix = tables
+        self.q = (self.q_edges[1:] + self.q_edges[:-1]) / 2
+        self.phi = (self.phi_edges[1:] + self.phi_edges[:-1]) / 2
+
+    @staticmethod
+    def _geometry_key(md, mask, num_q, num_phi, q_range):
+        h = hashlib.sha1()
+        for k in ('beam_center_x', 'beam_center_y', 'detector_distance',
+                  'incident_wavelength', 'x_pixel_size', 'y_pixel_size'):
+            h.update('{}={!r};'.format(k, float(md[k])).encode())
+        h.update('{!r};{!r};{!r};{!r};'.format(
+            num_q, num_phi, q_range, mask.shape).encode())
+        h.update(np.packbits(mask).tobytes())
+        return h.hexdigest()
+
+    def _build(self, md, mask, q_range):
+        q, phi = pixel_q_phi(md, self.shape)
+        pixels = np.flatnonzero(mask)
+        q, phi = q.ravel()[pixels], phi.ravel()[pixels]
+        if q_range is None:
+            q_range = (q.min(), q.max())
+        q_edges = np.linspace(q_range[0], q_range[1], self.num_q + 1)
+        phi_edges = np.linspace(-180, 180, self.num_phi + 1)
+        q_bin = np.searchsorted(q_edges, q, side='right') - 1
+        q_bin[q == q_edges[-1]] = self.num_q - 1  # right edge is inclusive
+        phi_bin = np.minimum(
+            np.searchsorted(phi_edges, phi, side='right') - 1,
+            self.num_phi - 1)
+        inside = (q_bin >= 0) & (q_bin < self.num_q)
+        pixels = pixels[inside]
+        bins = phi_bin[inside] * self.num_q + q_bin[inside]
+        npix = np.bincount(bins, minlength=self.num_q * self.num_phi)
+        matrix = sparse.csr_matrix(
+            (1. / npix[bins], (bins, pixels)),
+            shape=(self.num_q * self.num_phi, mask.size))
+        return matrix, q_edges, phi_edges, npix
+
+    def _path(self, cache_dir):
+        return os.path.join(cache_dir, self.key + '.npz')
+
+    def _load(self, cache_dir):
+        if cache_dir is None:
+            return None
+        try:
+            with np.load(self._path(cache_dir)) as f:
+                matrix = sparse.csr_matrix(
+                    (f['data'], f['indices'], f['indptr']),
+                    shape=tuple(f['matrix_shape']))
+                return matrix, f['q_edges'], f['phi_edges'], f['npix']
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def _save(self, cache_dir, tables):
+        if cache_dir is None:
+            return
+        matrix, q_edges, phi_edges, npix = tables
+        path = self._path(cache_dir)
+        tmp = path + '.{}.tmp.npz'.format(os.getpid())
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            np.savez(tmp, data=matrix.data, indices=matrix.indices,
+                     indptr=matrix.indptr, matrix_shape=matrix.shape,
+                     q_edges=q_edges, phi_edges=phi_edges, npix=npix)
+            os.replace(tmp, path)
+        except OSError as e:
+            print('Could not cache the q map in {}: {}'.format(cache_dir, e))
+
+    def _reshape(self, profiles):
+        with np.errstate(invalid='ignore'):
+            profiles = np.where(self.npix > 0, profiles, np.nan)
+        return profiles.reshape(profiles.shape[:-1] +
+                                (self.num_phi, self.num_q))
+
+    def integrate(self, frame):
+        "Mean intensity per (phi, q) bin of one frame."
+        return self._reshape(self.matrix.dot(np.asarray(frame).ravel()))
+
+    def integrate_frames(self, frames):
+        "Mean intensity per (phi, q) bin of a stack, as (N, num_phi, num_q)."
+        frames = np.asarray(frames)
+        flat = frames.reshape(len(frames), -1)
+        return self._reshape(self.matrix.dot(flat.T).T)
+
+    def integrate_series(self, images, block=100):
+        """
+        Profiles of every frame of images (EigerImages2 or anything with
+        get_frames), reading and reducing `block` frames at a time.
+        """
+        out = np.empty((len(images), self.num_phi, self.num_q))
+        for start in range(0, len(images), block):
+            frames = images.get_frames(start, start + block)
+            out[start:start + len(frames)] = self.integrate_frames(frames)
+        return out
+
+
+def view_geometry(md, roi=None, binning=1):
+    """
+    md with the beam center and pixel size of a cropped and/or binned frame
+    (see EigerImagesView): the beam center is moved by the ROI origin and
+    both are scaled by the binning.
+    """
+    md = dict(md)
+    row_start, col_start = (0, 0) if roi is None else (roi[0], roi[2])
+    for axis, start in (('x', col_start), ('y', row_start)):
+        center = float(md['beam_center_' + axis]) - start
+        # binned pixel j covers the pixels j*binning ... j*binning+binning-1
+        md['beam_center_' + axis] = (center - (binning - 1) / 2.) / binning
+        md[axis + '_pixel_size'] = float(md[axis + '_pixel_size']) * binning
+    return md
+
+
+def q_integrator(images, **kwargs):
+    """
+    QIntegrator for the geometry of images (an EigerImages2, or an
+    EigerImagesView, whose ROI and binning are taken into account).
+    """
+    md = images.md
+    if isinstance(images, EigerImagesView):
+        md = view_geometry(md, images.roi, images.binning)
+    return QIntegrator(md, **kwargs)
@@ -0,0 +1,214 @@
+"""
+Benchmarks of the Eiger handlers on synthetic master/data files.
+
+make_synthetic_eiger() writes a series with the layout the detector
+produces (entry/data/data_NNNNNN external links, the metadata in
+EigerHandler2.EIGER_MD_LAYOUT), and benchmark_eiger_handlers() measures
+open latency, sequential and random frame throughput and memory of each
+handler on it, e.g. to choose FWNImagesPerFile:
+
+    results = benchmark_eiger_handlers('/tmp/eiger_bench', num_frames=1000,
+                                       images_per_file=(10, 100),
+                                       compression=('bslz4', None))
+"""
+import gc
+import os
+import time
+import numpy as np
+h5py = lazy_import('h5py')
+
+try:
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+
+def _compression_kwargs(compression):
+    if compression is None:
+        return {}
+    if compression in ('bslz4', 'lz4'):
+        if hdf5plugin is None:
+            raise ImportError('hdf5plugin is needed to write {} data'.format(
+                compression))
+        if compression == 'bslz4':
+            return dict(hdf5plugin.Bitshuffle(nelems=0, cname='lz4'))
+        return dict(hdf5plugin.LZ4())
+    return dict(compression=compression)
+
+
+def make_synthetic_eiger(directory, num_frames=1000, images_per_file=100,
+                         frame_shape=(2167, 2070), compression='bslz4',
+                         seq_id=1, prefix='bench', mean_count=0.1,
+                         dtype=np.uint32):
+    """
+    Write a synthetic Eiger series in directory.
+
+    Frames are Poisson noise with mean_count photons per pixel, written one
+    chunk per frame like the detector does, with compression 'bslz4' or
+    'lz4' (need hdf5plugin), any h5py filter name (e.g. 'gzip') or None.
+    returns fpath, the handler path of the series: EigerHandler2(fpath,
+    images_per_file)(seq_id) opens it.
+    """
+    os.makedirs(directory, exist_ok=True)
+    fpath = os.path.join(directory, prefix)
+    master = '{}_{}_master.h5'.format(fpath, seq_id)
+    kwargs = _compression_kwargs(compression)
+    rng = np.random.default_rng(seq_id)
+    pixel_mask = np.zeros(frame_shape, dtype=np.uint32)
+    pixel_mask[:, frame_shape[1] // 2] = 1  # a module gap
+    md = {'y_pixel_size': 75e-6, 'x_pixel_size': 75e-6,
+          'detector_distance': 5., 'incident_wavelength': 1.285,
+          'frame_time': 0.01, 'count_time': 0.00999,
+          'beam_center_x': frame_shape[1] / 2.,
+          'beam_center_y': frame_shape[0] / 2.,
+          'pixel_mask': pixel_mask}
+    with h5py.File(master, 'w') as f:
+        for k, v in md.items():
+            f[EigerHandler2.EIGER_MD_LAYOUT[k]] = v
+        specific = f.require_group('entry/instrument/detector/detectorSpecific')
+        specific['nimages'] = num_frames
+        specific['ntrigger'] = 1
+        for n, start in enumerate(range(0, num_frames, images_per_file)):
+            count = min(images_per_file, num_frames - start)
+            data_path = '{}_{}_data_{:06d}.h5'.format(fpath, seq_id, n + 1)
+            with h5py.File(data_path, 'w') as g:
+                dataset = g.create_dataset(
+                    'entry/data/data', shape=(count,) + tuple(frame_shape),
+                    dtype=dtype, chunks=(1,) + tuple(frame_shape), **kwargs)
+                for i in range(count):
+                    dataset[i] = rng.poisson(mean_count, frame_shape)
+            f['entry/data/data_{:06d}'.format(n + 1)] = h5py.ExternalLink(
+                os.path.basename(data_path), 'entry/data/data')
+    return fpath
+
+
+def _rss():
+    "Resident memory of this process in bytes."
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _frame(images, i):
+    return np.asarray(images[i])
+
+
+def benchmark_handler(handler_class, fpath, images_per_file, seq_id=1,
+                      num_random=100, block=100):
+    """
+    Time one handler on a series written by make_synthetic_eiger.
+
+    returns a dict with open_s (handler call to first frame), seq_fps
+    (frame by frame), block_fps (get_frames batches, if the handler's
+    sequences have it), random_fps (num_random random frames), MB_s (of
+    decoded data, sequential) and rss_MB (memory growth during the run).
+    Files are in the OS page cache after the first pass: compare handlers
+    on the same files, not with the beamline disks.
+    """
+    md_cache = getattr(handler_class, '_md_cache', None)
+    if md_cache is not None:
+        md_cache.clear()
+    gc.collect()
+    rss0 = _rss()
+    result = {'handler': handler_class.__name__}
+
+    t0 = time.perf_counter()
+    images = handler_class(fpath, images_per_file)(seq_id)
+    num_frames = len(images)
+    frame = _frame(images, 0)
+    result['open_s'] = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    for i in range(num_frames):
+        frame = _frame(images, i)
+    elapsed = time.perf_counter() - t0
+    result['seq_fps'] = num_frames / elapsed
+    result['MB_s'] = num_frames * frame.nbytes / elapsed / 1e6
+
+    if hasattr(images, 'get_frames'):
+        t0 = time.perf_counter()
+        for start in range(0, num_frames, block):
+            images.get_frames(start, start + block)
+        result['block_fps'] = num_frames / (time.perf_counter() - t0)
+    else:
+        result['block_fps'] = None
+
+    clear_cache = getattr(images, 'clear_cache', None)
+    if clear_cache is not None:
+        clear_cache()  # random reads should not hit the sequential pass
+    order = np.random.default_rng(0).integers(0, num_frames, num_random)
+    t0 = time.perf_counter()
+    for i in order:
+        _frame(images, int(i))
+    result['random_fps'] = num_random / (time.perf_counter() - t0)
+    result['rss_MB'] = (_rss() - rss0) / 1e6
+
+    close = getattr(images, 'close', None)
+    if close is not None:
+        close()
+    return result
+
+
+def _handler_classes():
+    handlers = [EigerHandler2]
+    try:
+        from eiger_io.fs_handler_dask import EigerHandlerDask
+    except ImportError:
+        print('eiger_io is not available, benchmarking EigerHandler2 only')
+    else:
+        handlers.append(EigerHandlerDask)
+    return handlers
+
+
+def benchmark_eiger_handlers(directory, num_frames=1000,
+                             images_per_file=(10, 100),
+                             compression=('bslz4', None),
+                             frame_shape=(2167, 2070), handlers=None,
+                             num_random=100, keep_files=False):
+    """
+    Benchmark handlers (default: EigerHandler2 and EigerHandlerDask) for
+    every combination of images_per_file and compression, on synthetic
+    series of num_frames frames of frame_shape written in directory.
+
+    Prints a table and returns the list of result dicts (see
+    benchmark_handler), with images_per_file and compression added.
+    """
+    if handlers is None:
+        handlers = _handler_classes()
+    results = []
+    seq_id = 0
+    for comp in compression:
+        for ipf in images_per_file:
+            seq_id += 1
+            print('writing {} frames, {} per file, compression {}'.format(
+                num_frames, ipf, comp))
+            fpath = make_synthetic_eiger(
+                directory, num_frames, ipf, frame_shape, comp, seq_id)
+            for handler_class in handlers:
+                result = benchmark_handler(handler_class, fpath, ipf,
+                                           seq_id, num_random)
+                result.update(images_per_file=ipf, compression=comp)
+                results.append(result)
+            if not keep_files:
+                prefix = os.path.basename('{}_{}_'.format(fpath, seq_id))
+                for name in os.listdir(directory):
+                    if name.startswith(prefix):
+                        os.remove(os.path.join(directory, name))
+    _print_results(results)
+    return results
+
+
+def _print_results(results):
+    columns = ['handler', 'compression', 'images_per_file', 'open_s',
+               'seq_fps', 'block_fps', 'random_fps', 'MB_s', 'rss_MB']
+    print(' '.join('{:>16}'.format(c) for c in columns))
+    for result in results:
+        cells = []
+        for c in columns:
+            v = result.get(c)
+            cells.append('{:>16.3f}'.format(v) if isinstance(v, float)
+                         else '{:>16}'.format(str(v)))
+        print(' '.join(cells))
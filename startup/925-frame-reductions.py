@@ -0,0 +1,151 @@
+"""
+One-pass per-pixel reductions (sum, mean, variance, max) of frame series:
+EigerImages2 sequences, TIFF series or frames arriving during acquisition.
+
+Memory is bounded by a few blocks of frames and per-pixel accumulators,
+whatever the length of the series.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pims
+
+
+def _sum_dtype(dtype):
+    "Accumulator for sums of dtype: 64 bit integers stay exact."
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'u':
+        return np.dtype(np.uint64)
+    if dtype.kind in 'ib':
+        return np.dtype(np.int64)
+    return np.dtype(np.float64)
+
+
+class FrameReducer:
+    """
+    Per-pixel count, sum, max, mean and variance of frames, fed a stack at
+    a time with update().
+
+    Sums of integer frames are accumulated in 64 bit integers (exact), the
+    max keeps the frame dtype, and mean/variance use Welford's update
+    generalized to stacks (Chan et al.), so that reducers of parts of a
+    series can be merged.
+    """
+    def __init__(self):
+        self.count = 0
+        self.sum = None
+        self.max = None
+        self.mean = None
+        self._m2 = None
+
+    def update(self, frames):
+        "Add a stack of frames (N, y, x)."
+        frames = np.asarray(frames)
+        n = len(frames)
+        if n == 0:
+            return
+        block_sum = frames.sum(axis=0, dtype=_sum_dtype(frames.dtype))
+        block_max = frames.max(axis=0)
+        block_mean = block_sum / n
+        # accumulated one frame at a time: a float temporary of the whole
+        # stack would be 8 bytes per pixel per frame
+        block_m2 = np.zeros(block_mean.shape)
+        deviation = np.empty(block_mean.shape)
+        for frame in frames:
+            np.subtract(frame, block_mean, out=deviation)
+            deviation *= deviation
+            block_m2 += deviation
+        self._merge(n, block_sum, block_max, block_mean, block_m2)
+
+    def merge(self, other):
+        "Add the frames reduced by another FrameReducer."
+        if other.count:
+            self._merge(other.count, other.sum, other.max, other.mean,
+                        other._m2)
+
+    def _merge(self, n, block_sum, block_max, block_mean, block_m2):
+        if not self.count:
+            self.count = n
+            self.sum = block_sum.copy()
+            self.max = block_max.copy()
+            self.mean = np.asarray(block_mean, dtype=float).copy()
+            self._m2 = np.asarray(block_m2, dtype=float).copy()
+            return
+        total = self.count + n
+        delta = block_mean - self.mean
+        self.mean += delta * (n / total)
+        self._m2 += block_m2 + delta ** 2 * (self.count * n / total)
+        self.sum += block_sum
+        np.maximum(self.max, block_max, out=self.max)
+        self.count = total
+
+    @property
+    def variance(self):
+        "Per-pixel (population) variance."
+        return self._m2 / self.count if self.count else None
+
+    def results(self):
+        return {'count': self.count, 'sum': self.sum, 'mean': self.mean,
+                'variance': self.variance, 'max': self.max}
+
+
+def tiff_series(pattern):
+    "Lazy sequence of the TIFF files matching pattern (a glob), by name."
+    return pims.ImageSequence(pattern)
+
+
+def _blocks(images, block):
+    "Stacks of `block` frames of images."
+    if hasattr(images, 'get_frames'):
+        for start in range(0, len(images), block):
+            yield images.get_frames(start, start + block)
+        return
+    stack = []
+    for frame in images:
+        stack.append(np.asarray(frame))
+        if len(stack) == block:
+            yield np.stack(stack)
+            stack = []
+    if stack:
+        yield np.stack(stack)
+
+
+def _reduce_range(images, starts, block):
+    reducer = FrameReducer()
+    for start in starts:
+        if hasattr(images, 'get_frames'):
+            reducer.update(images.get_frames(start, start + block))
+        else:
+            reducer.update(np.stack([np.asarray(images[i]) for i in
+                                     range(start, min(start + block,
+                                                      len(images)))]))
+    return reducer
+
+
+def reduce_frames(images, block=100, workers=0):
+    """
+    Per-pixel sum, mean, variance and max of a series, in one pass.
+
+    images: EigerImages2 (or a view, SparseFrames...), a TIFF glob pattern
+            or pims sequence, or any iterable of frames, e.g.
+            EigerImages2.follow() to reduce a series while it is taken
+    block: frames read and reduced at a time
+    workers: > 0 splits the blocks over that many threads (each with its
+            own accumulators, merged at the end); needs random access, so
+            not for iterables like follow()
+    returns a dict with count, sum, mean, variance and max
+    """
+    if isinstance(images, str):
+        images = tiff_series(images)
+    if not workers:
+        reducer = FrameReducer()
+        for frames in _blocks(images, block):
+            reducer.update(frames)
+        return reducer.results()
+    starts = list(range(0, len(images), block))
+    with ThreadPoolExecutor(workers) as pool:
+        futures = [pool.submit(_reduce_range, images, starts[k::workers],
+                               block) for k in range(workers)]
+        reducer = FrameReducer()
+        for future in futures:
+            reducer.merge(future.result())
+    return reducer.results()
@@ -15,9 +15,12 @@ get_fields = db.get_fields
 get_images = db.get_images
 get_table = db.get_table
 from matplotlib import pyplot as pltfrom
-from lmfit import  Model
-from lmfit import minimize, Parameters, Parameter, report_fit
-from scipy.special import erf
+Model = lazy_from('lmfit', 'Model')
+minimize = lazy_from('lmfit', 'minimize')
+Parameters = lazy_from('lmfit', 'Parameters')
+Parameter = lazy_from('lmfit', 'Parameter')
+report_fit = lazy_from('lmfit', 'report_fit')
+erf = lazy_from('scipy.special', 'erf')
 
 import itertools 
 markers =  ['o',   'H', 'D', 'v',  '^', '<',  '>', 'p',
@@ -40,11 +40,23 @@ def get_R(header_si, header_rh):
 voltage_CHA = [ 3.5, 4.0, 4.5, 5.0, 5.5]
 voltage_CHA = [ 3.0,3.2,3.4,3.6,3.8,4.0,4.2,4.4,4.6,4.8,5.0,5.2,5.4]
 
-r_eng=np.array(np.loadtxt("/home/xf11id/Downloads/R_Rh_0p180.txt"))[:,0]/1e3
-rsi_0p18=np.array(np.loadtxt("/home/xf11id/Downloads/R_Si_0p180.txt"))[:,1]
-rrh_0p18=np.array(np.loadtxt("/home/xf11id/Downloads/R_Rh_0p180.txt"))[:,1]
+_hdm_reflectivity = None
+
+
+def hdm_reflectivity():
+    """
+    Calculated Si and Rh stripe reflectivities at 0.18 deg, read on first
+    use: returns r_eng (keV), rsi_0p18, rrh_0p18
+    """
+    global _hdm_reflectivity
+    if _hdm_reflectivity is None:
+        rh = np.loadtxt("/home/xf11id/Downloads/R_Rh_0p180.txt")
+        si = np.loadtxt("/home/xf11id/Downloads/R_Si_0p180.txt")
+        _hdm_reflectivity = rh[:, 0] / 1e3, si[:, 1], rh[:, 1]
+    return _hdm_reflectivity
 
 def get_Rdata( voltage_CHA, E ):
+    r_eng, rsi_0p18, rrh_0p18 = hdm_reflectivity()
     R = np.zeros(len(voltage_CHA), len(E)) 
     fig, ax = plt.subplots()
     ax.plot(r_eng,rsi_0p18/rrh_0p18,label="calc 0.18 deg")
@@ -11,6 +11,8 @@ def xpcs_count(detectors, *, md=None):
     Similar to `count`
 
     Customized to provide access to files before acquisition completes.
+    The frames can then be analysed while they are being written with
+    EigerImages2.follow() (see 92-handler2.py).
     """
 
     md = md or {}
@@ -217,8 +219,8 @@ def relabel_figure(fig, new_title):
     
 
 
-from suitcase.spec import DocumentToSpec
-import suitcase.spec
+# suitcase.spec is imported, and the spec file opened, by the first document
+DocumentToSpec = lazy_from('suitcase.spec', 'DocumentToSpec')
 
 # Monkey-patch module globals.
 #suitcase.spec._SCANS_WITHOUT_MOTORS.extend(['count'])
@@ -230,7 +232,7 @@ import suitcase.spec
 specpath = os.path.expanduser('/home/xf11id/specfiles/chx_spec_2017_11_28.spec')
 
 #spec_cb = DocumentToSpec('/home/xf11id/specfiles/testing.spec')
-spec_cb = DocumentToSpec(specpath)
+spec_cb = lazy_object(DocumentToSpec, specpath)
 
 
 RE.subscribe(spec_cb)
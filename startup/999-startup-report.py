@@ -0,0 +1,99 @@
+"""
+Report of the startup timing collected by 0-startup-timing.py.
+
+Each launch is appended as one JSON line to startup_timing.jsonl in the
+profile's log directory, and files that got noticeably slower than in
+the previous launches are flagged. Set CHX_STARTUP_REPORT=0 to skip the
+printout (the history is still written), or CHX_STARTUP_TIMING_JSON to a
+path to also get this launch alone as a JSON file.
+"""
+import json
+import os
+import time
+from datetime import datetime
+
+STARTUP_TIMING_HISTORY = os.path.join(get_ipython().profile_dir.log_dir,
+                                      'startup_timing.jsonl')
+
+
+def _startup_history(path=STARTUP_TIMING_HISTORY, last=10):
+    "The last `last` launches recorded in path."
+    try:
+        with open(path) as f:
+            lines = f.readlines()[-last:]
+    except OSError:
+        return []
+    history = []
+    for line in lines:
+        try:
+            history.append(json.loads(line))
+        except ValueError:
+            pass
+    return history
+
+
+def _typical_times(history):
+    "Median wall time of each file over the launches in history."
+    times = {}
+    for launch in history:
+        for record in launch['files']:
+            times.setdefault(record['file'], []).append(record['wall'])
+    return {name: sorted(t)[len(t) // 2] for name, t in times.items()}
+
+
+def startup_report(launch=None, sort='wall', top=None, history=True,
+                   slower=1.5, min_seconds=1.):
+    """
+    Print the startup timing of launch (default: this one).
+
+    sort: 'wall', 'import', 'pv' (descending) or 'file' (startup order)
+    top: only print the top files
+    history: compare with the median of the previous launches and flag
+        the files more than `slower` times and `min_seconds` slower
+    """
+    if launch is None:
+        launch = _startup_launch()
+    records = list(launch['files'])
+    if sort != 'file':
+        records.sort(key=lambda r: r[sort], reverse=True)
+    typical = _typical_times(_startup_history()[:-1]) if history else {}
+    print('{:<32}{:>9}{:>9}{:>9}'.format('startup file', 'wall s',
+                                         'import s', 'PV s'))
+    for record in records[:top]:
+        flag = ''
+        before = typical.get(record['file'])
+        if (before is not None and record['wall'] > slower * before and
+                record['wall'] - before > min_seconds):
+            flag = '  (usually {:.1f} s)'.format(before)
+        print('{:<32}{:>9.2f}{:>9.2f}{:>9.2f}{}'.format(
+            record['file'], record['wall'], record['import'], record['pv'],
+            flag))
+    print('{:<32}{:>9.2f}'.format('total', launch['total']))
+
+
+def _startup_launch():
+    return {'time': datetime.now().isoformat(timespec='seconds'),
+            'total': time.perf_counter() - startup_timer.t0,
+            'files': startup_timer.files}
+
+
+def _write_startup_timing():
+    launch = _startup_launch()
+    try:
+        os.makedirs(os.path.dirname(STARTUP_TIMING_HISTORY), exist_ok=True)
+        with open(STARTUP_TIMING_HISTORY, 'a') as f:
+            f.write(json.dumps(launch) + '\n')
+        artifact = os.environ.get('CHX_STARTUP_TIMING_JSON')
+        if artifact:
+            with open(artifact, 'w') as f:
+                json.dump(launch, f, indent=1)
+    except OSError as e:
+        print('Could not save the startup timing: {}'.format(e))
+    return launch
+
+
+startup_timer.uninstall()
+_launch = _write_startup_timing()
+if os.environ.get('CHX_STARTUP_REPORT', '1') != '0':
+    startup_report(_launch, top=15)
+del _launch
@@ -279,11 +279,14 @@ class Sample(object):
         return md_current
 
 
+    @traced  # 29-acquisition-trace.py
     def snap(self, exposure_time=1, measure_type='snap', **md):
 
+        trace_phase('parameter setup')
         if exposure_time is not None:
             caput('XF:11IDB-ES{Det:Eig4M}cam1:AcquireTime', exposure_time)
 
+        trace_phase('metadata collection')
         md_current = self.get_md(**md)
         md_current['measure_type'] = measure_type
 
@@ -293,6 +296,7 @@ class Sample(object):
 
 
 
+    @traced  # 29-acquisition-trace.py
     def measure(self, exposure_time=1, measure_type='measure', **md):
 
         self.snap(exposure_time=exposure_time, measure_type=measure_type, **md)
@@ -300,6 +304,7 @@ class Sample(object):
 
 
 
+    @traced  # 29-acquisition-trace.py
     def measureSpots(self, num_spots=4, translation_amount=0.03, axis='y', exposure_time=None, measure_type='measureSpots', **md):
         '''Measure multiple spots on the sample.'''
 
@@ -321,13 +326,16 @@ class Sample(object):
             self.md['spot_number'] += 1
 
 
+    @traced  # 29-acquisition-trace.py
     def measureXPCS(self, exposure_time=0.00134, num_frame=2000, measure_type='XPCS', **md):
 
 
+        trace_phase('parameter setup')
         caput('XF:11IDB-ES{Det:Eig4M}cam1:AcquireTime', exposure_time)
         caput('XF:11IDB-ES{Det:Eig4M}cam1:AcquirePeriod', exposure_time)
         caput('XF:11IDB-ES{Det:Eig4M}cam1:NumImages', num_frame)
 
+        trace_phase('metadata collection')
         md_current = self.get_md(**md)
         md_current['measure_type'] = measure_type
 
@@ -335,18 +343,22 @@ class Sample(object):
         #count(**md_current)
         RE(count([eiger4m_single]),**md_current)
 
+        trace_phase('parameter reset')
         caput('XF:11IDB-ES{Det:Eig4M}cam1:AcquireTime', 1)
         caput('XF:11IDB-ES{Det:Eig4M}cam1:AcquirePeriod', 1)
         caput('XF:11IDB-ES{Det:Eig4M}cam1:NumImages', 1)
 
 
+    @traced  # 29-acquisition-trace.py
     def measureTimeSeries(self, exposure_time=0.002, num_frame=5000, measure_type='measureTimeSeries', **md):
 
 
+        trace_phase('parameter setup')
         caput('XF:11IDB-ES{Det:Eig4M}cam1:AcquireTime', exposure_time)
         caput('XF:11IDB-ES{Det:Eig4M}cam1:AcquirePeriod', exposure_time)
         caput('XF:11IDB-ES{Det:Eig4M}cam1:NumImages', num_frame)
 
+        trace_phase('metadata collection')
         md_current = self.get_md(**md)
         md_current['measure_type'] = measure_type
 
@@ -354,6 +366,7 @@ class Sample(object):
         #count(**md_current)
         RE(count([eiger4m_single]),**md_current)
 
+        trace_phase('parameter reset')
         caput('XF:11IDB-ES{Det:Eig4M}cam1:AcquireTime', 1)
         caput('XF:11IDB-ES{Det:Eig4M}cam1:AcquirePeriod', 1)
         caput('XF:11IDB-ES{Det:Eig4M}cam1:NumImages', 1)